@@ -1,3 +1,7 @@
 #!/bin/sh
 python /app/src/manage.py seed_db
-gunicorn --chdir /app/src app:app -w 5 --threads 5 -b 0.0.0.0:2375
\ No newline at end of file
+python /app/src/manage.py ensure_indexes
+if python /app/src/manage.py tls_setup; then
+    DOCKERTRAP_LISTENER=tls gunicorn -c /app/src/gunicorn.conf.py app:app &
+fi
+gunicorn -c /app/src/gunicorn.conf.py app:app
\ No newline at end of file
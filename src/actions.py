@@ -1,29 +1,26 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-import urllib3
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
-
 import argparse
 import os
-import yaml
 import json
-import pytz
 import sys
 from datetime import datetime, timedelta
 
-import random
-from random import randrange
 from pathlib import Path
 
 import socket
-import multiprocessing
 
-from pymisp import ExpandedPyMISP, MISPEvent, MISPTag
+#pymisp and multiprocessing are imported by the actions using them,
+#python -X importtime actions.py ... shows what a command loads
 
 from pymongo import MongoClient
 from utils import get_settings, extract_urls
 from analyzer import get_action_info
+from interning import HeaderResolver
+from ioc import IocIndex, IOC_COLLECTION, ensure_ioc_indexes, find_ioc, backfill_windows, save_backfill, ip_of
+from geoip import get_geoip, format_geo
+from campaigns import CampaignEngine, CAMPAIGN_COLLECTION, get_command
 
 
 
@@ -48,6 +45,7 @@ def get_lock(process_name):
 def call_with_timeout(func, args, kwargs, timeout):
 
     #for LINUX only
+    import multiprocessing
     manager = multiprocessing.Manager()
     return_dict = manager.dict()
     #define a wrapper of 'return dict' to store the results
@@ -65,10 +63,18 @@ def call_with_timeout(func, args, kwargs, timeout):
     else:
         return return_dict.get('value')
 
+def get_misp(misp_settings):
+    #built only for the actions talking to MISP
+    import urllib3
+    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+    from pymisp import ExpandedPyMISP
+    return ExpandedPyMISP(misp_settings['url'], misp_settings['key'], misp_settings['verify'], cert=misp_settings['cert'])
+
 def get_misp_event(misp, event_name):
     event = misp.search(eventinfo=event_name)
 
     if not event:
+        from pymisp import MISPEvent
         event = MISPEvent()
         event.distribution = 3
         event.threat_level_id = 4
@@ -114,15 +120,26 @@ def export_as_json_feed(misp, event_name, outputdir):
             hash_file.write('{},{}\n'.format(element[0], element[1]))
     print("Hashes saved. Feed creation completed.")
 
-def get_attributes(mongo_client, time_delta_in_minutes):
+def get_attributes(mongo_client, time_delta_in_minutes, ioc_index=None, windows=None):
+    #windows: [(start, end)] read instead of the last time_delta_in_minutes
     db = mongo_client['DockerHoneypot']
 
-    start = datetime.now() - timedelta(minutes=int(time_delta_in_minutes))
-    request_logs = db.http_request_log.find( {'Date': {'$gte': start}})
+    if windows is None:
+        start = datetime.now() - timedelta(minutes=int(time_delta_in_minutes))
+        request_logs = db.http_request_log.find( {'Date': {'$gte': start}})
+    else:
+        request_logs = db.http_request_log.find({'$or': [{'Date': {'$gte': start, '$lt': end}} for start, end in windows]})
+    header_resolver = HeaderResolver(db)
+
+    #logs the analyzer has not labeled yet are matched against the known campaigns without saving anything
+    campaigns = None
+    campaign_settings = get_settings()['campaigns']
+    if campaign_settings['enabled']:
+        campaigns = CampaignEngine(db[CAMPAIGN_COLLECTION], threshold=campaign_settings['threshold']).load()
 
     attributes = {}
 
-    for request in request_logs:
+    for request in header_resolver.iter_rehydrated(request_logs):
 
         data_json = request['DataJson']
         action_info = get_action_info(request)
@@ -134,6 +151,12 @@ def get_attributes(mongo_client, time_delta_in_minutes):
         if action_info['action'] in ['Ignore','Unhandled']:
             continue
 
+        tags = []
+        cmd = get_command(action_info)
+        if campaigns and cmd:
+            action_info['campaign'] = request.get('CampaignId') or campaigns.assign(cmd, persist=False)
+            tags.append({'name': 'dockertrap:campaign="{}"'.format(action_info['campaign'])})
+
         comment = action_info['action'] + ';'
 
         for name,value in action_info.items():
@@ -151,15 +174,62 @@ def get_attributes(mongo_client, time_delta_in_minutes):
                 'type':'ip-src',
                 'value':request['SourceIP'],
                 'comment': comment,
-                'to_ids':False
+                'to_ids':False,
+                'Tag': []
             }
 
         for url in action_info['urls']:
-            attributes[url] = {
+            attributes.setdefault(url, {
                 'type':'url',
                 'value':url,
-                'to_ids':False
-            }
+                'to_ids':False,
+                'Tag': []
+            })
+
+        for key in [source_ip] + action_info['urls']:
+            for tag in tags:
+                if tag not in attributes[key]['Tag']:
+                    attributes[key]['Tag'].append(tag)
+
+        if ioc_index:
+            ioc_index.add_action(action_info)
+
+    if ioc_index:
+        ioc_index.flush()
+
+    add_geo_comments(attributes)
+
+    return attributes
+
+def add_geo_comments(attributes):
+    #one lookup per exported IP, the comment gets country, city and AS
+    geoip = get_geoip(get_settings())
+    ips = [ip_of(a['value']) for a in attributes.values() if a['type'] in ['ip-src', 'ip-dst']]
+    geo = geoip.enrich_many(ips)
+
+    for attribute in attributes.values():
+        info = geo.get(ip_of(attribute['value'])) if attribute['type'] in ['ip-src', 'ip-dst'] else None
+        if info:
+            attribute['comment'] = '{} Geo: {};'.format(attribute.get('comment') or '', format_geo(info)).strip()
+
+    geoip.close()
+
+def get_ioc_attributes(mongo_client, time_delta_in_minutes):
+    #reads the iocs index maintained by analyzer.py instead of the raw logs
+    db = mongo_client['DockerHoneypot']
+
+    start = datetime.now() - timedelta(minutes=int(time_delta_in_minutes))
+    attributes = {}
+
+    for ioc in db[IOC_COLLECTION].find({'LastSeen': {'$gte': start}}, {'_id': 0, 'SourceIPs': 0}):
+        attributes[ioc['Value']] = {
+            'type': ioc['Type'],
+            'value': ioc['Value'],
+            'comment': 'Seen {} times by {} between {} and {};'.format(ioc['Hits'], ', '.join(ioc.get('Sensors', [])), ioc['FirstSeen'], ioc['LastSeen']),
+            'to_ids': False
+        }
+
+    add_geo_comments(attributes)
 
     return attributes
 
@@ -182,34 +252,65 @@ def export_csv(filepath, event_name, attributes):
 
 def main():
     parser = argparse.ArgumentParser(description='Push detected IOCs to a MISP instance.')
-    parser.add_argument('action', type=str, help="action: export_misp, export_csv, generate_misp_feed")
+    parser.add_argument('action', type=str, help="action: export_misp, export_csv, export_parquet, generate_misp_feed, index_iocs, lookup_ioc")
     parser.add_argument("-l", "--last", help="timedelta, can be defined minutes.")
     parser.add_argument("-e", "--event-name",  help="MISP event name to use", default='Docker honeypot (DockerTrap)')
-    parser.add_argument("-d", "--output-dir",  help="Output directory to export feed")
+    parser.add_argument("-d", "--output-dir",  help="Output directory to export feed or parquet files")
     parser.add_argument("-f", "--csv-file",  help="File path to export csv")
     parser.add_argument("-p", "--publish", action='store_true', help="Publish event")
+    parser.add_argument("-s", "--source", choices=['logs', 'iocs'], default='logs', help="Export from the raw logs or only the indexed IOCs")
+    parser.add_argument("-v", "--value", help="IOC value to look up")
     
     args = parser.parse_args()
 
     settings = get_settings()
 
-    misp_settings = settings['misp']
-    misp = ExpandedPyMISP(misp_settings['url'], misp_settings['key'], misp_settings['verify'], cert=misp_settings['cert'])
     mongo_client = MongoClient(settings['mongodb']['uri'])
    
+    if args.source == 'iocs':
+        get_export_attributes = get_ioc_attributes
+    else:
+        get_export_attributes = get_attributes
+
     if args.action == 'export_misp':
-        attributes = get_attributes(mongo_client=mongo_client, time_delta_in_minutes=int(args.last))
+        attributes = get_export_attributes(mongo_client=mongo_client, time_delta_in_minutes=int(args.last))
+        misp = get_misp(settings['misp'])
         export_misp(misp=misp, event_name=args.event_name, attributes=attributes)
         if args.publish:
             publish_event(misp=misp, event_name=args.event_name)
 
     elif args.action == 'export_csv':
-        attributes = get_attributes(mongo_client=mongo_client, time_delta_in_minutes=int(args.last))
+        attributes = get_export_attributes(mongo_client=mongo_client, time_delta_in_minutes=int(args.last))
         export_csv(filepath=args.csv_file, event_name=args.event_name, attributes=attributes)
 
+    elif args.action == 'index_iocs':
+        #backfills the iocs index from the raw logs, the requests a previous run counted are skipped
+        db = mongo_client['DockerHoneypot']
+        ensure_ioc_indexes(db[IOC_COLLECTION])
+        end = datetime.now()
+        start = end - timedelta(minutes=int(args.last))
+        windows = backfill_windows(db, start, end)
+        if windows:
+            get_attributes(mongo_client=mongo_client, time_delta_in_minutes=int(args.last), ioc_index=IocIndex(db[IOC_COLLECTION]), windows=windows)
+        save_backfill(db, start, end)
+        print("IOCs indexed")
+
+    elif args.action == 'lookup_ioc':
+        ioc = find_ioc(mongo_client['DockerHoneypot'], args.value)
+        if ioc:
+            print(json.dumps(ioc, indent=2, default=str))
+        else:
+            print("Never seen: {}".format(args.value))
+
+    elif args.action == 'export_parquet':
+        #appends the logs stored since the previous run
+        from columnar import ParquetExporter
+        exporter = ParquetExporter(mongo_client['DockerHoneypot'], args.output_dir, lag_seconds=settings['retention']['lag'])
+        print("{} requests exported to {}".format(exporter.export(), args.output_dir))
+
     elif args.action == 'generate_misp_feed':
         Path(args.output_dir).mkdir(parents=True, exist_ok=True)
-        export_as_json_feed(misp=misp, event_name=args.event_name, outputdir=args.output_dir)
+        export_as_json_feed(misp=get_misp(settings['misp']), event_name=args.event_name, outputdir=args.output_dir)
 
     
 if __name__ == '__main__':
@@ -1,25 +1,63 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-import urllib3
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
-
-import os
 import datetime
-import yaml
+import functools
 import json
 import re
 import argparse
-import tarfile, gzip, io
-
-import colorama
-from colorama import init, Fore, Back, Style
-colorama.init()
 
-from pymongo import MongoClient
+import time
+import collections
+import concurrent.futures
+from pymongo import MongoClient, UpdateOne
+from pymongo.errors import OperationFailure
 from utils import extract_urls, get_settings
+from interning import HeaderResolver
+from ioc import IocIndex, IOC_COLLECTION, ensure_ioc_indexes
+from geoip import get_geoip, format_geo
+from campaigns import CampaignEngine, CAMPAIGN_COLLECTION, get_command
+
+#system events or just trash, get_action_info classifies them as 'Ignore'
+#the same expression is pushed down to the change stream, so they never reach the analyzer
+IGNORED_PATHS_REGEX = r'/start$|/attach$|/resize$|/events$|^/$|^/favicon\.ico$|^/v[\d.]*/exec/.*/json'
+IGNORED_PATHS = re.compile(IGNORED_PATHS_REGEX)
+
+#fields of http_request_log used by the analyzer
+WATCHED_FIELDS = [
+    'Date', 'SensorId', 'Method', 'Path', 'Args', 'DataJson', 'Data', 'SourceIP',
+    'Headers', 'HeadersRef', 'HeadersExtra', 'UserAgentRef', 'Count'
+]
+
+CHANGE_STREAM_HISTORY_LOST = 286
+
+MAX_BUILD_CONTEXT = 64*1024*1024
+
+def parse_build_context(data, max_size=MAX_BUILD_CONTEXT):
+    #the Dockerfile of a /build request, runs in the process pool of the live analyzer
+    import tarfile, gzip, io
 
-def get_action_info(request):
+    if data[:2] == b'\x1f\x8b':
+        with gzip.GzipFile(fileobj=io.BytesIO(data)) as f:
+            data = f.read(max_size + 1)
+    if len(data) > max_size:
+        raise ValueError('Build context is larger than {} bytes'.format(max_size))
+
+    tar = tarfile.open(fileobj=io.BytesIO(data))
+    dockerfile = tar.extractfile(tar.getmembers()[0]).read().decode('utf-8')
+    urls = extract_urls(cmd=dockerfile)
+
+    result = {}
+    if dockerfile:
+        result['dockerfile'] = dockerfile
+
+    if urls:
+        result['urls'] = urls
+
+    return result
+
+def get_action_info(request, parse_payload=True):
+    #parse_payload=False skips the costly parts (build contexts), only the action is classified
     data_json = request['DataJson']
     method = request['Method']
 
@@ -135,25 +173,11 @@ def get_action_info(request):
         action_info['action'] = 'Docker container build attempt'
         action_info['type'] = 'Exploitation'
 
-        if request['Data'][:2] == b'\x1f\x8b':
-            b = gzip.decompress(request['Data'])
-            file_like_object = io.BytesIO(b)
-        else:
-            file_like_object = io.BytesIO(request['Data'])
-
-        tar = tarfile.open(fileobj=file_like_object)
-        dockerfile = tar.extractfile(tar.getmembers()[0]).read().decode('utf-8')
-        urls = extract_urls(cmd=dockerfile)
-
-        if dockerfile:
-            action_info['dockerfile'] = dockerfile
-
-        if urls:
-            action_info['urls'] = urls
+        if parse_payload:
+            action_info.update(parse_build_context(request['Data']))
 
     #system events or just trash
-    elif path.endswith('/start') or path.endswith('/attach') or path.endswith('/resize') or path.endswith('/events') or \
-    path == ('/') or path == ('/favicon.ico') or re.match(r'\/v[\d.]*\/exec\/.*\/json', path):
+    elif IGNORED_PATHS.search(path):
         action_info['action'] = 'Ignore'
         action_info['type'] = 'Ignore'
 
@@ -163,12 +187,17 @@ def get_action_info(request):
 
     return action_info
 
-def handle_change(change):
+@functools.lru_cache(maxsize=None)
+def get_colors():
+    #colorama is only loaded by the commands printing actions
+    import colorama
+    colorama.init()
+    return colorama.Fore
 
-    dt = datetime.datetime.now().strftime("[%d/%m/%Y %H:%M:%S]")
+def print_action(action_info):
+    Fore = get_colors()
 
-    request = change['fullDocument']
-    action_info = get_action_info(request)
+    dt = datetime.datetime.now().strftime("[%d/%m/%Y %H:%M:%S]")
 
     if action_info['action'] == 'Ignore':
         return
@@ -194,19 +223,299 @@ def handle_change(change):
         if value:
             print (Fore.YELLOW + '{}: {}'.format(name.capitalize(), value))
 
+def handle_change(change, header_resolver=None):
+    request = change['fullDocument']
+    if header_resolver:
+        header_resolver.rehydrate(request)
+    print_action(get_action_info(request))
+
+class PendingAction:
+    __slots__ = ('token', 'action_info', 'future', 'deadline', 'done')
+
+    def __init__(self, token, action_info, future=None, deadline=None):
+        self.token = token
+        self.action_info = action_info
+        self.future = future
+        self.deadline = deadline
+        self.done = False
+
+class AnalysisPipeline:
+    #classification runs inline, build contexts are unpacked in a bounded process pool
+    #actions of one source IP are printed in arrival order, other IPs do not wait for them
+
+    def __init__(self, workers, job_timeout, max_pending, max_build_context=MAX_BUILD_CONTEXT, ioc_index=None, geoip=None, campaigns=None):
+        self.ioc_index = ioc_index
+        self.geoip = geoip
+        self.campaigns = campaigns
+        self.job_timeout = job_timeout
+        self.max_pending = max_pending
+        self.max_build_context = max_build_context
+        self._pool = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+        self._by_ip = {}
+        self._order = collections.deque()
+        self._futures = set()
+
+    @property
+    def pending(self):
+        return len(self._order)
+
+    def submit(self, change):
+        request = change['fullDocument']
+        request.setdefault('_id', change['documentKey']['_id'])
+        token = change['_id']
+
+        try:
+            action_info = get_action_info(request, parse_payload=False)
+        except Exception as err:
+            print (err)
+            action_info = None
+
+        if action_info is None or action_info['action'] == 'Ignore':
+            entry = PendingAction(token, None)
+            entry.done = True
+            self._order.append(entry)
+            return
+
+        if self.geoip:
+            action_info['geo'] = format_geo(self.geoip.lookup(request['SourceIP']))
+
+        entry = PendingAction(token, action_info)
+        if action_info['action'] == 'Docker container build attempt':
+            entry.future = self._pool.submit(parse_build_context, request['Data'], self.max_build_context)
+            entry.deadline = time.time() + self.job_timeout
+            self._futures.add(entry.future)
+
+        self._by_ip.setdefault(request['SourceIP'], collections.deque()).append(entry)
+        self._order.append(entry)
+
+        if len(self._futures) >= self.max_pending:
+            concurrent.futures.wait(self._futures, timeout=self.job_timeout, return_when=concurrent.futures.FIRST_COMPLETED)
+            self.flush()
+
+    def _ready(self, entry, now):
+        if entry.future is None or entry.future.done():
+            return True
+        if now >= entry.deadline:
+            #the output is not held back any longer, the worker finishes the job on its own
+            entry.future.cancel()
+            return True
+        return False
+
+    def _finish(self, entry):
+        if entry.future is not None:
+            self._futures.discard(entry.future)
+            if not entry.future.done():
+                entry.action_info['error'] = 'Payload analysis timed out after {}s'.format(self.job_timeout)
+            elif entry.future.cancelled():
+                entry.action_info['error'] = 'Payload analysis cancelled'
+            elif entry.future.exception():
+                entry.action_info['error'] = 'Payload analysis failed: {}'.format(entry.future.exception())
+            else:
+                entry.action_info.update(entry.future.result())
+
+        try:
+            if self.campaigns:
+                cmd = get_command(entry.action_info)
+                if cmd:
+                    request = entry.action_info['request']
+                    entry.action_info['campaign'] = self.campaigns.assign(cmd, request['Date'], request['_id'])
+            print_action(entry.action_info)
+            if self.ioc_index:
+                self.ioc_index.add_action(entry.action_info)
+        except Exception as err:
+            print (err)
+        entry.done = True
+
+    def flush(self):
+        #prints every action that is ready and returns the token of the last change
+        #all whose predecessors are done, None if there is no such change
+        now = time.time()
+        for ip, queue in list(self._by_ip.items()):
+            while queue and self._ready(queue[0], now):
+                self._finish(queue.popleft())
+            if not queue:
+                del self._by_ip[ip]
+
+        token = None
+        while self._order and self._order[0].done:
+            token = self._order.popleft().token
+        return token
+
+    def close(self):
+        #shutdown(cancel_futures=True) needs python 3.9, the jobs not started yet are cancelled here
+        for future in self._futures:
+            future.cancel()
+        self._pool.shutdown(wait=False)
+
+def get_pipeline():
+    projection = {'operationType': 1, 'documentKey': 1}
+    projection.update({'fullDocument.{}'.format(field): 1 for field in WATCHED_FIELDS})
+
+    return [
+        {'$match': {'operationType': 'insert', 'fullDocument.Path': {'$not': {'$regex': IGNORED_PATHS_REGEX}}}},
+        {'$project': projection}
+    ]
+
+class ChangeStreamConsumer:
+    #reads the change stream in micro-batches, the position is saved in analyzer_state under the consumer name
+    #so a restarted analyzer continues where the previous one stopped
+
+    def __init__(self, db, name, batch_size, batch_timeout, reset=False):
+        self.state = db['analyzer_state']
+        self.state_id = 'change_stream:{}'.format(name)
+        self.batch_size = batch_size
+        self.batch_timeout = batch_timeout
+
+        saved = None if reset else self.state.find_one({'_id': self.state_id})
+        self.saved_token = saved['ResumeToken'] if saved else None
+        max_await_time_ms = int(batch_timeout * 1000)
+
+        try:
+            self.stream = db['http_request_log'].watch(get_pipeline(), start_after=self.saved_token, batch_size=batch_size, max_await_time_ms=max_await_time_ms)
+        except OperationFailure as err:
+            if err.code != CHANGE_STREAM_HISTORY_LOST:
+                raise
+            print ('The saved position is no longer in the oplog, starting from now')
+            self.stream = db['http_request_log'].watch(get_pipeline(), batch_size=batch_size, max_await_time_ms=max_await_time_ms)
+
+    @property
+    def resume_token(self):
+        #position after the last returned change, including the filtered out ones
+        return self.stream.resume_token
+
+    def batches(self):
+        #yields a batch every batch_timeout at most, empty when nothing happened
+        with self.stream:
+            while self.stream.alive:
+                batch = []
+                deadline = time.time() + self.batch_timeout
+                while len(batch) < self.batch_size and time.time() < deadline:
+                    change = self.stream.try_next()
+                    if change is None:
+                        if batch:
+                            break
+                        continue
+                    batch.append(change)
+                yield batch
+
+    def save(self, token):
+        if token and token != self.saved_token:
+            self.saved_token = token
+            self.state.update_one({'_id': self.state_id}, {'$set': {'ResumeToken': token}}, upsert=True)
+
+def print_stats(db, settings, args):
+    from stats import Stats, DIMENSIONS, COLLECTION_DIMENSIONS, ensure_stats_indexes, parse_since, check_filters
+
+    if args.query == 'top' and args.dimension not in DIMENSIONS:
+        raise SystemExit('Dimension should be one of: {}'.format(', '.join(DIMENSIONS)))
+    if args.query == 'top' and args.dimension in COLLECTION_DIMENSIONS and (args.since or args.until):
+        raise SystemExit('The {} top ranks all-time hits, --since and --until do not apply'.format(args.dimension))
+    malformed = [f for f in args.filter if '=' not in f]
+    if malformed:
+        raise SystemExit('Filters should be DIMENSION=VALUE: {}'.format(', '.join(malformed)))
+    filters = dict(f.split('=', 1) for f in args.filter)
+    try:
+        check_filters(args.dimension if args.query == 'top' else None, filters)
+    except ValueError as err:
+        raise SystemExit(err)
+
+    cache_ttl = settings['stats']['cache_ttl']
+    ensure_stats_indexes(db, cache_ttl)
+    stats = Stats(db, cache_ttl)
+
+    since = parse_since(args.since or '24h')
+    until = parse_since(args.until) if args.until else datetime.datetime.utcnow()
+
+    if args.query == 'top':
+        rows = stats.top(args.dimension, since, until, args.limit, args.page, filters)
+    else:
+        rows = stats.timeline(since, until, args.bucket, filters)
+
+    if args.json:
+        print (json.dumps(rows, default=str))
+        return
+
+    for row in rows:
+        print ('{:>10}  {}'.format(row.get('Count', row.get('Hits')), row.get('Value', row.get('Date'))))
+
+def store_geo(logs, batch, geo):
+    #the enrichment of a batch is saved on its requests with one bulk write
+    requests = [
+        UpdateOne({'_id': change['documentKey']['_id']}, {'$set': {'Geo': geo[change['fullDocument']['SourceIP']]}})
+        for change in batch if geo.get(change['fullDocument']['SourceIP'])
+    ]
+    if requests:
+        logs.bulk_write(requests, ordered=False)
+
 def main():
+    parser = argparse.ArgumentParser(description='Show attacks logged by the sensors.')
+    parser.add_argument("-n", "--name", help="Consumer name, the position in the change stream is saved under it", default='default')
+    parser.add_argument("--reset", action='store_true', help="Ignore the saved position and start from now")
+
+    subparsers = parser.add_subparsers(dest='command')
+    stats_parser = subparsers.add_parser('stats', help="Top-N and timeline queries over the rollups, IOCs and campaigns")
+    stats_parser.add_argument("query", choices=['top', 'timeline'])
+    stats_parser.add_argument("dimension", nargs='?', help="top: source, action, type, image, sensor, path, ioc or campaign")
+    stats_parser.add_argument("--since", help="Relative (90m, 24h, 7d) or ISO 8601 UTC date, 24h by default")
+    stats_parser.add_argument("--until", help="Relative (90m, 24h, 7d) or ISO 8601 UTC date, now by default")
+    stats_parser.add_argument("--limit", type=int, default=10)
+    stats_parser.add_argument("--page", type=int, default=1)
+    stats_parser.add_argument("--bucket", choices=['hour', 'day'], default='hour', help="timeline resolution")
+    stats_parser.add_argument("--filter", action='append', default=[], metavar='DIMENSION=VALUE', help="e.g. source=1.2.3.4, can be repeated")
+    stats_parser.add_argument("--json", action='store_true')
+    args = parser.parse_args()
+
     settings = get_settings()
+    analyzer_settings = settings['analyzer']
     
     client = MongoClient(settings['mongodb']['uri'])
+    db = client['DockerHoneypot']
 
-    print ('Waiting for events...')
-    for change in client['DockerHoneypot']['http_request_log'].watch():
-        #handle_change(change)
+    if args.command == 'stats':
+        print_stats(db, settings, args)
+        return
 
-        try:
-            handle_change(change)
-        except Exception as err:
-            print (err)
+    header_resolver = HeaderResolver(db)
+
+    ensure_ioc_indexes(db[IOC_COLLECTION])
+    ioc_index = IocIndex(db[IOC_COLLECTION], live=True)
+
+    consumer = ChangeStreamConsumer(db, args.name, analyzer_settings['batch_size'], analyzer_settings['batch_timeout'], args.reset)
+    geoip = get_geoip(settings)
+
+    campaigns = None
+    if settings['campaigns']['enabled']:
+        campaigns = CampaignEngine(db[CAMPAIGN_COLLECTION], db['http_request_log'], settings['campaigns']['threshold']).load()
+
+    pipeline = AnalysisPipeline(
+        analyzer_settings['workers'], analyzer_settings['job_timeout'], analyzer_settings['max_pending'],
+        ioc_index=ioc_index, geoip=geoip if geoip.enabled else None, campaigns=campaigns
+    )
+
+    print ('Waiting for events...')
+    try:
+        for batch in consumer.batches():
+            header_resolver.rehydrate_many([change['fullDocument'] for change in batch])
+            geo = geoip.enrich_many([change['fullDocument']['SourceIP'] for change in batch])
+            store_geo(db['http_request_log'], batch, geo)
+
+            for change in batch:
+                pipeline.submit(change)
+
+            #the position only moves past changes that have been printed and indexed
+            token = pipeline.flush()
+            if not pipeline.pending:
+                token = consumer.resume_token
+            if token:
+                ioc_index.flush()
+                if campaigns:
+                    campaigns.flush()
+            consumer.save(token)
+    finally:
+        pipeline.close()
+        ioc_index.flush()
+        if campaigns:
+            campaigns.flush()
 
 if __name__ == "__main__":
     main()
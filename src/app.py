@@ -1,48 +1,362 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-import json, yaml
+import json
 import datetime, time
 import secrets
 import os
+import threading
+import contextlib
 import dateutil.parser
 
 import mongoengine
+from bson import ObjectId
+from pymongo.errors import PyMongoError
 
 import logging
 from logging.handlers import RotatingFileHandler
 
-from flask import Flask, make_response, jsonify, request, Response, stream_with_context, redirect
+from flask import Flask, make_response, jsonify, request, Response, stream_with_context, redirect, g
 from flask_mongoengine import MongoEngine
-
-from models import db, Docker, DockerImage, DockerContainer, HttpRequestLog, DockerExec
-from utils import get_random_name, get_settings
+from flask_mongoengine.connection import create_connections
+
+from models import db, Docker, DockerImage, DockerContainer, HttpRequestLog, DockerExec, SuppressedRequestLog, HeaderSet, UserAgentString, ContainerFilesystem, Sample
+from utils import get_random_name, get_settings, load_template
+from throttle import RateLimiter, Tarpit
+from compaction import Compactor
+from interning import HeaderInterner
+from spool import Spool, SpoolDrainer, insert_request_logs
+from shipping import Shipper
+from shell import Shell, Overlay, get_base_filesystem, MAX_DOWNLOADS
+from images import ImageResolver
+from documents import DocumentCache, raw_document, encode
+from profiling import Profiler
+from events import EventBus, EVENT_COLLECTION, FilterError, parse_filters, parse_timestamp
+from tls import handshakes
+from samples import SampleStore, SampleExtractor
+from lifecycle import ContainerLifecycle, exits_after, exit_containers, status_text, reap
 
 CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
 MODELS_TEMPLATES_DIR = os.path.join(CURRENT_DIR,'templates','models')
+SHELL_FILESYSTEM = os.path.join(CURRENT_DIR,'templates','shell','filesystem.yml')
 
 settings = get_settings()
 
 app = Flask(__name__)
 
+#the client connects on first use: with a preloaded app the gunicorn master never opens a connection
 app.config['MONGODB_SETTINGS'] = {
-    'host': settings['mongodb']['uri']
+    'host': settings['mongodb']['uri'],
+    'connect': False,
+    'maxPoolSize': settings['mongodb']['max_pool_size'],
+    'minPoolSize': settings['mongodb']['min_pool_size']
     }
 
+if settings['spool']['enabled']:
+    app.config['MONGODB_SETTINGS']['serverSelectionTimeoutMS'] = settings['spool']['mongo_timeout_ms']
+
 db.init_app(app)
 
+if settings['throttle']['enabled']:
+    rate_limiter = RateLimiter(settings['throttle']['rate'], settings['throttle']['burst'], settings['throttle']['max_clients'])
+    tarpit = Tarpit(settings['throttle']['tarpit_delay'], settings['throttle']['tarpit_slots'])
+else:
+    rate_limiter = None
+    tarpit = None
+
+if settings['compaction']['enabled']:
+    compactor = Compactor(
+        settings['compaction']['window'], settings['compaction']['paths'],
+        settings['compaction']['exclude'], settings['compaction']['max_groups']
+    )
+else:
+    compactor = None
+
+header_interner = None
+
+def intern_headers(log_params):
+    global header_interner
+
+    if not settings['interning']['enabled']:
+        return log_params
+
+    #created on first use, the collections are not touched at import time
+    if header_interner is None:
+        user_agents = UserAgentString._get_collection() if settings['interning']['user_agent'] else None
+        header_interner = HeaderInterner(HeaderSet._get_collection(), user_agents, settings['interning']['cache_size'])
+
+    return header_interner.intern(log_params)
+
+def save_request_log(log_params):
+    if compactor is None or not compactor.applies_to(log_params['Path']):
+        return HttpRequestLog(**intern_headers(log_params)).save()
+
+    fingerprint = compactor.fingerprint(log_params)
+    group = compactor.repeat(fingerprint, log_params['Date'])
+    if group:
+        update = {
+            '$inc': {'Count': 1},
+            '$max': {'Last': log_params['Date']}
+        }
+        if compactor.is_sampled(group.count):
+            update['$push'] = {'SampledDates': log_params['Date']}
+
+        result = HttpRequestLog._get_collection().update_one({'_id': group.doc_id}, update)
+        if result.matched_count:
+            return
+        compactor.forget(fingerprint)
+
+    o = HttpRequestLog(
+        Fingerprint=fingerprint,
+        Count=1,
+        First=log_params['Date'],
+        Last=log_params['Date'],
+        SampledDates=[log_params['Date']],
+        **intern_headers(log_params)
+    ).save()
+    compactor.register(fingerprint, o.id, log_params['Date'])
+    return o
+
+if settings['collector']['url']:
+    #the request logs are only written to the spool, sealed segments are shipped to the collector
+    shipper = Shipper(
+        settings['collector']['url'], settings['collector']['token'], settings['sensor']['id'],
+        settings['collector']['timeout'], settings['collector']['compress_level']
+    )
+    spool = Spool(
+        settings['spool']['directory'], settings['spool']['segment_size'], settings['collector']['interval'],
+        settings['spool']['max_bytes'], settings['spool']['fsync']
+    )
+    spool_drainer = SpoolDrainer(spool, shipper.send, settings['collector']['interval'], settings['collector']['batch_size'])
+elif settings['spool']['enabled']:
+    shipper = None
+    spool = Spool(
+        settings['spool']['directory'], settings['spool']['segment_size'], settings['spool']['segment_age'],
+        settings['spool']['max_bytes'], settings['spool']['fsync']
+    )
+    spool_drainer = SpoolDrainer(
+        spool, lambda documents: insert_request_logs(HttpRequestLog._get_collection(), documents),
+        settings['spool']['interval'], settings['spool']['batch_size']
+    )
+else:
+    shipper = None
+    spool = None
+
+if settings['profiling']['enabled']:
+    profiler = Profiler(settings['profiling']['socket_dir'], settings['profiling']['slow_ms'])
+else:
+    profiler = None
+
+def phase(name):
+    #times a part of the request when profiling
+    timings = g.get('timings')
+    return timings.phase(name) if timings is not None else contextlib.nullcontext()
+
+#encoded container and exec inspect documents
+inspect_cache = DocumentCache(settings['inspect']['cache_size'], settings['inspect']['cache_ttl'])
+
+image_resolver = None
+
+def get_image_resolver():
+    global image_resolver
+
+    if image_resolver is None:
+        image_resolver = ImageResolver(
+            DockerImage._get_collection(), settings['sensor']['id'], load_template(MODELS_TEMPLATES_DIR + '/image_inspect.yml'),
+            settings['images']['cache_size'], settings['images']['cache_ttl']
+        )
+    return image_resolver
+
+event_bus = None
+#a streaming events client holds a thread of the worker until the stream ends
+event_slots = threading.BoundedSemaphore(max(int(settings['events']['max_subscribers']), 1))
+
+def get_event_bus():
+    global event_bus
+
+    #created on first use, the collections are not touched at import time
+    if event_bus is None:
+        collection = Docker._get_db()[EVENT_COLLECTION] if settings['events']['persist'] else None
+        event_bus = EventBus(settings['sensor']['id'], settings['events']['history'], collection, settings['events']['poll_interval'])
+    return event_bus
+
+def publish_container_event(container, action, **attributes):
+    attributes['image'] = container['Config']['Image']
+    attributes['name'] = container['Name'].lstrip('/')
+    get_event_bus().publish('container', action, container['Id'], attributes)
+
+container_lifecycle = None
+
+def get_container_lifecycle():
+    global container_lifecycle
+
+    if container_lifecycle is None:
+        container_lifecycle = ContainerLifecycle(
+            Docker._get_db(), settings['sensor']['id'], settings['containers']['interval'],
+            settings['containers']['max_containers'], settings['containers']['archive']
+        )
+    return container_lifecycle
+
+def update_containers():
+    #moves the containers whose command is done to exited and removes the ones past max_containers
+    exited, reaped = get_container_lifecycle().tick()
+    for container in exited:
+        inspect_cache.invalidate(container['Id'])
+        publish_container_event(container, 'die', exitCode='0')
+    for container_id in reaped:
+        inspect_cache.invalidate(container_id)
+
+container_ticker = None
+ticker_lock = threading.Lock()
+
+def start_container_ticker():
+    global container_ticker
+
+    #started by the first container due to exit in the worker, its die is published without waiting for a request
+    with ticker_lock:
+        if container_ticker is None:
+            container_ticker = threading.Thread(target=tick_containers, name='container-ticker', daemon=True)
+            container_ticker.start()
+
+def tick_containers():
+    while True:
+        time.sleep(settings['containers']['interval'])
+        try:
+            update_containers()
+        except PyMongoError as err:
+            app.logger.warning('Containers not updated: %s', err)
+
+def run_container(container, now):
+    #the fields of a container (re)starting now
+    exits_in = exits_after([container['Path']] + list(container['Args']), settings['containers']['run_seconds'])
+    container['State'].update(Status='running', Running=True, ExitCode=0, StartedAt=now.isoformat(), FinishedAt='0001-01-01T00:00:00Z')
+    container['ExitsAt'] = now + datetime.timedelta(seconds=exits_in) if exits_in is not None else None
+    if exits_in is not None:
+        start_container_ticker()
+
+sample_extractor = None
+
+def get_sample_extractor():
+    global sample_extractor
+
+    #created and started on first use, in the worker
+    if sample_extractor is None:
+        store = SampleStore(
+            settings['samples']['directory'], Sample._get_collection(), settings['samples']['max_entries'],
+            settings['samples']['max_entry_size'], settings['samples']['max_total_size']
+        )
+        sample_extractor = SampleExtractor(store, settings['samples']['max_queued_bytes'])
+        sample_extractor.start()
+    return sample_extractor
+
+#mongo is skipped until this time after a failed write, so an outage costs one timeout per retry interval
+mongo_retry_at = 0
+
+def store_request_log(log_params):
+    global mongo_retry_at
+
+    if shipper is not None:
+        #interned and compacted by the collector
+        spool.append(HttpRequestLog(**log_params).to_mongo().to_dict())
+        return
+
+    if spool is None:
+        return save_request_log(log_params)
+
+    if time.time() >= mongo_retry_at:
+        try:
+            return save_request_log(log_params)
+        except PyMongoError as err:
+            mongo_retry_at = time.time() + settings['spool']['retry_interval']
+            app.logger.warning('Request log spooled, mongo is unavailable: %s', err)
+
+    spool.append(HttpRequestLog(**log_params).to_mongo().to_dict())
+
+def save_suppressed_requests(summaries):
+    for summary in summaries:
+        last_seen = datetime.datetime.utcfromtimestamp(summary['LastSeen'])
+        SuppressedRequestLog.objects(
+            SensorId=settings['sensor']['id'],
+            SourceIP=summary['SourceIP'],
+            Date=last_seen.replace(minute=0, second=0, microsecond=0)
+        ).update_one(
+            upsert=True,
+            inc__Count=summary['Count'],
+            min__FirstSeen=datetime.datetime.utcfromtimestamp(summary['FirstSeen']),
+            max__LastSeen=last_seen,
+            set__LastPath=summary['LastPath']
+        )
+
+def over_limit_response():
+    if settings['throttle']['mode'] == 'tarpit' and tarpit.acquire():
+        resp = Response(tarpit.drip(), mimetype='application/json')
+        resp.call_on_close(tarpit.release)
+        return resp
+
+    resp = Response('', status=503)
+    resp.headers['Connection'] = 'close'
+    return resp
+
 @app.after_request
 def docker_headers_mimicking(response):
     for key, value in settings['headers'].items():
         response.headers[key] = value
     return response
 
+@app.after_request
+def profiling_after_request(response):
+    timings = g.get('timings')
+    if timings is None:
+        return response
+
+    timings.close_phase('handler')
+    timings.mark()
+    description = '{} {}'.format(request.method, request.path)
+
+    def finish():
+        #the body of streamed responses is produced after the handler
+        timings.close_phase('response')
+        profiler.end(timings, description)
+
+    response.call_on_close(finish)
+    return response
+
+def request_body():
+    #an archive upload is read up to max_archive_size and one byte, a larger one is neither read in full nor extracted
+    if request.endpoint != 'put_file':
+        return request.get_data()
+    if 'body' not in g:
+        max_size = settings['samples']['max_archive_size']
+        g.body = request.stream.read(max_size + 1) if (request.content_length or 0) <= max_size else b''
+    return g.body
+
 @app.before_request 
 def before_request_callback():
 
+    if profiler is not None:
+        g.timings = profiler.begin()
+
+    if rate_limiter is not None:
+        with phase('throttle'):
+            allowed, summaries = rate_limiter.hit(request.remote_addr, request.path)
+            if summaries:
+                try:
+                    save_suppressed_requests(summaries)
+                except PyMongoError as err:
+                    #the counters are best effort, they are not worth a failed request
+                    app.logger.warning('Suppressed requests not saved: %s', err)
+        if not allowed:
+            return over_limit_response()
+
     date_now_utc = datetime.datetime.utcnow()
 
+    with phase('body'):
+        data_json = request.get_json(silent=True) if request.endpoint != 'put_file' else None
+        data = request_body()
+
     log_params = {
+        #generated here, so a record replayed from the spool is deduplicated on _id
+        'id': ObjectId(),
         'Date': date_now_utc,
         'SensorId': settings['sensor']['id'],
         'SensorType': 'Docker',
@@ -52,23 +366,33 @@ def before_request_callback():
         'Args': dict(request.args),
         'Url': request.url,
         'Headers': dict(request.headers),
-        'DataJson': request.get_json(),
-        'Data': request.get_data(),
+        'DataJson': data_json,
+        'Data': data,
         'SourceIP': request.remote_addr
     }
+    if request.environ.get('wsgi.url_scheme') == 'https':
+        #peeked by the SSL context of the TLS listener, see tls.py
+        hello = handshakes.get(request.remote_addr, request.environ.get('REMOTE_PORT'))
+        if hello:
+            log_params['Tls'] = hello
 
-    o = HttpRequestLog(**log_params).save()
+    with phase('mongo'):
+        store_request_log(log_params)
 
     if settings['sensor']['log_file']:
         #dirty, but works
+        log_params['id'] = str(log_params['id'])
         log_params['Date'] = str(date_now_utc)
-        log_params['Data'] = str(request.get_data())
+        log_params['Data'] = str(data)
 
         date_str = date_now_utc.strftime('%d_%m_%Y')
         log_path = os.path.join(CURRENT_DIR,'logs', date_str + '_log.json')
-        with open(log_path,'a') as f:
+        with phase('log_file'), open(log_path,'a') as f:
             f.write('{}\r\n'.format(json.dumps(log_params)))
 
+    if profiler is not None:
+        g.timings.mark()
+
 @app.route('/')
 def index():
     anwer = {'message':'page not found'}
@@ -145,6 +469,11 @@ def put_file(container_id, api_version=None):
         return '', 404
     else:
         path = request.args.get("path")
+        if request.method == 'PUT' and settings['samples']['enabled']:
+            data = request_body()
+            if data and len(data) <= settings['samples']['max_archive_size']:
+                #extracted in the background, the upload is answered at once
+                get_sample_extractor().submit(data, path, request.remote_addr, settings['sensor']['id'])
         return '', 200
 
 @app.route('/containers/create', methods = ['POST', 'GET'], endpoint='container_create')
@@ -156,10 +485,9 @@ def create_container(api_version=None):
         image = container_request['Image']
 
         #do we have such image?
-        RepoTags = ['{}:latest'.format(image)]
-        docker_images = DockerImage.objects(RepoTags=RepoTags, SensorId=settings['sensor']['id'])
-        if len(docker_images) == 0:
-            answer = {"message":"No such image: {}".format(RepoTags)}
+        docker_image = get_image_resolver().resolve(image)
+        if docker_image is None:
+            answer = {"message":"No such image: {}".format(image)}
             return jsonify(answer),404
 
         if type(container_request['Cmd']) is list:
@@ -169,18 +497,27 @@ def create_container(api_version=None):
                 cmd = container_request['Cmd']
             else:
                 cmd = ''
+
+        #the process of the container, as shown by inspect and run by attach
+        argv = []
+        for part in [container_request.get('Entrypoint'), container_request.get('Cmd')]:
+            if isinstance(part, list):
+                argv += part
+            elif part:
+                argv.append(part)
+        argv = argv or ['']
         
-        with open(MODELS_TEMPLATES_DIR + '/containers.yml') as file:
-            new_container = yaml.load(file, Loader=yaml.FullLoader)['default']
+        new_container = load_template(MODELS_TEMPLATES_DIR + '/containers.yml')['default']
 
         container_id = secrets.token_hex(32)
 
         new_container['SensorId'] = settings['sensor']['id']
         new_container['Id'] = container_id
         new_container['Created'] = datetime.datetime.utcnow().isoformat()
-        new_container['Path'] = cmd
+        new_container['Path'] = argv[0]
+        new_container['Args'] = argv[1:]
         new_container['State']['StartedAt'] = datetime.datetime.utcnow().isoformat()
-        new_container['Image'] = "sha256:{}".format(container_id)
+        new_container['Image'] = "sha256:{}".format(docker_image['Id'])
         new_container['ResolvConfPath'] = "/var/lib/docker/containers/{}/resolv.conf".format(container_id)
         new_container['HostnamePath'] =  "/var/lib/docker/containers/{}/hostname".format(container_id)
         new_container['HostsPath'] =  "/var/lib/docker/containers/{}/hosts".format(container_id)
@@ -194,8 +531,13 @@ def create_container(api_version=None):
         new_container['Config']['Image'] = container_request['Image']
         new_container['NetworkSettings']['Networks']['bridge']['NetworkID'] = secrets.token_hex(32)
         new_container['NetworkSettings']['Networks']['bridge']['EndpointID'] = secrets.token_hex(32)
+        new_container['CreatedAt'] = datetime.datetime.utcnow()
+        new_container['CreatedBy'] = request.remote_addr
+        run_container(new_container, new_container['CreatedAt'])
 
         o = DockerContainer(**new_container).save()
+        publish_container_event(o, 'create')
+        update_containers()
 
         answer = {
             "Id":container_id,
@@ -214,8 +556,7 @@ def image_create(api_version=None):
         image = request.args.get("fromImage")
         tag = request.args.get("tag")
 
-        with open(MODELS_TEMPLATES_DIR + '/images.yml') as file:
-            new_image = yaml.load(file, Loader=yaml.FullLoader)['default']
+        new_image = load_template(MODELS_TEMPLATES_DIR + '/images.yml')['default']
 
         new_image['Created'] = int(datetime.datetime.utcnow().timestamp())
         new_image['Id'] = secrets.token_hex(32)
@@ -224,6 +565,7 @@ def image_create(api_version=None):
         new_image['SensorId'] = settings['sensor']['id']
 
         o = DockerImage(**new_image).save()
+        get_image_resolver().invalidate()
 
         @stream_with_context
         def generate():
@@ -242,6 +584,29 @@ def image_create(api_version=None):
 
     return Response(generate(), mimetype='application/json')
 
+def run_in_container(container, argv=None, command_line=''):
+    #runs a command in the emulated shell of the container, its overlay and the downloads are saved
+    container_id = container['Id']
+    state = ContainerFilesystem.objects(SensorId=settings['sensor']['id'], ContainerId=container_id).first()
+    docker = Docker.objects(SensorId=settings['sensor']['id']).only('KernelVersion').first()
+
+    hostname = container['Config'].get('Hostname') or container_id[:12]
+    kernel = docker['KernelVersion'] if docker else '5.4.0-65-generic'
+    variables = {'hostname': hostname, 'kernel': kernel, 'container_id': container_id}
+
+    fs = Overlay(get_base_filesystem(SHELL_FILESYSTEM), state['Files'] if state else None, variables)
+    shell = Shell(fs, hostname, kernel, container_id)
+    output = shell.run_argv(argv) if argv else shell.run(command_line)
+
+    if fs.changed or shell.downloads:
+        #the first MAX_DOWNLOADS downloads are kept, the overlay is bounded by MAX_OVERLAY_SIZE
+        ContainerFilesystem._get_collection().update_one(
+            {'SensorId': settings['sensor']['id'], 'ContainerId': container_id},
+            {'$set': {'Files': fs.entries()}, '$push': {'Downloads': {'$each': shell.downloads, '$slice': MAX_DOWNLOADS}}},
+            upsert=True
+        )
+    return output
+
 ##It will not work in case of nginx\unicorn, because http connection should be upgraded to pure TCP
 #http://ip:2375/v1.24/containers/cb0ef905f1aa248e32261af63a39da3988287bcf6323e0e368bfa7fef212950a/attach?stderr=1&stdout=1&stream=1
 @app.route('/containers/<container_id>/attach', methods = ['POST'], endpoint='container_attach')
@@ -252,11 +617,17 @@ def container_attach(container_id, api_version=None):
     if len(containers) == 0:
         return '', 404
 
-    cmd = containers[0]['Config']['Cmd']
-    if cmd in ['id','whoami']:
-        resp = Response("uid=0(root) gid=0(root) groups=0(root)")
+    container = containers[0]
+    publish_container_event(container, 'attach')
+    if container['Args'] or ' ' not in (container['Path'] or ''):
+        resp = Response(run_in_container(container, argv=[container['Path']] + list(container['Args'])))
     else:
-        resp = Response("")
+        #created before Path and Args were split, Path holds the whole command
+        resp = Response(run_in_container(container, command_line=container['Path']))
+
+    if exits_after([container['Path']] + list(container['Args']), settings['containers']['run_seconds']) is not None:
+        #a one-shot command is done once its output is sent, docker run waits for its die after the start
+        DockerContainer.objects(Id=container['Id']).update_one(set__ExitsAt=datetime.datetime.utcnow())
 
     resp.headers['Content-Type'] = 'application/vnd.docker.raw-stream'
     resp.headers['Connection'] = 'Upgrade'
@@ -279,13 +650,19 @@ def container_delete(container_id, api_version=None):
     containers = DockerContainer.objects(Id__startswith='{}'.format(container_id))
     if len(containers) != 0:
         container = containers[0]
-        container.delete()
+        #with its execs and filesystem
+        reap(Docker._get_db(), [container['Id']])
+        inspect_cache.invalidate(container['Id'])
+        publish_container_event(container, 'destroy')
         return '', 200
 
     containers = DockerContainer.objects(Name='/{}'.format(container_id))
     if len(containers) != 0:
         container = containers[0]
-        container.delete()
+        #with its execs and filesystem
+        reap(Docker._get_db(), [container['Id']])
+        inspect_cache.invalidate(container['Id'])
+        publish_container_event(container, 'destroy')
         return '', 200
 
     answer = {'message':'No such container: {}'.format(container_id)}
@@ -295,16 +672,18 @@ def container_delete(container_id, api_version=None):
 @app.route('/v<api_version>/containers/<container_id>/json', endpoint='container_info')
 @app.route('/containers/<container_id>/json', endpoint='container_info')
 def container_info(container_id, api_version=None):
-    containers = DockerContainer.objects(Id__startswith='{}'.format(container_id))
-    if len(containers) > 0:
-        return jsonify(containers[0])
-
-    containers = DockerContainer.objects(Name='/{}'.format(container_id))
-    if len(containers) > 0:
-        return jsonify(containers[0])
+    payload = inspect_cache.get(('container', container_id))
+    if payload is None:
+        container = raw_document(DockerContainer.objects(Id__startswith='{}'.format(container_id)))
+        if container is None:
+            container = raw_document(DockerContainer.objects(Name='/{}'.format(container_id)))
+        if container is None:
+            answer = {'message':'No such container: {}'.format(container_id)}
+            return jsonify(answer), 404
+        with phase('serialization'):
+            payload = inspect_cache.put(('container', container_id), container['Id'], encode(container))
 
-    answer = {'message':'No such container: {}'.format(container_id)}
-    return jsonify(answer), 404
+    return Response(payload, mimetype='application/json')
 
 #/v1.41/containers/061ee0bfdb4c/exec
 @app.route('/v<api_version>/containers/<container_id>/exec', methods = ['POST'], endpoint='container_exec')
@@ -325,24 +704,22 @@ def container_exec(container_id, api_version=None):
         new_exec['Running'] = False
         new_exec['ExitCode'] = 0
 
-        cmd_array = data.get('Cmd')
-        cmd = ''
-        if cmd_array:
-            cmd = ' '.join(cmd_array)
-
-        process_config = {"tty":True,"entrypoint":cmd,"arguments":[],"privileged":False}
+        #as docker does, the first word is the entrypoint and the rest the arguments
+        cmd_array = data.get('Cmd') or ['']
+        process_config = {"tty":True,"entrypoint":cmd_array[0],"arguments":cmd_array[1:],"privileged":False}
         new_exec['ProcessConfig'] = process_config
         new_exec['OpenStdin'] = False
         new_exec['OpenStderr'] = False
         new_exec['OpenStdout'] = False
         new_exec['CanRemove'] = False
-        new_exec['ContainerID'] = container_id
+        new_exec['ContainerID'] = container['Id']
         
         new_exec['DetachKeys'] = ""
         new_exec['Pid'] = 1637
         new_exec['SensorId'] = settings['sensor']['id']
 
         o = DockerExec(**new_exec).save()
+        publish_container_event(container, 'exec_create: {}'.format(' '.join(cmd_array)), execID=new_exec['Id'])
 
         answer = {"Id":new_exec['Id']}
         return jsonify(answer),201
@@ -359,147 +736,77 @@ def exec_start(api_version, exec_id):
         return jsonify(answer), 404
     exec_obj = exec_list[0]
 
-    cmd = exec_obj.ProcessConfig.get('entrypoint')
-    if cmd in ['id','whoami']:
-        resp = Response("uid=0(root) gid=0(root) groups=0(root)")
-    else:
-        resp = Response("")
+    containers = DockerContainer.objects(Id__startswith='{}'.format(exec_obj.ContainerID))
+    if len(containers) == 0:
+        answer = {'message':'No such container: {}'.format(exec_obj.ContainerID)}
+        return jsonify(answer), 404
+
+    argv = [exec_obj.ProcessConfig.get('entrypoint')] + list(exec_obj.ProcessConfig.get('arguments') or [])
+    publish_container_event(containers[0], 'exec_start: {}'.format(' '.join(argv)), execID=exec_obj.Id)
+    resp = Response(run_in_container(containers[0], argv=argv))
+    publish_container_event(containers[0], 'exec_die', execID=exec_obj.Id, exitCode='0')
 
     return resp, 200
 
 @app.route('/v<api_version>/exec/<exec_id>/json', methods = ['GET'], endpoint='exec_view')
-@app.route('/exec/<exec_id>/json', methods = ['POST'], endpoint='exec_view')
-def exec_view(api_version, exec_id):
-
-    exec_list = DockerExec.objects(Id__startswith='{}'.format(exec_id))
-    if len(exec_list) == 0:
-        answer = {'message':'No such container: {}'.format(exec_id)}
-        return jsonify(answer), 404
-
-    exec_obj = exec_list[0]   
+@app.route('/exec/<exec_id>/json', methods = ['GET'], endpoint='exec_view')
+def exec_view(exec_id, api_version=None):
+    payload = inspect_cache.get(('exec', exec_id))
+    if payload is None:
+        exec_obj = raw_document(DockerExec.objects(Id__startswith='{}'.format(exec_id)))
+        if exec_obj is None:
+            answer = {'message':'No such container: {}'.format(exec_id)}
+            return jsonify(answer), 404
+        with phase('serialization'):
+            payload = inspect_cache.put(('exec', exec_id), exec_obj['Id'], encode(exec_obj))
 
-    return jsonify(exec_obj)
+    return Response(payload, mimetype='application/json')
 
 #GET
 #http://ip:2375/v1.24/events?filters={"container":{"cb0ef905f1aa248e32261af63a39da3988287bcf6323e0e368bfa7fef212950a":true},"type":{"container":true}}
 @app.route('/v<api_version>/events', methods = ['GET'], endpoint='events')
 @app.route('/events', methods = ['GET'], endpoint='events')
 def events(api_version=None):
-
-    filters = json.loads(request.args.get("filters"))
-    id = list(filters['container'].keys())[0]
-
-    containers = DockerContainer.objects(Id=id, SensorId=settings['sensor']['id'])
-    if len(containers) > 0:
-        container = containers[0]
-        image_name = container.Config['Image']
-        container_name = container.Name
-
-    event_create = {
-          "status": "create",
-          "id": id,
-          "from": image_name,
-          "Type": "container",
-          "Action": "create",
-          "Actor": {
-            "ID": id,
-            "Attributes": {
-              "com.example.some-label": "some-label-value",
-              "image": image_name,
-              "name": container_name
-            }
-          },
-          "time": int(datetime.datetime.utcnow().timestamp()),
-          "timeNano": int(datetime.datetime.utcnow().timestamp())*10^9
-        }
-
-    event_network = {
-        "Type": "network",
-        "Action": "connect",
-        "Actor": {
-            "ID": id,
-            "Attributes": {
-                "container": id,
-                "name": "bridge",
-                "type": "bridge"
-            }
-        },
-        "scope": "local",
-        "time": int(datetime.datetime.utcnow().timestamp()),
-        "timeNano": int(datetime.datetime.utcnow().timestamp())*10^9
-    }
-
-    event_start = {
-        "status": "start",
-        "id": id,
-        "from": image_name,
-        "Type": "container",
-        "Action": "start",
-        "Actor": {
-            "ID": id,
-            "Attributes": {
-                "image": image_name,
-                "name": container_name
-            }
-        },
-        "scope": "local",
-        "time": int(datetime.datetime.utcnow().timestamp()),
-        "timeNano": int(datetime.datetime.utcnow().timestamp())*10^9
-    }
-        
-    event_resize = {
-        "status": "resize",
-        "id": id,
-        "from": image_name,
-        "Type": "container",
-        "Action": "resize",
-        "Actor": {
-            "ID": id,
-            "Attributes": {
-                "height": "30",
-                "image": image_name,
-                "name": container_name,
-                "width": "120"
-            }
-        },
-        "scope": "local",
-        "time": int(datetime.datetime.utcnow().timestamp()),
-        "timeNano": int(datetime.datetime.utcnow().timestamp())*10^9
-    }
-
-    event_die = {
-        "status": "die",
-        "id": id,
-        "from": image_name,
-        "Type": "container",
-        "Action": "die",
-        "Actor": {
-            "ID": id,
-            "Attributes": {
-                "exitCode": "0",
-                "image": image_name,
-                "name": container_name
-            }
-        },
-        "scope": "local",
-        "time": int(datetime.datetime.utcnow().timestamp()),
-        "timeNano": int(datetime.datetime.utcnow().timestamp())*10^9
-    }
-
-    @stream_with_context
-    def generate():
-        yield json.dumps(event_create)
-        yield json.dumps(event_network)
-        yield json.dumps(event_start)
-        yield json.dumps(event_resize)
-        yield json.dumps(event_die)
-
-    return Response(generate(), mimetype='application/json')
+    try:
+        filters = parse_filters(request.args.get("filters"))
+        since = parse_timestamp(request.args.get("since"))
+        until = parse_timestamp(request.args.get("until"))
+    except FilterError as err:
+        return jsonify({'message': str(err)}), 400
+
+    #over the limit the client gets the past events and the stream ends, as with until
+    live = event_slots.acquire(blocking=False)
+    stream = get_event_bus().subscribe(since, until, filters, settings['events']['max_duration'], live)
+
+    resp = Response(stream, mimetype='application/json')
+    if live:
+        resp.call_on_close(event_slots.release)
+    return resp
 
 #POST /v1.24/containers/cb0ef905f1aa248e32261af63a39da3988287bcf6323e0e368bfa7fef212950a/start HTTP/1.1
 @app.route('/v<api_version>/containers/<container_id>/start', methods = ['POST'], endpoint='container_start')
 @app.route('/containers/<container_id>/start', methods = ['POST'], endpoint='container_start')
 def container_start(api_version, container_id):
+    containers = DockerContainer.objects(Id__startswith='{}'.format(container_id))
+    if len(containers) > 0:
+        container = containers[0]
+        now = datetime.datetime.utcnow()
+        #attached before the start, as docker run and docker start -a do
+        done = container['ExitsAt'] is not None and container['ExitsAt'] <= now
+        if not container['State'].get('Running', True):
+            run_container(container, now)
+            if done and container['ExitsAt'] is not None:
+                container['ExitsAt'] = now
+            container.save()
+            inspect_cache.invalidate(container['Id'])
+        get_event_bus().publish('network', 'connect', container['NetworkSettings']['Networks']['bridge']['NetworkID'], {
+            'container': container['Id'], 'name': 'bridge', 'type': 'bridge'
+        })
+        publish_container_event(container, 'start')
+        if container['ExitsAt'] is not None and container['ExitsAt'] <= now:
+            for exited in exit_containers(Docker._get_db(), [container], now):
+                inspect_cache.invalidate(exited['Id'])
+                publish_container_event(exited, 'die', exitCode='0')
     return '', 204
 
 #/v1.24/containers/061ee0bfdb4c/kill
@@ -508,7 +815,17 @@ def container_start(api_version, container_id):
 def container_kill(api_version, container_id):
     containers = DockerContainer.objects(Id__startswith='{}'.format(container_id))
     if len(containers) > 0:
-        containers[0].delete()
+        container = containers[0]
+        if not container['State'].get('Running', True):
+            answer = {'message':'Container {} is not running'.format(container['Id'])}
+            return jsonify(answer), 409
+        #exited, it is removed by rm or the reaper
+        container['State'].update(Status='exited', Running=False, Pid=0, ExitCode=137, FinishedAt=datetime.datetime.utcnow().isoformat() + 'Z')
+        container['ExitsAt'] = None
+        container.save()
+        inspect_cache.invalidate(container['Id'])
+        publish_container_event(container, 'kill', signal=request.args.get('signal', '9'))
+        publish_container_event(container, 'die', exitCode='137')
         return '', 200
     else:
         answer = {'message':'No such container: {}'.format(container_id)}
@@ -523,9 +840,18 @@ def build(api_version=None):
 @app.route('/containers/json', endpoint='view_containers')
 @app.route('/v<api_version>/containers/json', endpoint='view_containers')
 def view_containers(api_version=None):
+    update_containers()
+
+    #as docker ps, the stopped containers with all=1 only, the newest first
+    query = DockerContainer.objects(SensorId=settings['sensor']['id'])
+    if request.args.get('all', '').lower() not in ('1', 'true'):
+        query = query.filter(State__Running__ne=False)
+    query = query.order_by('-CreatedAt')
+    if request.args.get('limit', '').isdigit() and int(request.args['limit']) > 0:
+        query = query.limit(int(request.args['limit']))
 
     containers = []
-    for container in DockerContainer.objects(SensorId=settings['sensor']['id']):
+    for container in query:
         new_container = {}
         new_container['Id'] = container['Id']
         new_container['Names'] = [container['Name']]
@@ -544,7 +870,7 @@ def view_containers(api_version=None):
         new_container['Ports'] = []
         new_container['Labels'] = {}
         new_container['State'] = container['State']['Status']
-        new_container['Status'] = 'Up About a minute'
+        new_container['Status'] = status_text(container['State'])
         new_container['HostConfig'] = {'NetworkMode':'default'}
         new_container['NetworkSettings'] = {}
         new_container['NetworkSettings']['Networks'] = container['NetworkSettings']['Networks']
@@ -576,13 +902,56 @@ def view_images(api_version=None):
     return jsonify(images)
 
 #/v1.37/images/9873176a8ff5ac192ce4d7df8a403787558b9f3981a4c4d74afb3edceeda451c/json
-#TODO
-@app.route('/v<api_version>/images/<image_id>/json', endpoint='image_info')
-@app.route('/images/<image_id>/json', endpoint='image_info')
-def image_info(api_version, image_id):
-    images = DockerImage.objects(SensorId=settings['sensor']['id'])
-    return '', 404
-    #return jsonify(DockerImage.objects(SensorId=settings['sensor']['id'], Id__startswith='{}'.format(image_id))[0])
+#/v1.41/images/library/alpine:3/json
+@app.route('/v<api_version>/images/<path:image_id>/json', endpoint='image_info')
+@app.route('/images/<path:image_id>/json', endpoint='image_info')
+def image_info(image_id, api_version=None):
+    inspect = get_image_resolver().inspect(image_id)
+    if inspect is None:
+        answer = {'message':'No such image: {}'.format(image_id)}
+        return jsonify(answer), 404
+
+    return jsonify(inspect)
+
+IMPORT_PID = os.getpid()
+
+def init_worker():
+    #connections and threads of a process serving requests
+    #with preload_app the app is imported once in the gunicorn master and gunicorn.conf.py calls this in every worker after the fork
+    if os.getpid() != IMPORT_PID:
+        #each worker gets its own client and pool, the one created before the fork is dropped unused
+        mongoengine.disconnect_all()
+        app.extensions['mongoengine'][db]['conn'] = create_connections(app.config)
+
+    if spool is not None:
+        spool_drainer.start()
+    if profiler is not None:
+        profiler.start()
+
+def shutdown_worker():
+    #on worker exit (max_requests recycling, reload or shutdown) what is only held in memory is written out
+    if rate_limiter is not None:
+        try:
+            save_suppressed_requests(rate_limiter.drain())
+        except PyMongoError as err:
+            app.logger.warning('Suppressed requests not saved: %s', err)
+
+    if spool is not None:
+        spool_drainer.stop()
+        #sealed, the segment is replayed by the other workers
+        spool.close()
+    if shipper is not None:
+        shipper.close()
+    if sample_extractor is not None:
+        sample_extractor.stop(settings['gunicorn']['graceful_timeout'])
+
+#parsed at import, shared copy-on-write by the workers of a preloaded app
+for template in ['containers.yml', 'images.yml', 'image_inspect.yml']:
+    load_template(os.path.join(MODELS_TEMPLATES_DIR, template))
+get_base_filesystem(SHELL_FILESYSTEM)
+
+if os.environ.get('DOCKERTRAP_POST_FORK') != '1':
+    init_worker()
 
 if __name__ == "__main__":
     app.run(host='0.0.0.0', port='2375')
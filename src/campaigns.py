@@ -0,0 +1,143 @@
+import re
+import random
+import hashlib
+import datetime
+
+from pymongo import UpdateOne
+
+#Incremental clustering of attacker commands into campaigns.
+#Commands are normalized (URLs, IPs, hashes and numbers masked), cut into token shingles and
+#summarized by a MinHash signature. Signatures are split into LSH bands, so a new command is
+#only compared with the campaigns sharing at least one band instead of all of them.
+
+CAMPAIGN_COLLECTION = 'campaigns'
+
+NUM_PERM = 64
+BANDS = 16
+ROWS = NUM_PERM // BANDS
+SHINGLE_SIZE = 3
+MERSENNE_PRIME = (1 << 61) - 1
+
+MASKS = [
+    (re.compile(r'[a-z][a-z0-9+.-]*://\S+', re.I), '<url>'),
+    (re.compile(r'\b[\w-]+(?:\.[\w-]+)+(?::\d+)?/\S*'), '<url>'),
+    (re.compile(r'\b(?:\d{1,3}\.){3}\d{1,3}(?::\d+)?\b'), '<ip>'),
+    (re.compile(r'\b[0-9a-f]{16,}\b', re.I), '<hash>'),
+    (re.compile(r'[A-Za-z0-9+/]{40,}={0,2}'), '<b64>'),
+    (re.compile(r'\b\d+\b'), '<num>'),
+]
+
+TOKENS = re.compile(r'<\w+>|[^\s;|&<>()\'"`]+|[;|&<>()]')
+
+_random = random.Random(0x5eed)
+PERMUTATIONS = [(_random.randrange(1, MERSENNE_PRIME), _random.randrange(0, MERSENNE_PRIME)) for _ in range(NUM_PERM)]
+
+def normalize_command(cmd):
+    for regex, mask in MASKS:
+        cmd = regex.sub(mask, cmd)
+    return ' '.join(cmd.split())
+
+def shingles(normalized):
+    tokens = TOKENS.findall(normalized)
+    if len(tokens) <= SHINGLE_SIZE:
+        return {' '.join(tokens)}
+    return {' '.join(tokens[i:i + SHINGLE_SIZE]) for i in range(len(tokens) - SHINGLE_SIZE + 1)}
+
+def minhash(shingle_set):
+    hashes = [int.from_bytes(hashlib.blake2b(s.encode('utf-8'), digest_size=8).digest(), 'little') for s in shingle_set]
+    return [min((a * h + b) % MERSENNE_PRIME for h in hashes) for a, b in PERMUTATIONS]
+
+def similarity(signature1, signature2):
+    return sum(1 for x, y in zip(signature1, signature2) if x == y) / NUM_PERM
+
+def band_keys(signature):
+    return [(band, hash(tuple(signature[band * ROWS:(band + 1) * ROWS]))) for band in range(BANDS)]
+
+def get_command(action_info):
+    #the attacker controlled text of an action, None for actions without commands
+    parts = [action_info.get(name) for name in ['entrypoint', 'cmd', 'dockerfile']]
+    parts = [part for part in parts if part]
+    return ' '.join(parts) if parts else None
+
+class CampaignEngine:
+
+    def __init__(self, collection, logs=None, threshold=0.6):
+        self.collection = collection
+        self.logs = logs
+        self.threshold = threshold
+        self._signatures = {}
+        self._buckets = {}
+        self._updates = {}
+        self._labels = []
+
+    def load(self):
+        for campaign in self.collection.find({}, {'Signature': 1}):
+            self._index(campaign['_id'], campaign['Signature'])
+        return self
+
+    def _index(self, campaign_id, signature):
+        self._signatures[campaign_id] = signature
+        for key in band_keys(signature):
+            self._buckets.setdefault(key, set()).add(campaign_id)
+
+    def match(self, signature):
+        candidates = set()
+        for key in band_keys(signature):
+            candidates |= self._buckets.get(key, set())
+
+        best, best_score = None, 0
+        for campaign_id in candidates:
+            score = similarity(signature, self._signatures[campaign_id])
+            if score > best_score:
+                best, best_score = campaign_id, score
+
+        return best if best_score >= self.threshold else None
+
+    def assign(self, cmd, date=None, log_id=None, persist=True):
+        #returns the campaign id of cmd, a new campaign is created when nothing is similar enough
+        #log_id is the http_request_log document labeled with the campaign on flush
+        normalized = normalize_command(cmd)
+        signature = minhash(shingles(normalized))
+
+        campaign_id = self.match(signature)
+        created = campaign_id is None
+        if created:
+            campaign_id = 'C' + hashlib.sha1(normalized.encode('utf-8')).hexdigest()[:12]
+            self._index(campaign_id, signature)
+
+        if persist:
+            date = date or datetime.datetime.utcnow()
+            update = self._updates.setdefault(campaign_id, {'Hits': 0, 'FirstSeen': date, 'LastSeen': date})
+            update['Hits'] += 1
+            update['FirstSeen'] = min(update['FirstSeen'], date)
+            update['LastSeen'] = max(update['LastSeen'], date)
+            if created:
+                update['Signature'] = signature
+                update['Example'] = normalized[:1000]
+            if log_id is not None and self.logs is not None:
+                self._labels.append(UpdateOne({'_id': log_id}, {'$set': {'CampaignId': campaign_id}}))
+
+        return campaign_id
+
+    def flush(self):
+        if self._labels:
+            self.logs.bulk_write(self._labels, ordered=False)
+            self._labels = []
+
+        if not self._updates:
+            return 0
+
+        requests = []
+        for campaign_id, update in self._updates.items():
+            operations = {
+                '$inc': {'Hits': update['Hits']},
+                '$min': {'FirstSeen': update['FirstSeen']},
+                '$max': {'LastSeen': update['LastSeen']}
+            }
+            if 'Signature' in update:
+                operations['$setOnInsert'] = {'Signature': update['Signature'], 'Example': update['Example']}
+            requests.append(UpdateOne({'_id': campaign_id}, operations, upsert=True))
+        self._updates = {}
+
+        self.collection.bulk_write(requests, ordered=False)
+        return len(requests)
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import hmac
+import datetime
+import threading
+
+from flask import Flask, request, jsonify
+from pymongo import MongoClient, UpdateOne
+from pymongo.errors import PyMongoError, DuplicateKeyError
+
+from utils import get_settings
+from spool import insert_request_logs
+from compaction import Compactor, CompactionGroup
+from interning import HeaderInterner
+from shipping import BATCH_PATH, BATCH_COLLECTION, SENSOR_HEADER, BATCH_HEADER, decode_batch
+
+#Collector of the request logs shipped by the sensors (see shipping.py), the only process holding the Mongo credentials.
+#gunicorn -b 0.0.0.0:2380 collector:app
+#Every batch is written with one insert_many (and one bulk_write for the compacted repeats), header interning and
+#compaction are applied here with the interning and compaction settings of the collector.
+#Stored batches are recorded in collector_batch, a batch sent again after a lost acknowledgement is only acknowledged.
+#Its TTL index is created by manage.py ensure_indexes, like the indexes of the logs.
+
+settings = get_settings()
+
+if not settings['collector']['token']:
+    #bound to every interface, anyone could write to the log database without it
+    raise SystemExit('collector.token is required')
+
+app = Flask(__name__)
+
+client = MongoClient(settings['mongodb']['uri'], connect=False)
+db = client['DockerHoneypot']
+
+class LogWriter:
+
+    def __init__(self, db, compactor=None, interner=None):
+        self.logs = db['http_request_log']
+        self.compactor = compactor
+        self.interner = interner
+
+    def compact(self, document, updates, opened, repeated):
+        #the document to insert, None when it is counted in an open group
+        #the groups opened by the batch are kept in opened until it is written, see write
+        fingerprint = self.compactor.fingerprint(document)
+        group = opened.get(fingerprint)
+        if group is not None and (document['Date'] - group.started).total_seconds() <= self.compactor.window:
+            group.count += 1
+        else:
+            group = self.compactor.repeat(fingerprint, document['Date'])
+            if group and group.doc_id == document['_id']:
+                #the head of a group, stored by a batch sent again
+                group.count -= 1
+                return None
+            if group:
+                repeated.append(group)
+        if group:
+            update = {
+                '$inc': {'Count': 1},
+                '$max': {'Last': document['Date']}
+            }
+            if self.compactor.is_sampled(group.count):
+                update['$push'] = {'SampledDates': document['Date']}
+            updates.append(UpdateOne({'_id': group.doc_id}, update))
+            return None
+
+        document.update(Fingerprint=fingerprint, Count=1, First=document['Date'], Last=document['Date'], SampledDates=[document['Date']])
+        opened[fingerprint] = CompactionGroup(document['_id'], document['Date'])
+        return document
+
+    def write(self, documents):
+        inserts = []
+        updates = []
+        opened = {}
+        repeated = []
+        try:
+            for document in documents:
+                document.setdefault('Args', {})
+                document.setdefault('Headers', {})
+                if self.compactor is not None and self.compactor.applies_to(document['Path']):
+                    document = self.compact(document, updates, opened, repeated)
+                    if document is None:
+                        continue
+                if self.interner is not None:
+                    document = self.interner.intern(document)
+                inserts.append(document)
+
+            #the repeats of a group opened in this batch are applied after its insert
+            if inserts:
+                insert_request_logs(self.logs, inserts)
+            if updates:
+                self.logs.bulk_write(updates, ordered=False)
+        except Exception:
+            #the sensor sends the batch again, its repeats are counted then
+            for group in repeated:
+                group.count -= 1
+            raise
+
+        #only the groups whose head is stored take repeats
+        for fingerprint, group in opened.items():
+            self.compactor.register(fingerprint, group.doc_id, group.started, group.count)
+        return len(inserts) + len(updates)
+
+log_writer = None
+writer_lock = threading.Lock()
+
+def get_log_writer():
+    global log_writer
+
+    #created on first use, the collections are not touched at import time
+    with writer_lock:
+        if log_writer is None:
+            compactor = None
+            if settings['compaction']['enabled']:
+                compactor = Compactor(
+                    settings['compaction']['window'], settings['compaction']['paths'],
+                    settings['compaction']['exclude'], settings['compaction']['max_groups']
+                )
+            interner = None
+            if settings['interning']['enabled']:
+                user_agents = db['user_agent_string'] if settings['interning']['user_agent'] else None
+                interner = HeaderInterner(db['header_set'], user_agents, settings['interning']['cache_size'])
+
+            log_writer = LogWriter(db, compactor, interner)
+    return log_writer
+
+def authorized():
+    token = settings['collector']['token']
+    if not token:
+        return False
+    return hmac.compare_digest(request.headers.get('Authorization', ''), 'Bearer {}'.format(token))
+
+@app.route(BATCH_PATH, methods=['POST'])
+def receive_batch():
+    if not authorized():
+        return jsonify({'message': 'unauthorized'}), 401
+
+    sensor_id = request.headers.get(SENSOR_HEADER)
+    batch = request.headers.get(BATCH_HEADER)
+    if not sensor_id or not batch:
+        return jsonify({'message': '{} and {} are required'.format(SENSOR_HEADER, BATCH_HEADER)}), 400
+
+    try:
+        documents = decode_batch(request.get_data(), settings['collector']['max_batch_bytes'])
+    except (OSError, ValueError, EOFError) as err:
+        return jsonify({'message': 'invalid batch: {}'.format(err)}), 400
+
+    key = '{}:{}'.format(sensor_id, batch)
+    try:
+        writer = get_log_writer()
+        if db[BATCH_COLLECTION].find_one({'_id': key}, {'_id': 1}):
+            return jsonify({'Batch': batch, 'Stored': 0})
+
+        stored = writer.write(documents)
+        try:
+            db[BATCH_COLLECTION].insert_one({'_id': key, 'Date': datetime.datetime.utcnow(), 'Documents': len(documents)})
+        except DuplicateKeyError:
+            #stored meanwhile by another worker, the inserts were deduplicated on _id
+            pass
+    except PyMongoError as err:
+        #the sensor keeps the batch and sends it again
+        app.logger.warning('Batch %s of %s not stored: %s', batch, sensor_id, err)
+        return jsonify({'message': 'storage unavailable'}), 503
+
+    return jsonify({'Batch': batch, 'Stored': stored})
+
+@app.route('/_ping')
+def ping():
+    return 'OK'
+
+if __name__ == "__main__":
+    app.run(host='0.0.0.0', port=2380)
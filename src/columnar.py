@@ -0,0 +1,196 @@
+import os
+import json
+import glob
+import datetime
+
+from bson import ObjectId
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+from analyzer import get_action_info
+from interning import HeaderResolver
+
+#Parquet export of http_request_log for notebooks.
+#Files are partitioned as <dir>/date=YYYY-MM-DD/sensor=<SensorId>/part-<first _id>.parquet
+#and the position is kept in <dir>/_export_state.json, so a new run only appends what came in since.
+#The logs written when the request was served are read in _id order, the logs written later in batches (spool
+#replay, collector, import) in the order of Stored, their insert time on the server, since their _id is older.
+#Both are read up to the server time - lag, which leaves time for compacted documents to be closed.
+
+STATE_FILE = '_export_state.json'
+
+#low cardinality columns, written dictionary encoded
+DICTIONARY_COLUMNS = ['SensorId', 'SensorType', 'Method', 'Path', 'Host', 'SourceIP', 'Action', 'ActionType', 'Image', 'CampaignId']
+
+def get_schema():
+    string = pyarrow.string()
+    return pyarrow.schema([
+        ('Id', string),
+        ('Date', pyarrow.timestamp('ms')),
+        ('SensorId', string),
+        ('SensorType', string),
+        ('Method', string),
+        ('Path', string),
+        ('Host', string),
+        ('Url', string),
+        ('SourceIP', string),
+        ('Args', string),
+        ('Headers', string),
+        ('DataJson', string),
+        ('DataSize', pyarrow.int64()),
+        ('Count', pyarrow.int32()),
+        ('CampaignId', string),
+        ('Action', string),
+        ('ActionType', string),
+        ('Cmd', string),
+        ('Entrypoint', string),
+        ('Image', string),
+        ('Env', pyarrow.list_(string)),
+        ('Urls', pyarrow.list_(string)),
+        ('FilePath', string),
+        ('DirPath', string),
+    ])
+
+def to_json(value):
+    return json.dumps(value, default=str) if value else None
+
+def to_row(request):
+    request.setdefault('Args', {})
+    request.setdefault('DataJson', None)
+    try:
+        action_info = get_action_info(request, parse_payload=False)
+    except Exception:
+        action_info = {'action': 'Unhandled', 'type': 'Unhandled'}
+
+    #get_action_info does not fill env, the create payload has it
+    env = action_info.get('env') or (request['DataJson'] or {}).get('Env')
+    return {
+        'Id': str(request['_id']),
+        'Date': request['Date'],
+        'SensorId': request.get('SensorId'),
+        'SensorType': request.get('SensorType'),
+        'Method': request.get('Method'),
+        'Path': request.get('Path'),
+        'Host': request.get('Host'),
+        'Url': request.get('Url'),
+        'SourceIP': request.get('SourceIP'),
+        'Args': to_json(request.get('Args')),
+        'Headers': to_json(request.get('Headers')),
+        'DataJson': to_json(request.get('DataJson')),
+        'DataSize': len(request['Data']) if request.get('Data') else 0,
+        'Count': request.get('Count') or 1,
+        'CampaignId': request.get('CampaignId'),
+        'Action': action_info.get('action'),
+        'ActionType': action_info.get('type'),
+        'Cmd': action_info.get('cmd'),
+        'Entrypoint': action_info.get('entrypoint'),
+        'Image': action_info.get('image'),
+        'Env': env if isinstance(env, list) else None,
+        'Urls': action_info.get('urls') or None,
+        'FilePath': action_info.get('filepath'),
+        'DirPath': action_info.get('dirpath'),
+    }
+
+class ParquetExporter:
+
+    def __init__(self, db, output_dir, chunk_size=50000, batch_size=5000, lag_seconds=600):
+        if pyarrow is None:
+            raise RuntimeError('pyarrow is not installed, run: pip install pyarrow')
+
+        self.db = db
+        self.output_dir = output_dir
+        self.chunk_size = chunk_size
+        self.batch_size = batch_size
+        self.lag_seconds = lag_seconds
+        self.schema = get_schema()
+        os.makedirs(output_dir, exist_ok=True)
+
+    def _load_state(self):
+        try:
+            with open(os.path.join(self.output_dir, STATE_FILE)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def _save_state(self, state):
+        path = os.path.join(self.output_dir, STATE_FILE)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(state, f)
+        os.replace(path + '.tmp', path)
+
+    def _write_chunk(self, rows):
+        #one file per partition of the chunk, renamed into place once complete
+        partitions = {}
+        for row in rows:
+            partitions.setdefault((row['Date'].strftime('%Y-%m-%d'), row['SensorId']), []).append(row)
+
+        for (date, sensor_id), partition_rows in partitions.items():
+            directory = os.path.join(self.output_dir, 'date={}'.format(date), 'sensor={}'.format(sensor_id))
+            os.makedirs(directory, exist_ok=True)
+            path = os.path.join(directory, 'part-{}.parquet'.format(partition_rows[0]['Id']))
+
+            table = pyarrow.Table.from_pylist(partition_rows, schema=self.schema)
+            pyarrow.parquet.write_table(table, path + '.tmp', use_dictionary=DICTIONARY_COLUMNS, compression='zstd')
+            os.replace(path + '.tmp', path)
+
+    def _export(self, cursor, state, advance):
+        #writes the documents of cursor in chunks, advance(state, request) moves the position past request
+        exported = 0
+        rows = []
+        last = None
+        for request in HeaderResolver(self.db).iter_rehydrated(cursor, self.batch_size):
+            rows.append(to_row(request))
+            last = request
+            if len(rows) >= self.chunk_size:
+                self._write_chunk(rows)
+                advance(state, last)
+                self._save_state(state)
+                exported += len(rows)
+                rows = []
+
+        if rows:
+            self._write_chunk(rows)
+            advance(state, last)
+            self._save_state(state)
+            exported += len(rows)
+
+        return exported
+
+    def export(self):
+        #returns the number of exported documents
+        for path in glob.glob(os.path.join(self.output_dir, '**', '*.tmp'), recursive=True):
+            os.remove(path)
+
+        state = self._load_state()
+        #Stored is set by the server, so is the cutoff
+        cutoff = self.db.command('isMaster')['localTime'] - datetime.timedelta(seconds=self.lag_seconds)
+        logs = self.db.http_request_log
+
+        query = {'Stored': None, '_id': {'$lt': ObjectId.from_datetime(cutoff)}}
+        if state.get('last_id'):
+            query['_id']['$gt'] = ObjectId(state['last_id'])
+
+        def advance_id(state, request):
+            state['last_id'] = str(request['_id'])
+
+        cursor = logs.find(query, batch_size=self.batch_size).sort('_id', 1)
+        exported = self._export(cursor, state, advance_id)
+
+        query = {'Stored': {'$lt': cutoff}}
+        if state.get('stored'):
+            stored = datetime.datetime.fromisoformat(state['stored'])
+            query = {'$or': [
+                {'Stored': {'$gt': stored, '$lt': cutoff}},
+                {'Stored': stored, '_id': {'$gt': ObjectId(state['stored_id'])}}
+            ]}
+
+        def advance_stored(state, request):
+            state['stored'] = request['Stored'].isoformat()
+            state['stored_id'] = str(request['_id'])
+
+        cursor = logs.find(query, batch_size=self.batch_size).sort([('Stored', 1), ('_id', 1)])
+        return exported + self._export(cursor, state, advance_stored)
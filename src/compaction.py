@@ -0,0 +1,81 @@
+import hashlib
+import json
+import re
+import threading
+from collections import OrderedDict
+
+from utils import hash_headers
+
+API_VERSION_PREFIX = re.compile(r'^/v[\d.]+(?=/)')
+
+def strip_api_version(path):
+    return API_VERSION_PREFIX.sub('', path)
+
+class CompactionGroup:
+    __slots__ = ('doc_id', 'started', 'count')
+
+    def __init__(self, doc_id, started, count=1):
+        self.doc_id = doc_id
+        self.started = started
+        self.count = count
+
+class Compactor:
+    #collapses identical requests of one source IP within a time window into a single HttpRequestLog document
+    #the groups are kept per worker, so several workers can each open a group for the same fingerprint
+
+    def __init__(self, window, paths, exclude, max_groups):
+        self.window = window
+        self.paths = tuple(paths)
+        self.exclude = tuple(exclude)
+        self.max_groups = max_groups
+        self._groups = OrderedDict()
+        self._lock = threading.Lock()
+
+    def applies_to(self, path):
+        path = strip_api_version(path)
+        if path.endswith(self.exclude):
+            return False
+        return path.endswith(self.paths)
+
+    def fingerprint(self, log_params):
+        data = log_params.get('Data') or b''
+        key = [
+            log_params['SourceIP'],
+            log_params['Method'],
+            log_params['Path'],
+            sorted(log_params['Args'].items()),
+            hashlib.sha1(data).hexdigest(),
+            hash_headers(log_params['Headers'])
+        ]
+        return hashlib.sha1(json.dumps(key).encode('utf-8')).hexdigest()
+
+    def repeat(self, fingerprint, date):
+        #returns the group of an identical request seen within the window or None
+        with self._lock:
+            group = self._groups.get(fingerprint)
+            if group is None:
+                return None
+
+            if (date - group.started).total_seconds() > self.window:
+                del self._groups[fingerprint]
+                return None
+
+            self._groups.move_to_end(fingerprint)
+            group.count += 1
+            return group
+
+    def register(self, fingerprint, doc_id, date, count=1):
+        with self._lock:
+            self._groups[fingerprint] = CompactionGroup(doc_id, date, count)
+            self._groups.move_to_end(fingerprint)
+            while len(self._groups) > self.max_groups:
+                self._groups.popitem(last=False)
+
+    def forget(self, fingerprint):
+        with self._lock:
+            self._groups.pop(fingerprint, None)
+
+    @staticmethod
+    def is_sampled(count):
+        #keep the dates of the 1st, 2nd, 4th, 8th... repeat, so samples stay logarithmic in the count
+        return count & (count - 1) == 0
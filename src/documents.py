@@ -0,0 +1,63 @@
+import json
+import time
+import threading
+from collections import OrderedDict
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+#Inspect responses straight from raw documents.
+#The documents are read with as_pymongo, skipping the MongoEngine wrappers, and encoded once to the
+#response bytes, with orjson when it is installed. The bytes are cached by lookup key (an id prefix or a name)
+#and dropped by object id when the object changes; the changes made by the other workers are seen after cache_ttl.
+
+#the fields of the sensor, CreatedBy is the address of the attacker
+HIDDEN_FIELDS = ['id', 'SensorId', 'CreatedAt', 'CreatedBy', 'ExitsAt']
+
+def raw_document(queryset):
+    #the first document of a queryset as a dict, without the fields docker does not have
+    hidden = [name for name in HIDDEN_FIELDS if name in queryset._document._fields]
+    return queryset.exclude(*hidden).as_pymongo().first()
+
+def encode(document):
+    if orjson is not None:
+        return orjson.dumps(document, default=str, option=orjson.OPT_APPEND_NEWLINE)
+    return (json.dumps(document, default=str) + '\n').encode('utf-8')
+
+class DocumentCache:
+
+    def __init__(self, cache_size=1024, cache_ttl=5):
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        #lookup key: (expires, object id, payload)
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= time.time():
+                del self._cache[key]
+                return None
+            self._cache.move_to_end(key)
+            return entry[2]
+
+    def put(self, key, object_id, payload):
+        if not self.cache_size:
+            return payload
+        with self._lock:
+            self._cache[key] = (time.time() + self.cache_ttl, object_id, payload)
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return payload
+
+    def invalidate(self, object_id):
+        #every lookup key resolving to the object
+        with self._lock:
+            for key in [key for key, entry in self._cache.items() if entry[1] == object_id]:
+                del self._cache[key]
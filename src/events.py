@@ -0,0 +1,275 @@
+import os
+import json
+import time
+import uuid
+import logging
+import datetime
+import threading
+from collections import deque
+
+from pymongo import ASCENDING
+from pymongo.errors import PyMongoError
+
+from retention import ensure_ttl_index
+
+#Docker events of the fake containers, served by /events.
+#Handlers publish to the bus of the sensor, every event is encoded once and appended to a bounded history.
+#Subscribers do not get a queue of their own: they keep a cursor in the shared history and are woken
+#by a condition when it grows, so an event costs a filter check and a write per client.
+#With Mongo backing events are also stored in docker_event, which replays older history and
+#brings the events of the other gunicorn workers through one poller thread per process.
+
+EVENT_COLLECTION = 'docker_event'
+
+#the poller reads again this far before the newest event it has seen, an event is stored a little after its
+#timeNano and the workers do not store in timeNano order
+POLL_OVERLAP = 5*10**9
+
+logger = logging.getLogger(__name__)
+
+class FilterError(ValueError):
+    pass
+
+def parse_filters(value):
+    #{"container": {"abc": true}} or the older {"container": ["abc"]} -> {'container': ['abc']}
+    if not value:
+        return {}
+    try:
+        filters = json.loads(value)
+    except ValueError:
+        raise FilterError('invalid filter: {}'.format(value))
+    if not isinstance(filters, dict):
+        raise FilterError('invalid filter: {}'.format(value))
+
+    parsed = {}
+    for key, values in filters.items():
+        if isinstance(values, dict):
+            parsed[key] = [name for name, enabled in values.items() if enabled]
+        elif isinstance(values, list):
+            parsed[key] = [str(name) for name in values]
+        else:
+            raise FilterError('invalid filter: {}'.format(value))
+    return parsed
+
+def parse_timestamp(value):
+    #'1700000000', '1700000000.123456789' or an RFC 3339 date -> nanoseconds
+    if not value:
+        return None
+    seconds, _, fraction = value.partition('.')
+    if seconds.isdigit() and (not fraction or fraction.isdigit()):
+        return int(seconds) * 10**9 + int(fraction.ljust(9, '0')[:9] or 0)
+
+    from dateutil import parser
+    try:
+        date = parser.isoparse(value)
+    except ValueError:
+        raise FilterError('invalid timestamp: {}'.format(value))
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=datetime.timezone.utc)
+    return int(date.timestamp() * 10**9)
+
+def matches(event, filters):
+    #every filter key has to match one of its values, as docker does
+    actor = event['Actor']
+    attributes = actor.get('Attributes') or {}
+    for key, values in filters.items():
+        if not values:
+            continue
+        ids = []
+        if key == 'type':
+            names = [event['Type']]
+        elif key == 'event':
+            #exec events are named 'exec_start: <command>'
+            names = [event['Action'], event['Action'].split(':')[0]]
+        elif key == 'image':
+            names = [attributes.get('image'), event.get('from')]
+        elif key == 'container':
+            if event['Type'] == 'container':
+                ids, names = [actor['ID']], [attributes.get('name'), '/{}'.format(attributes.get('name'))]
+            else:
+                ids, names = [attributes.get('container')], []
+        elif key in ['network', 'volume', 'daemon']:
+            if event['Type'] != key:
+                return False
+            ids, names = [actor['ID']], [attributes.get('name')]
+        elif key == 'label':
+            names = ['{}={}'.format(name, value) for name, value in attributes.items()] + list(attributes)
+        elif key == 'scope':
+            names = [event.get('scope')]
+        else:
+            return False
+
+        #ids also match by prefix
+        if not any(value in names or any(id and id.startswith(value) for id in ids) for value in values):
+            return False
+    return True
+
+class Event:
+    __slots__ = ('seq', 'time_nano', 'data', 'payload')
+
+    def __init__(self, seq, data):
+        self.seq = seq
+        self.time_nano = data['timeNano']
+        self.data = data
+        self.payload = (json.dumps(data) + '\n').encode('utf-8')
+
+class EventBus:
+
+    def __init__(self, sensor_id, history=1000, collection=None, poll_interval=1.0):
+        self.sensor_id = sensor_id
+        self.collection = collection
+        self.poll_interval = poll_interval
+        #events of this process are skipped by its poller
+        self.origin = '{}-{}'.format(os.getpid(), uuid.uuid4().hex[:8])
+
+        self._events = deque(maxlen=history)
+        self._seq = 0
+        self._condition = threading.Condition()
+        self._poller = None
+        self._poller_lock = threading.Lock()
+        self._last_polled = None
+        #_id: TimeNano of the events polled within the overlap
+        self._polled = {}
+
+    def publish(self, event_type, action, actor_id, attributes=None, now=None):
+        now = now or time.time()
+        data = {}
+        if event_type == 'container':
+            #pre 1.22 fields, still sent by docker for container events
+            data['status'] = action
+            data['id'] = actor_id
+            data['from'] = (attributes or {}).get('image', '')
+        data.update({
+            'Type': event_type,
+            'Action': action,
+            'Actor': {'ID': actor_id, 'Attributes': attributes or {}},
+            'scope': 'local',
+            'time': int(now),
+            'timeNano': int(now * 10**9)
+        })
+        self._append(data)
+
+        if self.collection is not None:
+            try:
+                self.collection.insert_one({
+                    'SensorId': self.sensor_id,
+                    'Date': datetime.datetime.utcfromtimestamp(now),
+                    'TimeNano': data['timeNano'],
+                    'Origin': self.origin,
+                    'Event': data
+                })
+            except PyMongoError as err:
+                logger.warning('Event not stored: %s', err)
+        return data
+
+    def _append(self, data):
+        with self._condition:
+            self._seq += 1
+            self._events.append(Event(self._seq, data))
+            self._condition.notify_all()
+
+    def _after(self, cursor):
+        #events newer than the cursor, called with the condition held
+        if not self._events or self._events[-1].seq <= cursor:
+            return []
+        start = max(cursor + 1 - self._events[0].seq, 0)
+        return [self._events[i] for i in range(start, len(self._events))]
+
+    def _stored(self, since, until):
+        #history of all the processes of the sensor, from mongo
+        query = {'SensorId': self.sensor_id, 'TimeNano': {'$gte': since, '$lte': until}}
+        try:
+            for document in self.collection.find(query, {'Event': 1}).sort('TimeNano', ASCENDING):
+                yield Event(0, document['Event'])
+        except PyMongoError as err:
+            logger.warning('Event history not read: %s', err)
+
+    def _poll_once(self):
+        #the events of the overlap were appended by a previous poll, they are skipped by _id
+        query = {'SensorId': self.sensor_id, 'Origin': {'$ne': self.origin}, 'TimeNano': {'$gte': self._last_polled - POLL_OVERLAP}}
+        events = []
+        for document in self.collection.find(query, {'Event': 1, 'TimeNano': 1}).sort('TimeNano', ASCENDING):
+            if document['_id'] not in self._polled:
+                self._polled[document['_id']] = document['TimeNano']
+                events.append(document['Event'])
+            self._last_polled = max(self._last_polled, document['TimeNano'])
+
+        horizon = self._last_polled - POLL_OVERLAP
+        self._polled = {_id: time_nano for _id, time_nano in self._polled.items() if time_nano >= horizon}
+        return events
+
+    def _poll(self):
+        #events stored by the other processes of the sensor
+        while True:
+            try:
+                for data in self._poll_once():
+                    self._append(data)
+            except PyMongoError as err:
+                logger.warning('Events not polled: %s', err)
+            time.sleep(self.poll_interval)
+
+    def _start_poller(self):
+        with self._poller_lock:
+            if self.collection is None or self._poller is not None:
+                return
+            #only what is stored from now on, older events are read by _stored
+            self._last_polled = time.time_ns()
+            self._poll_once()
+            self._poller = threading.Thread(target=self._poll, name='event-poller', daemon=True)
+            self._poller.start()
+
+    def subscribe(self, since=None, until=None, filters=None, timeout=None, live=True):
+        #yields the encoded events from since (nanoseconds, None for new events only) until until,
+        #for at most timeout seconds
+        filters = filters or {}
+        deadline = time.time() + timeout if timeout else None
+        try:
+            self._start_poller()
+        except PyMongoError as err:
+            logger.warning('Event poller not started: %s', err)
+
+        with self._condition:
+            cursor = self._seq
+            snapshot = time.time_ns()
+            if since is None:
+                replay = []
+            elif self.collection is not None:
+                replay = None
+            else:
+                replay = [event for event in self._events if event.time_nano >= since]
+
+        if replay is None:
+            #mongo has the events of every worker up to now, later ones come live
+            replay = self._stored(since, snapshot if until is None else min(until, snapshot))
+
+        for event in replay:
+            if until is not None and event.time_nano > until:
+                return
+            if matches(event.data, filters):
+                yield event.payload
+
+        while live:
+            now = time.time()
+            ends = [end for end in [deadline, until / 10**9 if until is not None else None] if end is not None]
+            if ends and now >= min(ends):
+                return
+
+            with self._condition:
+                events = self._after(cursor)
+                if not events:
+                    self._condition.wait(min(ends) - now if ends else None)
+                    events = self._after(cursor)
+                if events:
+                    cursor = events[-1].seq
+
+            for event in events:
+                if until is not None and event.time_nano > until:
+                    return
+                if since is not None and self.collection is not None and event.time_nano <= snapshot:
+                    continue
+                if matches(event.data, filters):
+                    yield event.payload
+
+def ensure_event_indexes(collection, ttl):
+    collection.create_index([('SensorId', ASCENDING), ('TimeNano', ASCENDING)])
+    ensure_ttl_index(collection, 'Date', max(int(ttl), 1))
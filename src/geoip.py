@@ -0,0 +1,78 @@
+import os
+import functools
+import ipaddress
+
+try:
+    import maxminddb
+except ImportError:
+    maxminddb = None
+
+#Offline GeoIP/ASN enrichment from MaxMind-format .mmdb files (GeoLite2-City, GeoLite2-ASN or compatible).
+#The databases are memory-mapped, so all the processes share the page cache,
+#and lookups are memoized per IP since the same scanners come back over and over.
+
+class GeoIP:
+
+    def __init__(self, city_db=None, asn_db=None, cache_size=100000):
+        self.city = self._open(city_db)
+        self.asn = self._open(asn_db)
+        self.lookup = functools.lru_cache(maxsize=cache_size)(self._lookup)
+
+    @staticmethod
+    def _open(path):
+        if not path or not os.path.isfile(path) or maxminddb is None:
+            return None
+        return maxminddb.open_database(path, maxminddb.MODE_MMAP)
+
+    @property
+    def enabled(self):
+        return bool(self.city or self.asn)
+
+    def _lookup(self, ip):
+        #returns None for private or unknown addresses
+        try:
+            if not ipaddress.ip_address(ip).is_global:
+                return None
+        except ValueError:
+            return None
+
+        info = {}
+        if self.city:
+            record = self.city.get(ip) or {}
+            info['country'] = record.get('country', {}).get('iso_code')
+            info['city'] = record.get('city', {}).get('names', {}).get('en')
+            location = record.get('location') or {}
+            if 'latitude' in location:
+                info['location'] = [location['latitude'], location['longitude']]
+
+        if self.asn:
+            record = self.asn.get(ip) or {}
+            info['asn'] = record.get('autonomous_system_number')
+            info['as_org'] = record.get('autonomous_system_organization')
+
+        info = {key: value for key, value in info.items() if value}
+        return info or None
+
+    def enrich_many(self, ips):
+        #one lookup per distinct IP of a batch
+        if not self.enabled:
+            return {}
+        return {ip: self.lookup(ip) for ip in set(ips) if ip}
+
+    def close(self):
+        for reader in [self.city, self.asn]:
+            if reader:
+                reader.close()
+
+def format_geo(info):
+    if not info:
+        return ''
+
+    parts = [info.get('country'), info.get('city')]
+    if info.get('asn'):
+        parts.append('AS{} {}'.format(info['asn'], info.get('as_org') or '').strip())
+    return ', '.join(part for part in parts if part)
+
+def get_geoip(settings):
+    geoip_settings = settings['geoip']
+    return GeoIP(geoip_settings['city_db'], geoip_settings['asn_db'], geoip_settings['cache_size'])
@@ -0,0 +1,70 @@
+#gunicorn -c /app/src/gunicorn.conf.py app:app
+#DOCKERTRAP_LISTENER=tls gunicorn -c /app/src/gunicorn.conf.py app:app for the TLS listener, a master of its own
+#since the TLS options of gunicorn apply to all its listeners.
+#Settings come from the gunicorn section of the settings (or the gunicorn_<key> environment variables).
+#With preload the app, its settings and parsed templates are loaded once in the master and shared
+#copy-on-write by the workers; Mongo connections and background threads are only opened in the workers.
+
+import os
+import gc
+import sys
+import multiprocessing
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, SRC_DIR)
+
+from utils import get_settings
+
+options = get_settings()['gunicorn']
+tls_options = get_settings()['tls']
+
+def cpu_count():
+    #the CPUs the container may use, not the ones of the host
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return multiprocessing.cpu_count()
+
+chdir = SRC_DIR
+bind = options['bind']
+threads = options['threads']
+#threads already overlap the Mongo round trips, sync workers need more processes for that
+worker_class = 'gthread' if threads > 1 else 'sync'
+workers = options['workers'] or min(cpu_count() + 1 if threads > 1 else cpu_count() * 2 + 1, options['max_workers'])
+preload_app = options['preload']
+max_requests = options['max_requests']
+max_requests_jitter = options['max_requests_jitter']
+timeout = options['timeout']
+graceful_timeout = options['graceful_timeout']
+keepalive = options['keepalive']
+
+if os.environ.get('DOCKERTRAP_LISTENER') == 'tls':
+    from tls import create_context
+
+    bind = tls_options['bind']
+    certfile = tls_options['certfile']
+    keyfile = tls_options['keyfile']
+    tls_context = create_context(
+        certfile, keyfile, tls_options['fingerprint'], tls_options['cache_size'], tls_options['handshake_timeout']
+    )
+
+    def ssl_context(config, default_ssl_context_factory):
+        #the context of the master for every connection
+        return tls_context
+
+if preload_app:
+    #app.init_worker is left to post_fork
+    os.environ['DOCKERTRAP_POST_FORK'] = '1'
+
+def pre_fork(server, worker):
+    #the objects of the master are left out of the collections of the workers, so their pages stay shared
+    gc.freeze()
+
+def post_fork(server, worker):
+    if preload_app:
+        import app
+        app.init_worker()
+
+def worker_exit(server, worker):
+    import app
+    app.shutdown_worker()
@@ -0,0 +1,148 @@
+import re
+import json
+import time
+import hashlib
+import datetime
+import threading
+from collections import OrderedDict
+
+#Image lookups by the references docker accepts: an id or id prefix, sha256:<id>, name[:tag] and name@<digest>.
+#Names are normalized as docker does (docker.io/library/alpine -> alpine:latest) and matched against
+#RepoTags/RepoDigests through the (SensorId, RepoTags) and (SensorId, RepoDigests) indexes.
+#Resolved images and their inspect documents are cached per worker for cache_ttl seconds,
+#the images pulled by the other workers show up once the entries expire.
+
+DEFAULT_REGISTRIES = ['docker.io/', 'index.docker.io/', 'registry-1.docker.io/']
+HEX_ID = re.compile(r'^[0-9a-f]{1,64}$')
+
+def parse_reference(reference):
+    #'docker.io/library/alpine' -> ('alpine', 'latest', None), 'alpine@sha256:...' -> ('alpine', None, 'sha256:...')
+    name, _, digest = reference.partition('@')
+    tag = None
+    slash = name.rfind('/')
+    colon = name.rfind(':')
+    if colon > slash:
+        name, tag = name[:colon], name[colon + 1:]
+
+    for registry in DEFAULT_REGISTRIES:
+        if name.startswith(registry):
+            name = name[len(registry):]
+            break
+    if name.startswith('library/'):
+        name = name[len('library/'):]
+
+    if not digest and not tag:
+        tag = 'latest'
+    return name, tag, digest or None
+
+def rfc3339(timestamp):
+    return datetime.datetime.utcfromtimestamp(timestamp).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+def layer_ids(image_id, count):
+    #stable fake layer digests of an image
+    return ['sha256:{}'.format(hashlib.sha256('{}:{}'.format(image_id, i).encode('utf-8')).hexdigest()) for i in range(count)]
+
+def build_inspect(image, template):
+    #the inspect document of a DockerImage, the static parts come from templates/models/image_inspect.yml
+    name = image['RepoTags'][0].rpartition(':')[0] if image.get('RepoTags') else None
+    overrides = template.get(name) or {}
+
+    inspect = dict(template['default'])
+    inspect.update({key: value for key, value in overrides.items() if key != 'Config'})
+    config = dict(inspect['Config'])
+    config.update(overrides.get('Config') or {})
+    config['Image'] = 'sha256:{}'.format(hashlib.sha256(image['Id'].encode('utf-8')).hexdigest())
+    layers = inspect.pop('Layers')
+
+    inspect.update({
+        'Id': 'sha256:{}'.format(image['Id']),
+        'RepoTags': image.get('RepoTags') or [],
+        'RepoDigests': image.get('RepoDigests') or [],
+        'Parent': image.get('ParentId') or '',
+        'Created': rfc3339(image['Created']),
+        'Container': hashlib.sha256(config['Image'].encode('utf-8')).hexdigest(),
+        'ContainerConfig': dict(config, Cmd=['/bin/sh', '-c', '#(nop)  CMD {}'.format(json.dumps(config.get('Cmd')))]),
+        'Config': config,
+        'Size': image['Size'],
+        'VirtualSize': image['VirtualSize'],
+        'RootFS': {'Type': 'layers', 'Layers': layer_ids(image['Id'], layers)},
+    })
+    merged = hashlib.sha256(image['Id'].encode('utf-8')).hexdigest()
+    inspect['GraphDriver'] = {
+        'Data': {
+            'MergedDir': '/var/lib/docker/overlay2/{}/merged'.format(merged),
+            'UpperDir': '/var/lib/docker/overlay2/{}/diff'.format(merged),
+            'WorkDir': '/var/lib/docker/overlay2/{}/work'.format(merged)
+        },
+        'Name': 'overlay2'
+    }
+    return inspect
+
+class ImageResolver:
+
+    def __init__(self, collection, sensor_id, template, cache_size=1024, cache_ttl=30):
+        self.collection = collection
+        self.sensor_id = sensor_id
+        self.template = template
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        #reference: [expires, image, inspect document built on first use]
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _find(self, reference):
+        projection = {'_id': 0}
+        if reference.startswith('sha256:'):
+            query = {'Id': {'$regex': '^{}'.format(re.escape(reference[len('sha256:'):]))}}
+        else:
+            name, tag, digest = parse_reference(reference)
+            if digest:
+                query = {'RepoDigests': '{}@{}'.format(name, digest)}
+            else:
+                query = {'RepoTags': '{}:{}'.format(name, tag)}
+
+            image = self.collection.find_one(dict(query, SensorId=self.sensor_id), projection)
+            if image or not HEX_ID.match(reference):
+                return image
+            query = {'Id': {'$regex': '^{}'.format(reference)}}
+
+        #an id prefix has to be unambiguous
+        images = list(self.collection.find(dict(query, SensorId=self.sensor_id), projection).limit(2))
+        return images[0] if len(images) == 1 else None
+
+    def _entry(self, reference):
+        now = time.time()
+        with self._lock:
+            entry = self._cache.get(reference)
+            if entry and entry[0] > now:
+                self._cache.move_to_end(reference)
+                return entry
+
+        image = self._find(reference)
+        if image is None:
+            return None
+
+        entry = [now + self.cache_ttl, image, None]
+        with self._lock:
+            self._cache[reference] = entry
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return entry
+
+    def resolve(self, reference):
+        #the raw image document or None
+        entry = self._entry(reference)
+        return entry[1] if entry else None
+
+    def inspect(self, reference):
+        entry = self._entry(reference)
+        if entry is None:
+            return None
+        if entry[2] is None:
+            entry[2] = build_inspect(entry[1], self.template)
+        return entry[2]
+
+    def invalidate(self):
+        #after a mutation of the images of this sensor
+        with self._lock:
+            self._cache.clear()
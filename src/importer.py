@@ -0,0 +1,193 @@
+import os
+import ast
+import gzip
+import json
+import mmap
+import hashlib
+import datetime
+import multiprocessing
+
+from bson import ObjectId
+
+from spool import insert_request_logs
+
+#Loads the daily logs/<date>_log.json files back into http_request_log.
+#The file log is written by before_request_callback with Date, Data and id turned into strings,
+#parsing restores their types. Records carry the _id of the document stored at request time,
+#so importing a file twice, or a record already in Mongo, is deduplicated by the unique _id index.
+#Records written before they had an id are looked up by sensor, date, source IP, method and path instead.
+#The file log has every request while Mongo has one document per compaction group: with a compactor, the records
+#of compacted paths are folded into the first record of their group, whose _id is the one of the stored group.
+
+CHUNK_SIZE = 8*1024*1024
+
+#set by parse_line on the records without an id, removed before the insert
+LEGACY = '_legacy'
+
+NATURAL_KEY = ['SensorId', 'Date', 'SourceIP', 'Method', 'Path']
+
+def natural_key(record):
+    #mongo keeps milliseconds, the file log microseconds
+    date = record['Date'].replace(microsecond=record['Date'].microsecond // 1000 * 1000)
+    return (record.get('SensorId'), date, record.get('SourceIP'), record.get('Method'), record.get('Path'))
+
+def record_id(record, line):
+    if record.get('id'):
+        return ObjectId(record['id'])
+    #logs written before records had an id: the timestamp of the request and a hash of the line,
+    #stable across imports
+    seconds = int(record['Date'].replace(tzinfo=datetime.timezone.utc).timestamp())
+    return ObjectId(seconds.to_bytes(4, 'big') + hashlib.sha1(line).digest()[:8])
+
+def parse_line(line):
+    record = json.loads(line)
+    record['Date'] = datetime.datetime.fromisoformat(record['Date'])
+    record['_id'] = record_id(record, line)
+    if not record.pop('id', None):
+        record[LEGACY] = True
+
+    data = record.get('Data')
+    if data and data[:2] in ['b\'', 'b"']:
+        record['Data'] = ast.literal_eval(data)
+    if not record.get('Data'):
+        record.pop('Data', None)
+    if record.get('DataJson') is None:
+        record.pop('DataJson', None)
+    return record
+
+def parse_chunk(chunk):
+    #runs in the worker processes, broken lines are counted and skipped
+    records = []
+    errors = 0
+    for line in chunk.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            records.append(parse_line(line))
+        except (ValueError, KeyError, SyntaxError):
+            errors += 1
+    return records, errors
+
+def read_chunks(path, chunk_size=CHUNK_SIZE, use_mmap=True):
+    #yields blocks of whole lines
+    if path.endswith('.gz'):
+        with gzip.open(path, 'rb') as f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    return
+                yield chunk + f.readline()
+
+    with open(path, 'rb') as f:
+        if not use_mmap or os.fstat(f.fileno()).st_size == 0:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    return
+                yield chunk + f.readline()
+
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            start = 0
+            while start < len(m):
+                end = m.find(b'\n', start + chunk_size)
+                end = len(m) if end == -1 else end + 1
+                yield m[start:end]
+                start = end
+
+class RepeatFolder:
+    #folds the repeats of compacted paths into the first record of their group, as save_request_log does
+    #a group is released with its Count once a record past its window is read, the files are in date order
+
+    def __init__(self, compactor):
+        self.compactor = compactor
+        self._heads = {}
+
+    def fold(self, records):
+        #the records to insert, the groups still open are held back
+        released = []
+        latest = None
+        for record in records:
+            latest = max(latest or record['Date'], record['Date'])
+            if not self.compactor.applies_to(record['Path']):
+                released.append(record)
+                continue
+
+            record.setdefault('Args', {})
+            record.setdefault('Headers', {})
+            fingerprint = self.compactor.fingerprint(record)
+            group = self.compactor.repeat(fingerprint, record['Date'])
+            head = self._heads.get(fingerprint)
+            if group and head:
+                head['Count'] += 1
+                head['Last'] = max(head['Last'], record['Date'])
+                if self.compactor.is_sampled(group.count):
+                    head['SampledDates'].append(record['Date'])
+                continue
+
+            if head:
+                released.append(head)
+            record.update(Fingerprint=fingerprint, Count=1, First=record['Date'], Last=record['Date'], SampledDates=[record['Date']])
+            self.compactor.register(fingerprint, record['_id'], record['Date'])
+            self._heads[fingerprint] = record
+
+        if latest:
+            for fingerprint, head in list(self._heads.items()):
+                if (latest - head['First']).total_seconds() > self.compactor.window:
+                    released.append(self._heads.pop(fingerprint))
+                    self.compactor.forget(fingerprint)
+        return released
+
+    def release(self):
+        released = list(self._heads.values())
+        self._heads = {}
+        return released
+
+def unstored(collection, records):
+    #the records without id that have no document with the same natural key
+    if not records:
+        return []
+
+    query = {
+        'Date': {'$in': sorted({natural_key(record)[1] for record in records})},
+        'SensorId': {'$in': sorted({record.get('SensorId') or '' for record in records})}
+    }
+    stored = {natural_key(document) for document in collection.find(query, dict.fromkeys(NATURAL_KEY, 1))}
+    return [record for record in records if natural_key(record) not in stored]
+
+def store(collection, records):
+    documents = []
+    legacy = []
+    for record in records:
+        (legacy if record.pop(LEGACY, False) else documents).append(record)
+    documents += unstored(collection, legacy)
+    if documents:
+        insert_request_logs(collection, documents)
+
+def import_logs(collection, paths, workers=None, batch_size=10000, use_mmap=True, compactor=None):
+    #returns (parsed records, unparsable lines), records already stored are skipped by insert
+    #compactor: the Compactor of the sensors, the records of compacted paths are folded into their groups
+    parsed = 0
+    errors = 0
+    folder = RepeatFolder(compactor) if compactor is not None else None
+
+    def chunks():
+        for path in paths:
+            yield from read_chunks(path, use_mmap=use_mmap)
+
+    with multiprocessing.Pool(workers) as pool:
+        batch = []
+        for records, chunk_errors in pool.imap(parse_chunk, chunks()):
+            errors += chunk_errors
+            parsed += len(records)
+            batch.extend(folder.fold(records) if folder else records)
+            while len(batch) >= batch_size:
+                store(collection, batch[:batch_size])
+                batch = batch[batch_size:]
+
+        if folder:
+            batch.extend(folder.release())
+        if batch:
+            store(collection, batch)
+
+    return parsed, errors
@@ -0,0 +1,121 @@
+import datetime
+import hashlib
+import threading
+from collections import OrderedDict
+
+from utils import hash_headers
+
+#headers that differ between otherwise identical clients, they stay inline in the log document
+VOLATILE_HEADERS = ('Content-Length',)
+
+class LRUSet:
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self._lock:
+            if key in self._items:
+                self._items.move_to_end(key)
+                return True
+            return False
+
+    def add(self, key):
+        with self._lock:
+            self._items[key] = None
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+class HeaderInterner:
+    #write side: replaces the Headers of a log document by a reference to the header_set collection
+    #a hash is upserted only the first time a worker meets it
+
+    def __init__(self, header_sets, user_agents=None, cache_size=10000):
+        #header_sets and user_agents are pymongo collections
+        self.header_sets = header_sets
+        self.user_agents = user_agents
+        self._known = LRUSet(cache_size)
+
+    def _intern(self, collection, key, document):
+        if (collection.name, key) in self._known:
+            return key
+
+        collection.update_one(
+            {'Hash': key},
+            {'$setOnInsert': dict(document, Hash=key, FirstSeen=datetime.datetime.utcnow())},
+            upsert=True
+        )
+        self._known.add((collection.name, key))
+        return key
+
+    def intern(self, log_params):
+        #returns a copy of log_params with Headers replaced by HeadersRef (and UserAgentRef)
+        log_params = dict(log_params)
+        headers = dict(log_params.pop('Headers') or {})
+
+        extra = {name: headers.pop(name) for name in VOLATILE_HEADERS if name in headers}
+        if extra:
+            log_params['HeadersExtra'] = extra
+
+        if self.user_agents is not None and 'User-Agent' in headers:
+            user_agent = headers.pop('User-Agent')
+            key = hashlib.sha1(user_agent.encode('utf-8', 'replace')).hexdigest()
+            log_params['UserAgentRef'] = self._intern(self.user_agents, key, {'Value': user_agent})
+
+        log_params['HeadersRef'] = self._intern(self.header_sets, hash_headers(headers), {'Headers': headers})
+        return log_params
+
+class HeaderResolver:
+    #read side: restores Headers on raw http_request_log documents
+    #documents written before interning was enabled are returned untouched
+
+    def __init__(self, db, cache_size=100000):
+        self.header_sets = db['header_set']
+        self.user_agents = db['user_agent_string']
+        self.cache_size = cache_size
+        self._header_sets = {}
+        self._user_agents = {}
+
+    def _load(self, collection, cache, keys, field):
+        missing = [key for key in set(keys) if key not in cache]
+        if not missing:
+            return
+
+        if len(cache) + len(missing) > self.cache_size:
+            cache.clear()
+
+        for document in collection.find({'Hash': {'$in': missing}}, {'_id': 0, 'Hash': 1, field: 1}):
+            cache[document['Hash']] = document.get(field)
+
+    def rehydrate_many(self, requests):
+        #resolves all the references of a batch with one query per collection
+        requests = list(requests)
+
+        self._load(self.header_sets, self._header_sets, [r['HeadersRef'] for r in requests if r.get('HeadersRef')], 'Headers')
+        self._load(self.user_agents, self._user_agents, [r['UserAgentRef'] for r in requests if r.get('UserAgentRef')], 'Value')
+
+        for request in requests:
+            if not request.get('HeadersRef'):
+                continue
+
+            headers = dict(self._header_sets.get(request['HeadersRef']) or {})
+            if request.get('UserAgentRef') and request['UserAgentRef'] in self._user_agents:
+                headers['User-Agent'] = self._user_agents[request['UserAgentRef']]
+            headers.update(request.get('HeadersExtra') or {})
+            request['Headers'] = headers
+
+        return requests
+
+    def rehydrate(self, request):
+        return self.rehydrate_many([request])[0]
+
+    def iter_rehydrated(self, cursor, batch_size=1000):
+        batch = []
+        for request in cursor:
+            batch.append(request)
+            if len(batch) >= batch_size:
+                yield from self.rehydrate_many(batch)
+                batch = []
+        if batch:
+            yield from self.rehydrate_many(batch)
@@ -0,0 +1,133 @@
+import ipaddress
+
+from pymongo import ASCENDING, DESCENDING, UpdateOne
+
+IOC_COLLECTION = 'iocs'
+IOC_STATE_COLLECTION = 'ioc_state'
+
+#SourceIPs and Sensors stop growing at this size, a flush can add up to one more batch of values past it
+MAX_LIST_SIZE = 1000
+
+def ip_of(value):
+    #the address of 1.2.3.4, 1.2.3.4:80, 1.2.3.4|80, 2001:db8::1, [2001:db8::1]:80 or 2001:db8::1|80, None for anything else
+    for host in (value, value.rpartition('|')[0], value.rpartition(':')[0]):
+        try:
+            return str(ipaddress.ip_address(host.strip('[]')))
+        except ValueError:
+            continue
+    return None
+
+def ioc_type(value):
+    #bare IP addresses (with an optional port) are ip-dst, everything else extracted from commands is an url
+    if '/' in value or ip_of(value) is None:
+        return 'url'
+    return 'ip-dst'
+
+def ensure_ioc_indexes(collection):
+    collection.create_index([('Type', ASCENDING), ('Value', ASCENDING)], unique=True)
+    collection.create_index([('Value', ASCENDING)])
+    collection.create_index([('LastSeen', DESCENDING)])
+    collection.create_index([('SourceIPs', ASCENDING)])
+
+def find_ioc(db, value):
+    return db[IOC_COLLECTION].find_one({'Value': value}, {'_id': 0})
+
+def backfill_windows(db, start, end):
+    #the parts of [start, end) not backfilled yet, the requests of the covered range are never counted twice
+    #the windows reach the covered range, a run starting after it also counts the requests since its end
+    #they end before the first request counted by the analyzer, which counts the later ones itself
+    live = db[IOC_STATE_COLLECTION].find_one({'_id': 'live'})
+    if live:
+        end = min(end, live['Since'])
+    if start >= end:
+        return []
+
+    state = db[IOC_STATE_COLLECTION].find_one({'_id': 'backfill'})
+    if not state:
+        return [(start, end)]
+
+    windows = []
+    if start < state['From']:
+        windows.append((start, state['From']))
+    if end > state['Until']:
+        windows.append((state['Until'], end))
+    return windows
+
+def save_backfill(db, start, end):
+    #the covered range stays contiguous, see backfill_windows
+    db[IOC_STATE_COLLECTION].update_one({'_id': 'backfill'}, {'$min': {'From': start}, '$max': {'Until': end}}, upsert=True)
+
+def save_live_start(db, date):
+    #the analyzer counts the requests from date on, see backfill_windows
+    db[IOC_STATE_COLLECTION].update_one({'_id': 'live'}, {'$min': {'Since': date}}, upsert=True)
+
+class IocIndex:
+    #unique IOCs aggregated in memory and upserted in bulk
+    #a sighting costs a dict update, the collection sees one upsert per IOC per flush
+    #live is the index of the analyzer, its first request is recorded for the backfill
+
+    def __init__(self, collection, batch_size=500, max_list_size=MAX_LIST_SIZE, live=False):
+        self.collection = collection
+        self.batch_size = batch_size
+        self.max_list_size = max_list_size
+        self.live = live
+        self._pending = {}
+        self._lists = []
+
+    def add(self, value, date, sensor_id, source_ip, type=None):
+        key = (type or ioc_type(value), value)
+
+        ioc = self._pending.get(key)
+        if ioc is None:
+            ioc = self._pending[key] = {'FirstSeen': date, 'LastSeen': date, 'Hits': 0, 'Sensors': set(), 'SourceIPs': set()}
+
+        ioc['FirstSeen'] = min(ioc['FirstSeen'], date)
+        ioc['LastSeen'] = max(ioc['LastSeen'], date)
+        ioc['Hits'] += 1
+        ioc['Sensors'].add(sensor_id)
+        ioc['SourceIPs'].add(source_ip)
+
+        if len(self._pending) >= self.batch_size:
+            self.flush()
+
+    def add_action(self, action_info):
+        request = action_info['request']
+        for url in action_info.get('urls') or []:
+            self.add(url, request['Date'], request['SensorId'], request['SourceIP'])
+
+    def flush(self):
+        #the sightings are kept until they are written, a failed flush is retried by the next one
+        if not self._pending:
+            self._flush_lists()
+            return 0
+
+        counters = []
+        lists = []
+        for (type, value), ioc in self._pending.items():
+            key = {'Type': type, 'Value': value}
+            counters.append(UpdateOne(key, {
+                '$min': {'FirstSeen': ioc['FirstSeen']},
+                '$max': {'LastSeen': ioc['LastSeen']},
+                '$inc': {'Hits': ioc['Hits']}
+            }, upsert=True))
+            #only the lists still under max_list_size match
+            for name in ('Sensors', 'SourceIPs'):
+                lists.append(UpdateOne(
+                    dict(key, **{'{}.{}'.format(name, self.max_list_size - 1): {'$exists': False}}),
+                    {'$addToSet': {name: {'$each': sorted(ioc[name])[:self.max_list_size]}}}
+                ))
+
+        if self.live:
+            save_live_start(self.collection.database, min(ioc['FirstSeen'] for ioc in self._pending.values()))
+        #the documents are upserted before their lists are matched
+        self.collection.bulk_write(counters, ordered=False)
+        #counted, only the lists are written again after a failure, $addToSet does not add twice
+        self._pending = {}
+        self._lists.extend(lists)
+        self._flush_lists()
+        return len(counters)
+
+    def _flush_lists(self):
+        if self._lists:
+            self.collection.bulk_write(self._lists, ordered=False)
+            self._lists = []
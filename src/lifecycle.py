@@ -0,0 +1,163 @@
+import re
+import time
+import datetime
+import posixpath
+import threading
+
+import dateutil.parser
+
+from spool import insert_ignoring_duplicates
+
+#Lifecycle of the containers created through the API, the seeded ones (no CreatedAt) are left alone.
+#A container exits once its simulated command is done: a one-shot command after run_seconds, or as soon as its
+#output was sent by an attach, while services, interactive shells and miners keep running. The containers due are
+#moved to exited by ContainerLifecycle.tick, run every interval seconds by a thread of the workers that ran such a
+#container and by the create and list requests, which also reaps the oldest containers past max_containers of the sensor. manage.py reap removes the ones older than the ttl of every sensor.
+#reap() deletes containers with their execs and filesystem overlays, copying them to the archive first when asked.
+
+CONTAINER_COLLECTION = 'docker_container'
+EXEC_COLLECTION = 'docker_exec'
+FILESYSTEM_COLLECTION = 'container_filesystem'
+ARCHIVE_COLLECTION = 'docker_container_archive'
+
+SHELLS = ('sh', 'bash', 'ash', 'dash', 'zsh')
+LONG_RUNNING = re.compile(
+    r'sleep\s+(inf|\d{4,})|tail\s+-f|while\s+(true|:)|nohup|daemon|'
+    r'nginx|httpd|apache2|redis-server|mysqld|postgres|sshd|'
+    r'xmrig|minerd|cpuminer|kdevtmpfsi|kinsing|stratum\+tcp',
+    re.IGNORECASE
+)
+
+def exits_after(argv, run_seconds):
+    #seconds the command of a container runs, None when it keeps running
+    command = ' '.join(part for part in argv if part)
+    if not command:
+        #the default command of the image, a service
+        return None
+    if posixpath.basename(argv[0]) in SHELLS and '-c' not in argv:
+        #waits on its tty
+        return None
+    if LONG_RUNNING.search(command):
+        return None
+    return run_seconds
+
+def docker_time(date):
+    return date.isoformat() + 'Z'
+
+def human_duration(seconds):
+    #as the docker cli prints the age of a container
+    if seconds < 1:
+        return 'Less than a second'
+    if seconds < 60:
+        return '1 second' if seconds < 2 else '{} seconds'.format(int(seconds))
+    minutes = int(seconds // 60)
+    if minutes < 60:
+        return 'About a minute' if minutes == 1 else '{} minutes'.format(minutes)
+    hours = int(seconds // 3600)
+    if hours < 48:
+        return 'About an hour' if hours == 1 else '{} hours'.format(hours)
+    if hours < 24 * 7 * 2:
+        return '{} days'.format(hours // 24)
+    if hours < 24 * 30 * 2:
+        return '{} weeks'.format(hours // (24 * 7))
+    if hours < 24 * 365 * 2:
+        return '{} months'.format(hours // (24 * 30))
+    return '{} years'.format(hours // (24 * 365))
+
+def status_text(state, now=None):
+    #'Up 5 minutes' or 'Exited (0) 3 minutes ago' from the State of a container
+    now = now or datetime.datetime.utcnow()
+    running = state.get('Running', True)
+    date = state.get('StartedAt') if running else state.get('FinishedAt')
+    try:
+        seconds = (now - dateutil.parser.isoparse(date).replace(tzinfo=None)).total_seconds()
+    except (TypeError, ValueError):
+        seconds = 60
+    if running:
+        return 'Up {}'.format(human_duration(seconds))
+    return 'Exited ({}) {} ago'.format(state.get('ExitCode', 0), human_duration(seconds))
+
+def reap(db, container_ids, archive=False):
+    #removes the containers, their execs and filesystem overlays, returns the number of removed containers
+    if not container_ids:
+        return 0
+
+    if archive:
+        archived_at = datetime.datetime.utcnow()
+        documents = list(db[CONTAINER_COLLECTION].find({'Id': {'$in': container_ids}}))
+        for document in documents:
+            document['ArchivedAt'] = archived_at
+        if documents:
+            insert_ignoring_duplicates(db[ARCHIVE_COLLECTION], documents)
+
+    #execs created with a short container id too
+    db[EXEC_COLLECTION].delete_many({'ContainerID': {'$in': container_ids + [container_id[:12] for container_id in container_ids]}})
+    db[FILESYSTEM_COLLECTION].delete_many({'ContainerId': {'$in': container_ids}})
+    return db[CONTAINER_COLLECTION].delete_many({'Id': {'$in': container_ids}}).deleted_count
+
+def reap_expired(db, ttl, archive=False, batch_size=1000):
+    #the containers of all the sensors created more than ttl seconds ago, through the CreatedAt index
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds=ttl)
+    reaped = 0
+    while True:
+        container_ids = [c['Id'] for c in db[CONTAINER_COLLECTION].find({'CreatedAt': {'$lt': cutoff}}, {'_id': 0, 'Id': 1}).limit(batch_size)]
+        if not container_ids:
+            return reaped
+        reaped += reap(db, container_ids, archive)
+
+def exit_containers(db, containers, now):
+    #moves the containers due at now to exited, returns the ones this call moved: a container another worker
+    #moved meanwhile is left out, so its die event is published once
+    collection = db[CONTAINER_COLLECTION]
+    exited = []
+    for container in containers:
+        result = collection.update_one({'Id': container['Id'], 'ExitsAt': {'$lte': now}}, {
+            '$set': {
+                'State.Status': 'exited', 'State.Running': False, 'State.Pid': 0, 'State.ExitCode': 0,
+                'State.FinishedAt': docker_time(container['ExitsAt'])
+            },
+            '$unset': {'ExitsAt': ''}
+        })
+        if result.modified_count:
+            exited.append(container)
+    return exited
+
+class ContainerLifecycle:
+
+    def __init__(self, db, sensor_id, interval=10, max_containers=100, archive=False, batch_size=1000):
+        self.db = db
+        self.sensor_id = sensor_id
+        self.interval = interval
+        self.max_containers = max_containers
+        self.archive = archive
+        self.batch_size = batch_size
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def exit_due(self, now):
+        #the exited containers, with Id, Name and Config.Image for their events
+        due = self.db[CONTAINER_COLLECTION].find(
+            {'SensorId': self.sensor_id, 'ExitsAt': {'$lte': now}, 'State.Running': True},
+            {'_id': 0, 'Id': 1, 'Name': 1, 'Config.Image': 1, 'ExitsAt': 1}
+        ).limit(self.batch_size)
+        return exit_containers(self.db, list(due), now)
+
+    def over_limit(self):
+        #the ids of the oldest containers past max_containers
+        if not self.max_containers:
+            return []
+        return [c['Id'] for c in self.db[CONTAINER_COLLECTION].find(
+            {'SensorId': self.sensor_id, 'CreatedAt': {'$exists': True}}, {'_id': 0, 'Id': 1}
+        ).sort('CreatedAt', -1).skip(self.max_containers).limit(self.batch_size)]
+
+    def tick(self):
+        #(exited containers, reaped container ids), empty until interval seconds passed since the last run
+        with self._lock:
+            if time.time() < self._next:
+                return [], []
+            self._next = time.time() + self.interval
+
+        exited = self.exit_due(datetime.datetime.utcnow())
+        reaped = self.over_limit()
+        reap(self.db, reaped, self.archive)
+        return exited, reaped
@@ -1,48 +1,178 @@
 from flask.cli import FlaskGroup
 from app import app, db
-from models import Docker, DockerImage, DockerContainer
-from utils import get_random_name, get_settings
-from app import MODELS_TEMPLATES_DIR
-import yaml
+from models import DockerImage, DockerContainer
+from utils import get_settings
+from seeding import build_profile, diff_profile, seed_profile
+from app import MODELS_TEMPLATES_DIR, CURRENT_DIR
+from retention import ensure_retention, rollup, ensure_ttl_index
+from stats import ensure_stats_indexes
+from events import EVENT_COLLECTION, ensure_event_indexes
+from ioc import IOC_COLLECTION, ensure_ioc_indexes
+from importer import import_logs
+from compaction import Compactor
+from profiling import control
+from lifecycle import ARCHIVE_COLLECTION, reap_expired
+from shipping import BATCH_COLLECTION
+from mongoengine.connection import get_db
+import os
+import sys
+import glob
+import json
+import time
+import click
+import subprocess
+import dateutil.parser
 
 settings = get_settings()
 
 cli = FlaskGroup(app)
 
 @cli.command("seed_db")
-def seed_db():
-    
-    try:
-        Docker.objects(SensorId = settings['sensor']['id']).delete()
-    except:
-        pass
-
-    try:
-        DockerImage.objects(SensorId = settings['sensor']['id']).delete()
-    except:
-        pass
-
-    try:
-        DockerContainer.objects(SensorId = settings['sensor']['id']).delete()
-    except:
-        pass
-
-    with open(MODELS_TEMPLATES_DIR + '/docker.yml') as file:
-        docker = yaml.load(file, Loader=yaml.FullLoader)['default']
-        docker['SensorId'] = settings['sensor']['id']
-        o = Docker(**docker).save()
-
-    with open(MODELS_TEMPLATES_DIR + '/images.yml') as file:
-        images = yaml.load(file, Loader=yaml.FullLoader)
-        for image in images.values():
-            image['SensorId'] = settings['sensor']['id']
-            o = DockerImage(**image).save()
-
-    with open(MODELS_TEMPLATES_DIR + '/containers.yml') as file:
-        containers = yaml.load(file, Loader=yaml.FullLoader)
-        for container in containers.values():
-            container['SensorId'] = settings['sensor']['id']
-            o = DockerContainer(**container).save()
+@click.option("--sensor-id", "sensor_ids", multiple=True, help="Sensor to seed, can be repeated, the configured sensor by default")
+@click.option("--dry-run", is_flag=True, help="Only show what would change")
+def seed_db(sensor_ids, dry_run):
+    for sensor_id in sensor_ids or [settings['sensor']['id']]:
+        profile = build_profile(MODELS_TEMPLATES_DIR, sensor_id)
+
+        if dry_run:
+            changes = diff_profile(profile, sensor_id)
+            print ('{}: {} change(s)'.format(sensor_id, len(changes)))
+            for change, model, key, fields in changes:
+                print ('  {} {} {} {}'.format(change, model.__name__, key, ', '.join(fields)).rstrip())
+            continue
+
+        seed_profile(profile, sensor_id)
+        print ('{}: {} image(s), {} container(s)'.format(sensor_id, len(profile[DockerImage]), len(profile[DockerContainer])))
+
+@cli.command("ensure_indexes")
+def ensure_indexes():
+    ensure_retention(get_db(), settings)
+    ensure_ioc_indexes(get_db()[IOC_COLLECTION])
+    ensure_stats_indexes(get_db(), settings['stats']['cache_ttl'])
+    ensure_event_indexes(get_db()[EVENT_COLLECTION], settings['events']['ttl'])
+    ensure_ttl_index(get_db()[ARCHIVE_COLLECTION], 'ArchivedAt', int(settings['containers']['archive_ttl_days'] * 86400))
+    #written by the collector only
+    ensure_ttl_index(get_db()[BATCH_COLLECTION], 'Date', int(settings['collector']['batch_ttl']))
+
+@cli.command("tls_setup")
+@click.option("--common-name", default="docker", help="Subject of the generated certificate")
+@click.option("--days", default=3650, help="Validity of the generated certificate")
+def tls_setup(common_name, days):
+    #exits with 1 when the TLS listener is disabled, a self-signed certificate is generated when none is there
+    options = settings['tls']
+    if not options['enabled']:
+        sys.exit(1)
+
+    if os.path.exists(options['certfile']) and os.path.exists(options['keyfile']):
+        print ('Using {}'.format(options['certfile']))
+        return
+
+    for path in [options['certfile'], options['keyfile']]:
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    subprocess.run([
+        'openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-sha256',
+        '-days', str(days), '-subj', '/CN={}'.format(common_name),
+        '-keyout', options['keyfile'], '-out', options['certfile']
+    ], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    os.chmod(options['keyfile'], 0o600)
+    print ('Self-signed certificate written to {}'.format(options['certfile']))
+
+@cli.command("rollup")
+@click.option("--since", help="Recompute the rollups starting from this UTC date (ISO 8601)")
+@click.option("--loop", default=0, help="Keep running, every LOOP seconds")
+def rollup_logs(since, loop):
+    since = dateutil.parser.isoparse(since).replace(tzinfo=None) if since else None
+
+    while True:
+        hours = rollup(get_db(), settings['retention']['lag'], since=since)
+        print ('{} hour(s) rolled up'.format(hours))
+
+        if not loop:
+            break
+        since = None
+        time.sleep(loop)
+
+@cli.command("reap")
+@click.option("--ttl", default=None, type=int, help="Seconds, containers.ttl by default")
+@click.option("--archive/--no-archive", default=None, help="Copy the containers to docker_container_archive, containers.archive by default")
+@click.option("--loop", default=0, help="Keep running, every LOOP seconds")
+def reap_containers(ttl, archive, loop):
+    #the containers created through the API by the attackers, of every sensor, with their execs and filesystems
+    ttl = ttl if ttl is not None else settings['containers']['ttl']
+    archive = archive if archive is not None else settings['containers']['archive']
+
+    while True:
+        print ('{} container(s) removed'.format(reap_expired(get_db(), ttl, archive)))
+
+        if not loop:
+            break
+        time.sleep(loop)
+
+@cli.command("import_logs")
+@click.argument("paths", nargs=-1)
+@click.option("--workers", default=None, type=int, help="Parser processes, one per CPU by default")
+@click.option("--batch-size", default=10000, help="Documents per insert_many")
+@click.option("--no-mmap", is_flag=True, help="Read the files instead of memory-mapping them")
+def import_log_files(paths, workers, batch_size, no_mmap):
+    #logs/<date>_log.json files (or .gz) back into http_request_log, records already stored are skipped
+    if not paths:
+        paths = sorted(glob.glob(os.path.join(CURRENT_DIR, 'logs', '*_log.json*')))
+
+    compactor = None
+    if settings['compaction']['enabled']:
+        #the repeats the sensors counted in a compacted document are folded the same way
+        options = settings['compaction']
+        compactor = Compactor(options['window'], options['paths'], options['exclude'], options['max_groups'])
+
+    started = time.time()
+    parsed, errors = import_logs(get_db()['http_request_log'], paths, workers, batch_size, not no_mmap, compactor)
+    elapsed = time.time() - started
+    print ('{} record(s) from {} file(s) stored or already present, {:.1f}s, {} unparsable line(s)'.format(parsed, len(paths), elapsed, errors))
+
+@cli.command("profile")
+@click.argument("action", type=click.Choice(['sample', 'memory-start', 'memory-diff', 'memory-stop', 'slow', 'status']))
+@click.option("--seconds", default=10.0, help="sample: sampling duration")
+@click.option("--interval", default=0.005, help="sample: seconds between samples")
+@click.option("--output", default=None, help="sample: folded stacks file, stdout by default")
+@click.option("--limit", default=20, help="memory-diff: lines shown per worker")
+@click.option("--threshold", default=0.0, help="slow: milliseconds, 0 disables the slow request log")
+def profile(action, seconds, interval, output, limit, threshold):
+    #the workers of the running sensor, through their control sockets (profiling.enabled)
+    if action == 'sample':
+        command = {'command': 'sample', 'seconds': seconds, 'interval': interval}
+    elif action.startswith('memory-'):
+        command = {'command': 'memory', 'action': action[len('memory-'):], 'limit': limit}
+    elif action == 'slow':
+        command = {'command': 'slow', 'threshold': threshold}
+    else:
+        command = {'command': 'status'}
+
+    answers = control(settings['profiling']['socket_dir'], command, timeout=seconds + 30)
+    if not answers:
+        print ('No worker found in {}, is profiling enabled?'.format(settings['profiling']['socket_dir']))
+        return
+
+    if action != 'sample':
+        for pid, answer in sorted(answers.items()):
+            print ('{}: {}'.format(pid, json.dumps(answer, indent=2)))
+        return
+
+    #folded stacks of all the workers, for flamegraph.pl or speedscope
+    stacks = {}
+    for pid, answer in answers.items():
+        if 'error' in answer:
+            print ('{}: {}'.format(pid, answer['error']))
+            continue
+        for stack, count in answer['stacks'].items():
+            stacks[stack] = stacks.get(stack, 0) + count
+
+    lines = ['{} {}'.format(stack, count) for stack, count in sorted(stacks.items())]
+    if output:
+        with open(output, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        print ('{} stack(s) from {} worker(s) written to {}'.format(len(lines), len(answers), output))
+    else:
+        print ('\n'.join(lines))
 
 if __name__ == "__main__":
     cli()
\ No newline at end of file
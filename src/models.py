@@ -89,6 +89,10 @@ class DockerImage(db.Document):
     Size = db.IntField(required=True)
     VirtualSize = db.IntField(required=True)
 
+    meta = {
+        'indexes': [('SensorId', 'Id'), ('SensorId', 'RepoTags'), ('SensorId', 'RepoDigests')]
+    }
+
 class DockerContainer(db.Document):
     SensorId = db.StringField(required=True)
     Id = db.StringField(required=True)
@@ -114,6 +118,14 @@ class DockerContainer(db.Document):
     Mounts = db.ListField()
     Config = db.DictField()
     NetworkSettings = db.DictField()    
+    #set on the containers created through the API, see lifecycle.py
+    CreatedAt = db.DateTimeField()
+    CreatedBy = db.StringField()
+    ExitsAt = db.DateTimeField()
+
+    meta = {
+        'indexes': [('SensorId', 'Id'), ('SensorId', 'CreatedAt'), ('SensorId', 'ExitsAt'), 'CreatedAt']
+    }
     
 class DockerExec(db.Document):
     SensorId = db.StringField(required=True)
@@ -129,6 +141,37 @@ class DockerExec(db.Document):
     DetachKeys = db.StringField()
     Pid = db.IntField(required=True)   
 
+    meta = {
+        'indexes': ['ContainerID']
+    }
+
+class ContainerFilesystem(db.Document):
+    #copy-on-write overlay of a fake container over the shared base filesystem, see shell.py
+    SensorId = db.StringField(required=True)
+    ContainerId = db.StringField(required=True)
+    Files = db.ListField(db.DictField())
+    Downloads = db.ListField(db.DictField())
+
+    meta = {
+        'indexes': [('SensorId', 'ContainerId')]
+    }
+
+class Sample(db.Document):
+    #file extracted from the archives uploaded to the containers, stored by hash, see samples.py
+    Sha256 = db.StringField(required=True)
+    Size = db.IntField()
+    FileType = db.StringField()
+    FirstSeen = db.DateTimeField()
+    LastSeen = db.DateTimeField()
+    Count = db.IntField()
+    SourceIPs = db.ListField(db.StringField())
+    Paths = db.ListField(db.StringField())
+    SensorIds = db.ListField(db.StringField())
+
+    meta = {
+        'indexes': [{'fields': ['Sha256'], 'unique': True}, 'LastSeen']
+    }
+
 class HttpRequestLog(db.Document):
     Date = db.DateTimeField(default=datetime.datetime.utcnow)
     SensorId = db.StringField(required=True)
@@ -139,7 +182,57 @@ class HttpRequestLog(db.Document):
     Args = db.DictField()
     Url = db.StringField(required=True)
     Headers = db.DictField()
+    #set instead of Headers when header interning is enabled, see interning.py
+    HeadersRef = db.StringField()
+    HeadersExtra = db.DictField()
+    UserAgentRef = db.StringField()
     DataJson = db.DictField()
     Data = db.BinaryField()
     SourceIP = db.StringField(required=True)
+    #set on compacted documents only, see compaction.py
+    Fingerprint = db.StringField()
+    Count = db.IntField()
+    First = db.DateTimeField()
+    Last = db.DateTimeField()
+    SampledDates = db.ListField(db.DateTimeField())
+    #set by analyzer.py on exec/create/build requests, see campaigns.py
+    CampaignId = db.StringField()
+    #country, city and AS of SourceIP set by analyzer.py, see geoip.py
+    Geo = db.DictField()
+    #ClientHello of the requests received on the TLS listener, see tls.py
+    Tls = db.DictField()
+    #server time of the insert for the logs written in batches, see spool.insert_request_logs
+    Stored = db.DateTimeField()
+
+
+class HeaderSet(db.Document):
+    Hash = db.StringField(required=True)
+    Headers = db.DictField()
+    FirstSeen = db.DateTimeField()
+
+    meta = {
+        'indexes': [{'fields': ['Hash'], 'unique': True}]
+    }
+
+class UserAgentString(db.Document):
+    Hash = db.StringField(required=True)
+    Value = db.StringField()
+    FirstSeen = db.DateTimeField()
+
+    meta = {
+        'indexes': [{'fields': ['Hash'], 'unique': True}]
+    }
+
+class SuppressedRequestLog(db.Document):
+    #requests dropped or tarpitted by the rate limiter, counted per source IP and hour
+    Date = db.DateTimeField(required=True)
+    SensorId = db.StringField(required=True)
+    SourceIP = db.StringField(required=True)
+    Count = db.IntField(default=0)
+    FirstSeen = db.DateTimeField()
+    LastSeen = db.DateTimeField()
+    LastPath = db.StringField()
 
+    meta = {
+        'indexes': [('SensorId', 'SourceIP', 'Date')]
+    }
@@ -0,0 +1,210 @@
+import os
+import sys
+import json
+import glob
+import time
+import socket
+import logging
+import threading
+import contextlib
+import tracemalloc
+from collections import Counter, OrderedDict
+
+from spool import pid_alive
+
+#Opt-in profiling of the running sensor, driven through a unix socket per worker: <socket_dir>/<pid>.sock.
+#The socket is only reachable from the host (or container) of the sensor, never through the honeypot port.
+#  sample    statistical sampling of the stacks of the threads handling a request, as folded stacks
+#            (one 'frame;frame;frame count' line per stack, the input of flamegraph.pl and speedscope)
+#  memory    tracemalloc start, diff against the previous snapshot, stop
+#  slow      logs the requests slower than a threshold with the time spent in each phase
+#  status    requests in flight, tracemalloc state and threshold
+#manage.py profile sends a command to every worker and merges the answers.
+
+logger = logging.getLogger(__name__)
+
+class RequestTimings:
+    __slots__ = ('started', 'phases', '_mark')
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases = OrderedDict()
+        self._mark = None
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - started)
+
+    def add(self, name, seconds):
+        self.phases[name] = self.phases.get(name, 0) + seconds
+
+    def mark(self):
+        #start of a phase ended by close_phase, for the phases spanning several callbacks
+        self._mark = time.perf_counter()
+
+    def close_phase(self, name):
+        if self._mark is not None:
+            self.add(name, time.perf_counter() - self._mark)
+            self._mark = None
+
+    def total(self):
+        return time.perf_counter() - self.started
+
+def fold(frame):
+    #'module:function;module:function' from the outermost frame
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append('{}:{}'.format(os.path.splitext(os.path.basename(code.co_filename))[0], code.co_name))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+class Profiler:
+
+    def __init__(self, socket_dir, slow_ms=0):
+        self.socket_dir = socket_dir
+        self.slow_ms = slow_ms
+        self.path = None
+
+        #thread id: timings of the request it handles
+        self._requests = {}
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self._server = None
+
+    def begin(self):
+        timings = RequestTimings()
+        with self._lock:
+            self._requests[threading.get_ident()] = timings
+        return timings
+
+    def end(self, timings, description):
+        with self._lock:
+            if self._requests.get(threading.get_ident()) is timings:
+                del self._requests[threading.get_ident()]
+
+        total = timings.total() * 1000
+        if self.slow_ms and total >= self.slow_ms:
+            phases = ' '.join('{}={:.1f}'.format(name, seconds * 1000) for name, seconds in timings.phases.items())
+            logger.warning('Slow request %s %.1fms: %s', description, total, phases)
+
+    def sample(self, seconds=10, interval=0.005):
+        counts = Counter()
+        samples = 0
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            frames = sys._current_frames()
+            with self._lock:
+                threads = list(self._requests)
+            for ident in threads:
+                frame = frames.get(ident)
+                if frame is not None:
+                    counts[fold(frame)] += 1
+            samples += 1
+            del frames
+            time.sleep(interval)
+        return {'samples': samples, 'stacks': dict(counts)}
+
+    def memory(self, action, frames=10, limit=20):
+        if action == 'start':
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(frames)
+            self._snapshot = tracemalloc.take_snapshot()
+            return {'tracing': True}
+
+        if action == 'stop':
+            tracemalloc.stop()
+            self._snapshot = None
+            return {'tracing': False}
+
+        if not tracemalloc.is_tracing():
+            return {'error': 'tracemalloc is not started'}
+
+        #the growth since the previous snapshot, by line
+        snapshot = tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+        ])
+        stats = snapshot.compare_to(self._snapshot, 'lineno') if self._snapshot else snapshot.statistics('lineno')
+        self._snapshot = snapshot
+        current, peak = tracemalloc.get_traced_memory()
+        return {'current': current, 'peak': peak, 'top': [str(stat) for stat in stats[:limit]]}
+
+    def status(self):
+        with self._lock:
+            requests = len(self._requests)
+        return {'requests': requests, 'tracing': tracemalloc.is_tracing(), 'slow_ms': self.slow_ms}
+
+    def handle(self, command):
+        name = command.get('command')
+        if name == 'sample':
+            return self.sample(float(command.get('seconds', 10)), float(command.get('interval', 0.005)))
+        if name == 'memory':
+            return self.memory(command.get('action', 'diff'), int(command.get('frames', 10)), int(command.get('limit', 20)))
+        if name == 'slow':
+            self.slow_ms = float(command.get('threshold', 0))
+            return self.status()
+        if name == 'status':
+            return self.status()
+        return {'error': 'unknown command: {}'.format(name)}
+
+    def _serve(self, server):
+        while True:
+            connection, _ = server.accept()
+            with connection:
+                try:
+                    command = json.loads(connection.makefile('rb').readline())
+                    answer = self.handle(command)
+                except Exception as err:
+                    answer = {'error': str(err)}
+                connection.sendall((json.dumps(answer) + '\n').encode('utf-8'))
+
+    def start(self):
+        #in every worker after the fork
+        self.path = os.path.join(self.socket_dir, '{}.sock'.format(os.getpid()))
+        os.makedirs(self.socket_dir, mode=0o700, exist_ok=True)
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(self.path)
+
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.path)
+        os.chmod(self.path, 0o600)
+        server.listen(4)
+        self._server = threading.Thread(target=self._serve, args=(server,), name='profiler', daemon=True)
+        self._server.start()
+
+def control(socket_dir, command, timeout=None):
+    #sends the command to every worker at once, {pid: answer}
+    answers = {}
+
+    def send(path, pid):
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+                connection.settimeout(timeout)
+                connection.connect(path)
+                connection.sendall((json.dumps(command) + '\n').encode('utf-8'))
+                answers[pid] = json.loads(connection.makefile('rb').readline())
+        except (OSError, ValueError) as err:
+            answers[pid] = {'error': str(err)}
+
+    threads = []
+    for path in sorted(glob.glob(os.path.join(socket_dir, '*.sock'))):
+        pid = int(os.path.basename(path).split('.')[0])
+        if pid == os.getpid():
+            continue
+        if not pid_alive(pid):
+            #left by a worker that was killed
+            with contextlib.suppress(OSError):
+                os.unlink(path)
+            continue
+        thread = threading.Thread(target=send, args=(path, pid))
+        thread.start()
+        threads.append(thread)
+
+    for thread in threads:
+        thread.join()
+    return answers
@@ -0,0 +1,134 @@
+import re
+import datetime
+
+from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import OperationFailure
+
+from compaction import strip_api_version
+
+RAW_COLLECTION = 'http_request_log'
+HOURLY_COLLECTION = 'http_request_rollup_hourly'
+DAILY_COLLECTION = 'http_request_rollup_daily'
+STATE_COLLECTION = 'rollup_state'
+
+ROLLUP_KEYS = ['SensorId', 'Path', 'Action', 'ActionType', 'SourceIP', 'Image']
+
+#container, exec and image ids in paths would make a rollup key per object
+OBJECT_ID = re.compile(r'/(?:sha256:)?[0-9a-f]{12,64}(?=/|$)')
+
+INDEX_OPTIONS_CONFLICT = 85
+
+def normalize_path(path):
+    return OBJECT_ID.sub('/<id>', strip_api_version(path))
+
+def ensure_ttl_index(collection, field, ttl_seconds):
+    #creates, updates or drops the TTL index on field
+    name = '{}_ttl'.format(field)
+
+    if not ttl_seconds:
+        if name in collection.index_information():
+            collection.drop_index(name)
+        return
+
+    try:
+        collection.create_index([(field, ASCENDING)], name=name, expireAfterSeconds=ttl_seconds)
+    except OperationFailure as err:
+        if err.code != INDEX_OPTIONS_CONFLICT:
+            raise
+        collection.database.command('collMod', collection.name, index={'name': name, 'expireAfterSeconds': ttl_seconds})
+
+def ensure_retention(db, settings):
+    retention = settings['retention']
+    raw_ttl = int(retention['raw_ttl_days'] * 86400)
+
+    ensure_ttl_index(db[RAW_COLLECTION], 'Date', raw_ttl)
+
+    db[RAW_COLLECTION].create_index([('Date', ASCENDING), ('SensorId', ASCENDING)])
+    #read order of the Parquet export, see columnar.py
+    db[RAW_COLLECTION].create_index([('Stored', ASCENDING), ('_id', ASCENDING)])
+
+    for name, ttl_days in [(HOURLY_COLLECTION, retention['hourly_ttl_days']), (DAILY_COLLECTION, retention['daily_ttl_days'])]:
+        collection = db[name]
+        collection.create_index([('Date', ASCENDING)] + [(key, ASCENDING) for key in ROLLUP_KEYS], unique=True)
+        collection.create_index([('SensorId', ASCENDING), ('Date', DESCENDING)])
+        collection.create_index([('SourceIP', ASCENDING), ('Date', DESCENDING)])
+        ensure_ttl_index(collection, 'Date', int(ttl_days * 86400))
+
+def classify(request):
+    #imported here, ensure_ttl_index is used by the sensor and the collector which do not classify
+    from analyzer import get_action_info
+    try:
+        action_info = get_action_info(request, parse_payload=False)
+    except Exception:
+        return 'Unhandled', 'Unhandled', None
+    return action_info['action'], action_info['type'], action_info['image']
+
+def rollup_hour(db, hour):
+    #recomputes the hourly rollups of one hour from raw logs, the result does not depend on previous runs
+    projection = {'SensorId': 1, 'Method': 1, 'Path': 1, 'Args': 1, 'DataJson': 1, 'SourceIP': 1, 'Count': 1}
+    request_logs = db[RAW_COLLECTION].find(
+        {'Date': {'$gte': hour, '$lt': hour + datetime.timedelta(hours=1)}}, projection, batch_size=5000
+    )
+
+    counts = {}
+    for request in request_logs:
+        request.setdefault('Args', {})
+        request.setdefault('DataJson', None)
+        action, action_type, image = classify(request)
+        key = (request['SensorId'], normalize_path(request['Path']), action, action_type, request['SourceIP'], image)
+        #compacted documents stand for Count requests
+        counts[key] = counts.get(key, 0) + (request.get('Count') or 1)
+
+    db[HOURLY_COLLECTION].delete_many({'Date': hour})
+    if counts:
+        db[HOURLY_COLLECTION].insert_many(
+            [dict(zip(ROLLUP_KEYS, key), Date=hour, Count=count) for key, count in counts.items()],
+            ordered=False
+        )
+
+def rollup_day(db, day):
+    #daily rollups are summed up from the hourly ones
+    pipeline = [
+        {'$match': {'Date': {'$gte': day, '$lt': day + datetime.timedelta(days=1)}}},
+        {'$group': {'_id': {key: '${}'.format(key) for key in ROLLUP_KEYS}, 'Count': {'$sum': '$Count'}}}
+    ]
+    documents = [dict(group['_id'], Date=day, Count=group['Count']) for group in db[HOURLY_COLLECTION].aggregate(pipeline)]
+
+    db[DAILY_COLLECTION].delete_many({'Date': day})
+    if documents:
+        db[DAILY_COLLECTION].insert_many(documents, ordered=False)
+
+def rollup(db, lag_seconds, since=None):
+    #rolls up every complete hour older than lag_seconds since the watermark
+    #the lag leaves time for compacted documents to be closed and for late inserts
+    #returns the number of rolled up hours
+    state = db[STATE_COLLECTION].find_one({'_id': RAW_COLLECTION}) or {}
+
+    if since:
+        hour = since.replace(minute=0, second=0, microsecond=0)
+    elif state.get('Date'):
+        hour = state['Date']
+    else:
+        first = db[RAW_COLLECTION].find_one({}, {'Date': 1}, sort=[('Date', ASCENDING)])
+        if not first:
+            return 0
+        hour = first['Date'].replace(minute=0, second=0, microsecond=0)
+
+    limit = datetime.datetime.utcnow() - datetime.timedelta(seconds=lag_seconds)
+    hours = 0
+
+    while hour + datetime.timedelta(hours=1) <= limit:
+        rollup_hour(db, hour)
+        hour += datetime.timedelta(hours=1)
+        hours += 1
+
+        if hour.hour == 0:
+            rollup_day(db, hour - datetime.timedelta(days=1))
+
+        db[STATE_COLLECTION].update_one({'_id': RAW_COLLECTION}, {'$set': {'Date': hour}}, upsert=True)
+
+    #the current day so far
+    if hours and hour.hour != 0:
+        rollup_day(db, hour.replace(hour=0))
+
+    return hours
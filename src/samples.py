@@ -0,0 +1,186 @@
+import io
+import os
+import queue
+import logging
+import hashlib
+import tarfile
+import datetime
+import posixpath
+import tempfile
+import threading
+
+from pymongo import UpdateOne
+
+#Sample store of the files uploaded with PUT /containers/<id>/archive.
+#Archives are queued by the request handler and extracted by a background thread: the tar stream is read once
+#(gzip, bzip2 and xz included), every regular file is hashed while it is written to a temporary file and moved to
+#<directory>/<sha256[:2]>/<sha256> unless that sample is already stored. Links, devices and the entries above
+#the limits are skipped. The files are written read-only and never executed or interpreted.
+#The index (sample collection) has one document per hash with the size, file type, first/last seen dates,
+#uploader IPs, target paths and sensors.
+
+CHUNK_SIZE = 64*1024
+#SourceIPs, Paths and SensorIds stop growing at this size
+MAX_LIST_SIZE = 1000
+
+logger = logging.getLogger(__name__)
+
+#(offset, magic, type), the first match wins
+MAGIC = [
+    (0, b'\x7fELF', 'ELF'),
+    (0, b'MZ', 'PE'),
+    (0, b'#!', 'Script'),
+    (0, b'\x1f\x8b', 'gzip'),
+    (0, b'BZh', 'bzip2'),
+    (0, b'\xfd7zXZ\x00', 'xz'),
+    (0, b'PK\x03\x04', 'Zip'),
+    (0, b'7z\xbc\xaf\x27\x1c', '7-Zip'),
+    (257, b'ustar', 'tar'),
+    (0, b'\xca\xfe\xba\xbe', 'Mach-O/Java class'),
+    (0, b'\xcf\xfa\xed\xfe', 'Mach-O'),
+    (0, b'\x89PNG', 'PNG'),
+    (0, b'\xff\xd8\xff', 'JPEG'),
+    (0, b'%PDF', 'PDF'),
+]
+
+def file_type(head):
+    for offset, magic, name in MAGIC:
+        if head[offset:offset + len(magic)] == magic:
+            return name
+    try:
+        head.decode('utf-8')
+    except UnicodeDecodeError:
+        return 'Data'
+    return 'Text'
+
+class SampleStore:
+
+    def __init__(self, directory, collection, max_entries=1000, max_entry_size=32*1024*1024, max_total_size=256*1024*1024, max_list_size=MAX_LIST_SIZE):
+        self.directory = directory
+        self.collection = collection
+        self.max_list_size = max_list_size
+        self.max_entries = max_entries
+        self.max_entry_size = max_entry_size
+        self.max_total_size = max_total_size
+
+    def path(self, sha256):
+        return os.path.join(self.directory, sha256[:2], sha256)
+
+    def _store(self, member_file, size):
+        #(sha256, file type) of the member, written to the store when it is new
+        digest = hashlib.sha256()
+        head = b''
+        os.makedirs(self.directory, exist_ok=True)
+        descriptor, temporary = tempfile.mkstemp(dir=self.directory, suffix='.part')
+        try:
+            with os.fdopen(descriptor, 'wb') as f:
+                remaining = size
+                while remaining > 0:
+                    chunk = member_file.read(min(CHUNK_SIZE, remaining))
+                    if not chunk:
+                        break
+                    if len(head) < 512:
+                        head += chunk[:512 - len(head)]
+                    digest.update(chunk)
+                    f.write(chunk)
+                    remaining -= len(chunk)
+
+            sha256 = digest.hexdigest()
+            path = self.path(sha256)
+            if os.path.exists(path):
+                os.remove(temporary)
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.chmod(temporary, 0o440)
+                os.replace(temporary, path)
+        except BaseException:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+            raise
+        return sha256, file_type(head)
+
+    def index(self, sample, source_ip, sensor_id, date):
+        key = {'Sha256': sample['Sha256']}
+        self.collection.update_one(
+            key,
+            {
+                '$setOnInsert': {'Size': sample['Size'], 'FileType': sample['FileType'], 'FirstSeen': date},
+                '$max': {'LastSeen': date},
+                '$inc': {'Count': 1}
+            },
+            upsert=True
+        )
+        #the lists of a full document are left as they are, the document is upserted before
+        self.collection.bulk_write([
+            UpdateOne(dict(key, **{'{}.{}'.format(name, self.max_list_size - 1): {'$exists': False}}), {'$addToSet': {name: value}})
+            for name, value in (('SourceIPs', source_ip), ('Paths', sample['Path']), ('SensorIds', sensor_id))
+        ], ordered=False)
+
+    def extract(self, data, target, source_ip, sensor_id, date=None):
+        #the samples of an uploaded archive, [{'Sha256', 'Size', 'FileType', 'Path'}]
+        #a truncated archive raises once the samples before the damage are stored
+        date = date or datetime.datetime.utcnow()
+        samples = []
+        entries = 0
+        total = 0
+
+        with tarfile.open(fileobj=io.BytesIO(data), mode='r|*') as archive:
+            for member in archive:
+                entries += 1
+                if entries > self.max_entries:
+                    break
+                if not member.isfile():
+                    continue
+                #the skipped entries are decompressed too, they count towards the total
+                total += member.size
+                if total > self.max_total_size:
+                    break
+                if member.size > self.max_entry_size:
+                    continue
+
+                sha256, kind = self._store(archive.extractfile(member), member.size)
+                path = posixpath.normpath(posixpath.join(target or '/', member.name.lstrip('/')))
+                sample = {'Sha256': sha256, 'Size': member.size, 'FileType': kind, 'Path': path}
+                self.index(sample, source_ip, sensor_id, date)
+                samples.append(sample)
+        return samples
+
+class SampleExtractor(threading.Thread):
+    #extracts the queued archives off the request path, an archive is dropped when the queued ones would hold
+    #more than max_queued_bytes
+
+    def __init__(self, store, max_queued_bytes=128*1024*1024):
+        super().__init__(daemon=True, name='sample-extractor')
+        self.store = store
+        self.max_queued_bytes = max_queued_bytes
+        self.queued_bytes = 0
+        self.dropped = 0
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+
+    def submit(self, data, target, source_ip, sensor_id):
+        with self._lock:
+            if self.queued_bytes + len(data) > self.max_queued_bytes:
+                self.dropped += 1
+                return False
+            self.queued_bytes += len(data)
+        self._queue.put((data, target, source_ip, sensor_id, datetime.datetime.utcnow()))
+        return True
+
+    def run(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                break
+            try:
+                self.store.extract(*job)
+            except Exception as err:
+                logger.warning('Archive extraction failed: %s', err)
+            finally:
+                with self._lock:
+                    self.queued_bytes -= len(job[0])
+
+    def stop(self, timeout=None):
+        #the archives queued so far are extracted first
+        self._queue.put(None)
+        self.join(timeout)
@@ -0,0 +1,109 @@
+import os
+import json
+import random
+import string
+
+from pymongo import ReplaceOne
+
+from models import Docker, DockerImage, DockerContainer
+from utils import get_random_name, load_template
+
+#Builds the fake docker host of a sensor from templates/models and writes it with bulk upserts.
+#Every sensor gets its own profile: a subset of the template images and containers, container names
+#and ids, host name and resources. The choices are seeded with the sensor id, so seeding a sensor
+#again gives the same documents and only brings back what attackers changed.
+
+HOSTNAMES = ['ubuntu', 'docker', 'docker01', 'node1', 'worker-2', 'build', 'ci-runner', 'dev', 'srv01', 'k8s-node-3']
+RESOURCES = [(2, 2079064064), (4, 8201170944), (8, 16645939200), (16, 33564798976)]
+
+def random_hex(rng, length):
+    return ''.join(rng.choice('0123456789abcdef') for _ in range(length))
+
+def pick(rng, templates):
+    #the default entry and a random subset of the others
+    others = sorted(key for key in templates if key != 'default')
+    keys = ['default'] + rng.sample(others, rng.randint(0, len(others)))
+    return [templates[key] for key in keys]
+
+def build_container(rng, container, sensor_id):
+    old_id = container['Id']
+    new_id = random_hex(rng, 64)
+    container = json.loads(json.dumps(container).replace(old_id, new_id))
+    container['SensorId'] = sensor_id
+    container['Name'] = get_random_name(rng)
+    container['Config']['Hostname'] = new_id[:12]
+    container['State']['Pid'] = rng.randint(1000, 60000)
+    return container
+
+def build_profile(templates_dir, sensor_id):
+    rng = random.Random(sensor_id)
+
+    images = pick(rng, load_template(os.path.join(templates_dir, 'images.yml')))
+    for image in images:
+        image['SensorId'] = sensor_id
+
+    containers = [build_container(rng, container, sensor_id) for container in pick(rng, load_template(os.path.join(templates_dir, 'containers.yml')))]
+    running = sum(1 for container in containers if container['State']['Running'])
+
+    docker = load_template(os.path.join(templates_dir, 'docker.yml'))['default']
+    docker['SensorId'] = sensor_id
+    docker['ID'] = ':'.join(''.join(rng.choice(string.ascii_uppercase + '234567') for _ in range(4)) for _ in range(12))
+    docker['Name'] = rng.choice(HOSTNAMES)
+    docker['NCPU'], docker['MemTotal'] = rng.choice(RESOURCES)
+    docker['Containers'] = len(containers)
+    docker['ContainersRunning'] = running
+    docker['ContainersPaused'] = 0
+    docker['ContainersStopped'] = len(containers) - running
+    docker['Images'] = len(images)
+
+    #validated and converted by the models
+    return {
+        Docker: [Docker(**docker).to_mongo().to_dict()],
+        DockerImage: [DockerImage(**image).to_mongo().to_dict() for image in images],
+        DockerContainer: [DockerContainer(**container).to_mongo().to_dict() for container in containers],
+    }
+
+def document_key(model, document):
+    if model is Docker:
+        return {'SensorId': document['SensorId']}
+    return {'SensorId': document['SensorId'], 'Id': document['Id']}
+
+def seeded(model, sensor_id):
+    #the documents of the sensor that come from a profile, the containers created through the API have a
+    #CreatedAt and are left to the lifecycle (see lifecycle.py)
+    query = {'SensorId': sensor_id}
+    if model is DockerContainer:
+        query['CreatedAt'] = {'$exists': False}
+    return query
+
+def diff_profile(profile, sensor_id):
+    #[(change, model, key, changed fields)], change is one of '+', '~', '-'
+    changes = []
+    for model, documents in profile.items():
+        existing = {}
+        for document in model._get_collection().find(seeded(model, sensor_id)):
+            document.pop('_id')
+            existing[json.dumps(document_key(model, document), sort_keys=True)] = document
+
+        for document in documents:
+            key = json.dumps(document_key(model, document), sort_keys=True)
+            old = existing.pop(key, None)
+            if old is None:
+                changes.append(('+', model, key, []))
+            elif old != document:
+                fields = sorted(field for field in set(old) | set(document) if old.get(field) != document.get(field))
+                changes.append(('~', model, key, fields))
+
+        for key in existing:
+            changes.append(('-', model, key, []))
+
+    return changes
+
+def seed_profile(profile, sensor_id):
+    #upserts the profile and removes the documents it does not have, so the sensor is never left empty
+    for model, documents in profile.items():
+        collection = model._get_collection()
+        collection.bulk_write([ReplaceOne(document_key(model, document), document, upsert=True) for document in documents], ordered=False)
+
+        if model is not Docker:
+            collection.delete_many(dict(seeded(model, sensor_id), Id={'$nin': [document['Id'] for document in documents]}))
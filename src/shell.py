@@ -0,0 +1,797 @@
+import re
+import shlex
+import base64
+import datetime
+import functools
+import posixpath
+
+from utils import load_template
+
+#Emulated shell for exec and attach.
+#Every container sees the same read-only base filesystem, loaded once per process from
+#templates/shell/filesystem.yml. Files created, changed or deleted by a command go to a small
+#per-container overlay (copy-on-write), which is all that is stored per container.
+#Downloads (wget, curl) are recorded, never fetched; the target file is created empty.
+
+MAX_DEPTH = 8
+MAX_OUTPUT = 64*1024
+MAX_FILE_SIZE = 64*1024
+#files and directories of an overlay
+MAX_OVERLAY_FILES = 256
+#bytes of the paths and contents of an overlay, the overlay and the downloads are stored in one document (16MB at most)
+MAX_OVERLAY_SIZE = 4*1024*1024
+MAX_PATH = 4096
+MAX_DOWNLOADS = 100
+MAX_URL = 2048
+
+ELF_PLACEHOLDER = '\x7fELF'
+
+SUBSTITUTION = re.compile(r'\$\(([^()]*)\)|`([^`]*)`')
+VARIABLE = re.compile(r'\$\{(\w+)\}|\$(\w+|\?)')
+#what _expand looks at: single-quoted text is left as it is, the rest is expanded
+EXPANSION = re.compile(r"""'[^']*'|"(?:\\.|[^"\\])*"|\$\([^()]*\)|`[^`]*`|\$\{\w+\}|\$(?:\w+|\?)""")
+QUOTED = re.compile(r"""('[^']*'|"(?:\\.|[^"\\])*")""")
+#the 1 and 2 of 1> and 2>, outside quotes
+FD_REDIRECT = re.compile(r'(?<![^\s(])([12])(?=>)')
+
+class BaseFilesystem:
+    #read-only, shared by the overlays of all containers
+
+    def __init__(self, template):
+        self.files = dict(template.get('files') or {})
+        self.dirs = {'/'} | set(template.get('directories') or [])
+
+        for directory, names in (template.get('binaries') or {}).items():
+            for name in names:
+                self.files[posixpath.join(directory, name)] = ELF_PLACEHOLDER
+
+        self.children = {}
+        for path in list(self.files) + list(self.dirs):
+            if path == '/':
+                continue
+            parent = posixpath.dirname(path)
+            while parent not in self.dirs:
+                #parents of listed paths exist even if not listed
+                self.dirs.add(parent)
+                parent = posixpath.dirname(parent)
+            self.children.setdefault(posixpath.dirname(path), set()).add(posixpath.basename(path))
+        for path in self.dirs:
+            if path != '/':
+                self.children.setdefault(posixpath.dirname(path), set()).add(posixpath.basename(path))
+
+def split_commands(line):
+    #[(command, separator)] of a command line, split on ; && || & and | outside quotes and substitutions
+    commands = []
+    start = i = 0
+    quote = None
+    depth = 0
+    while i < len(line):
+        char = line[i]
+        if quote:
+            if char == '\\' and quote == '"':
+                i += 1
+            elif char == quote:
+                quote = None
+        elif char == '\\':
+            i += 1
+        elif char in '\'"`':
+            quote = char
+        elif line.startswith('$(', i):
+            depth += 1
+            i += 1
+        elif char == ')' and depth:
+            depth -= 1
+        elif char in ';&|' and not depth:
+            separator = line[i:i + 2] if line[i:i + 2] in ('&&', '||') else char
+            #the & of 2>&1, >&2 and &>file
+            if separator != '&' or not (line[i - 1:i] in ('<', '>') or line[i + 1:i + 2] == '>'):
+                commands.append((line[start:i], separator))
+                i += len(separator)
+                start = i
+                continue
+        i += 1
+    commands.append((line[start:], ';'))
+    return commands
+
+def mark_fd_redirects(command):
+    #2> and 1> become the words @2@ and @1@, shlex does not tell them from an argument followed by >
+    parts = QUOTED.split(command)
+    return ''.join(part if i % 2 else FD_REDIRECT.sub(r'@\1@', part) for i, part in enumerate(parts))
+
+@functools.lru_cache(maxsize=None)
+def get_base_filesystem(path):
+    return BaseFilesystem(load_template(path))
+
+def entry_size(path, content=None):
+    return len(path.encode('utf-8')) + len((content or '').encode('utf-8'))
+
+class Overlay:
+    #copy-on-write view of the base filesystem, the entries are the only per-container state
+    #a None content marks a deleted base file
+
+    def __init__(self, base, entries=None, variables=None):
+        self.base = base
+        self.variables = variables or {}
+        self.files = {}
+        self.dirs = set()
+        self.changed = False
+
+        for entry in entries or []:
+            if entry.get('Directory'):
+                self.dirs.add(entry['Path'])
+            else:
+                self.files[entry['Path']] = None if entry.get('Deleted') else entry.get('Content', '')
+        self.size = sum(entry_size(path, content) for path, content in self.files.items()) + sum(entry_size(path) for path in self.dirs)
+
+    def _fits(self, path, added):
+        #whether a new entry of added bytes is under the limits
+        if len(path) > MAX_PATH or self.size + added > MAX_OVERLAY_SIZE:
+            return False
+        return path in self.files or path in self.dirs or len(self.files) + len(self.dirs) < MAX_OVERLAY_FILES
+
+    def entries(self):
+        entries = [{'Path': path, 'Directory': True} for path in sorted(self.dirs)]
+        for path, content in sorted(self.files.items()):
+            entries.append({'Path': path, 'Deleted': True} if content is None else {'Path': path, 'Content': content})
+        return entries
+
+    def isdir(self, path):
+        if path in self.dirs:
+            return True
+        return path in self.base.dirs and self.files.get(path, '') is not None
+
+    def isfile(self, path):
+        if path in self.files:
+            return self.files[path] is not None
+        return path in self.base.files
+
+    def exists(self, path):
+        return self.isfile(path) or self.isdir(path)
+
+    def read(self, path):
+        if path in self.files:
+            return self.files[path]
+        content = self.base.files.get(path)
+        if content:
+            for name, value in self.variables.items():
+                content = content.replace('{' + name + '}', value)
+        return content
+
+    def write(self, path, content, append=False):
+        #False when the overlay is full, the file is left as it was
+        if append:
+            content = (self.read(path) or '') + content
+        content = content[:MAX_FILE_SIZE]
+        added = entry_size(path, content) - (entry_size(path, self.files[path]) if path in self.files else 0)
+        if not self._fits(path, added):
+            return False
+        self.files[path] = content
+        self.size += added
+        self.changed = True
+        return True
+
+    def remove(self, path):
+        if path in self.dirs:
+            self.dirs.discard(path)
+            self.size -= entry_size(path)
+        elif path in self.base.files or path in self.base.dirs:
+            #the base is bounded, its deletions always fit
+            self.size += entry_size(path) - (entry_size(path, self.files[path]) if path in self.files else 0)
+            self.files[path] = None
+        elif path in self.files:
+            self.size -= entry_size(path, self.files.pop(path))
+        self.changed = True
+
+    def mkdir(self, path):
+        if path in self.files:
+            self.size -= entry_size(path, self.files.pop(path))
+        if path not in self.dirs:
+            if not self._fits(path, entry_size(path)):
+                return False
+            self.dirs.add(path)
+            self.size += entry_size(path)
+        self.changed = True
+        return True
+
+    def listdir(self, path):
+        names = set(self.base.children.get(path, ()))
+        prefix = path.rstrip('/') + '/'
+        for overlay_path in list(self.files) + list(self.dirs):
+            if overlay_path.startswith(prefix) and '/' not in overlay_path[len(prefix):]:
+                names.add(overlay_path[len(prefix):])
+        return sorted(name for name in names if self.exists(prefix + name))
+
+class Shell:
+
+    def __init__(self, fs, hostname='localhost', kernel='5.4.0-65-generic', container_id=''):
+        self.fs = fs
+        self.hostname = hostname
+        self.kernel = kernel
+        self.container_id = container_id
+        self.cwd = '/root'
+        self.env = {
+            'PATH': '/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin',
+            'HOSTNAME': hostname,
+            'HOME': '/root',
+            'USER': 'root',
+            'SHELL': '/bin/bash',
+            'PWD': self.cwd,
+        }
+        self.status = 0
+        self.downloads = []
+        self.depth = 0
+        #where the stderr of the running command goes, the output of the tty outside a command line
+        self._stderr = None
+
+    def path(self, path):
+        if path.startswith('~'):
+            path = '/root' + path[1:]
+        return posixpath.normpath(posixpath.join(self.cwd, path)).replace('//', '/')
+
+    def run(self, command_line, stdin=''):
+        #returns the output of a command line, stdout and stderr interleaved as on a tty
+        #a nested run (script, sh -c, substitution) returns its stdout, its stderr goes to the command running it
+        if self.depth >= MAX_DEPTH:
+            return ''
+        output = []
+        tty = self._stderr is None
+        if tty:
+            self._stderr = output
+        self.depth += 1
+        try:
+            for line in command_line.splitlines():
+                self._run_list(line, stdin, output)
+        finally:
+            self.depth -= 1
+            if tty:
+                self._stderr = None
+        return ''.join(output)[:MAX_OUTPUT]
+
+    def run_argv(self, argv):
+        #an exec'd argument vector, no shell parsing as with docker exec
+        if not argv:
+            return ''
+        output = []
+        self._stderr = output
+        try:
+            output.append(self.execute(argv[0], list(argv[1:])))
+        finally:
+            self._stderr = None
+        return ''.join(output)[:MAX_OUTPUT]
+
+    def error(self, message, status=1):
+        #writes message to stderr, commands return its result
+        self.status = status
+        if self._stderr is None:
+            return message
+        self._stderr.append(message)
+        return ''
+
+    def _expand(self, command):
+        return EXPANSION.sub(lambda m: m.group(0) if m.group(0).startswith("'") else self._substitute(m.group(0)), command)
+
+    def _substitute(self, text):
+        text = SUBSTITUTION.sub(lambda m: self.run(m.group(1) or m.group(2) or '').strip(), text)
+        return VARIABLE.sub(lambda m: str(self.status) if m.group(2) == '?' else self.env.get(m.group(1) or m.group(2), ''), text)
+
+    def _run_list(self, command_line, stdin, output):
+        #appends the stdout of the pipelines to output, every simple command is expanded right before it runs
+        pipeline = []
+        condition = None
+        for command, separator in split_commands(command_line):
+            pipeline.append(command)
+            if separator == '|':
+                continue
+
+            if any(command.strip() for command in pipeline) and (condition is None or (condition == '&&') == (self.status == 0)):
+                try:
+                    output.append(self._run_pipeline(pipeline, stdin))
+                except ValueError:
+                    self.error('sh: 1: Syntax error: Unterminated quoted string\n', 2)
+                    return
+            pipeline = []
+            condition = separator if separator in ['&&', '||'] else None
+
+    def _run_pipeline(self, commands, stdin):
+        data = stdin
+        for command in commands:
+            data = self._run_simple(command, data)
+        return data
+
+    def _run_simple(self, command, stdin):
+        #stdout, the stderr goes to the command line unless redirected
+        lexer = shlex.shlex(self._expand(mark_fd_redirects(command)), posix=True, punctuation_chars=';&|<>()')
+        lexer.wordchars += ':@%+,!^[]{}'
+        #subshells run in the same shell
+        args = [token for token in lexer if token not in ['(', ')']]
+
+        #targets: 'out' (the pipe or the tty), 'err' (the stderr of the command line), None (/dev/null) or (path, append)
+        out, err = 'out', 'err'
+        words = []
+        i = 0
+        while i < len(args):
+            fd = None
+            if args[i] in ['@1@', '@2@'] and i + 1 < len(args):
+                fd = args[i][1]
+                i += 1
+            if args[i] in ['>', '>>', '>&', '&>'] and i + 1 < len(args):
+                operator, target = args[i], args[i + 1]
+                if operator == '>&' and target in ['1', '2']:
+                    if fd == '2':
+                        err = out if target == '1' else err
+                    else:
+                        out = err if target == '2' else out
+                else:
+                    target = None if target == '/dev/null' else (self.path(target), operator == '>>')
+                    if operator in ['>&', '&>']:
+                        out = err = target
+                    elif fd == '2':
+                        err = target
+                    else:
+                        out = target
+                i += 2
+                continue
+            if args[i] == '<' and i + 1 < len(args):
+                stdin = self.fs.read(self.path(args[i + 1])) or ''
+                i += 2
+                continue
+            words.append(args[i])
+            i += 1
+
+        #VAR=value assignments
+        while words and re.match(r'^\w+=', words[0]):
+            name, value = words.pop(0).split('=', 1)
+            self.env[name] = value
+
+        stderr = self._stderr
+        self._stderr = []
+        try:
+            if words:
+                output = self.execute(words[0], words[1:], stdin)
+            else:
+                self.status = 0
+                output = ''
+        finally:
+            errors = ''.join(self._stderr)
+            self._stderr = stderr
+
+        stdout = []
+        written = set()
+        for text, target in [(errors, err), (output, out)]:
+            if target == 'out':
+                stdout.append(text)
+            elif target == 'err':
+                self.error(text, self.status)
+            elif target is not None:
+                path, append = target
+                self.fs.write(path, text, append or path in written)
+                written.add(path)
+        return ''.join(stdout)
+
+    def execute(self, name, args, stdin=''):
+        self.status = 0
+        command = COMMANDS.get(posixpath.basename(name)) if '/' not in name or self.fs.isfile(self.path(name)) else None
+
+        if command is None and '/' in name:
+            path = self.path(name)
+            if not self.fs.isfile(path):
+                return self.error('sh: 1: {}: not found\n'.format(name), 127)
+            content = self.fs.read(path) or ''
+            if content.startswith(ELF_PLACEHOLDER):
+                return ''
+            return self.run(content)
+
+        if command is None:
+            return self.error('sh: 1: {}: not found\n'.format(name), 127)
+
+        return command(self, args, stdin)
+
+def split_options(args):
+    options = ''.join(arg[1:] for arg in args if arg.startswith('-') and len(arg) > 1 and not arg.startswith('--'))
+    operands = [arg for arg in args if not arg.startswith('-') or arg == '-']
+    return options, operands
+
+def cmd_true(shell, args, stdin):
+    return ''
+
+def cmd_false(shell, args, stdin):
+    shell.status = 1
+    return ''
+
+def cmd_echo(shell, args, stdin):
+    newline = True
+    while args and args[0] in ['-n', '-e', '-ne', '-en']:
+        newline = newline and 'n' not in args[0][1:]
+        args = args[1:]
+    text = ' '.join(args)
+    return text + '\n' if newline else text
+
+def cmd_printf(shell, args, stdin):
+    if not args:
+        return ''
+    text = args[0].replace('\\n', '\n').replace('\\t', '\t')
+    for value in args[1:]:
+        text = re.sub(r'%[sdb]', lambda m: value, text, count=1)
+    return text.replace('%%', '%')
+
+def cmd_id(shell, args, stdin):
+    options, _ = split_options(args)
+    if 'u' in options:
+        return 'root\n' if 'n' in options else '0\n'
+    return 'uid=0(root) gid=0(root) groups=0(root)\n'
+
+def cmd_whoami(shell, args, stdin):
+    return 'root\n'
+
+def cmd_hostname(shell, args, stdin):
+    return shell.hostname + '\n'
+
+def cmd_uname(shell, args, stdin):
+    options, _ = split_options(args)
+    parts = {
+        's': 'Linux', 'n': shell.hostname, 'r': shell.kernel, 'v': '#73-Ubuntu SMP Mon Jan 18 17:25:17 UTC 2021',
+        'm': 'x86_64', 'p': 'x86_64', 'i': 'x86_64', 'o': 'GNU/Linux'
+    }
+    if 'a' in options:
+        options = 'snrvmpio'
+    return ' '.join(parts[option] for option in (options or 's') if option in parts) + '\n'
+
+def cmd_pwd(shell, args, stdin):
+    return shell.cwd + '\n'
+
+def cmd_cd(shell, args, stdin):
+    path = shell.path(args[0] if args else '~')
+    if not shell.fs.isdir(path):
+        return shell.error('sh: 1: cd: can\'t cd to {}\n'.format(args[0]), 2)
+    shell.cwd = shell.env['PWD'] = path
+    return ''
+
+def cmd_ls(shell, args, stdin):
+    options, operands = split_options(args)
+    output = []
+    for operand in operands or ['.']:
+        path = shell.path(operand)
+        if shell.fs.isfile(path):
+            names = [operand]
+        elif shell.fs.isdir(path):
+            names = shell.fs.listdir(path)
+            if 'a' in options:
+                names = ['.', '..'] + names
+            else:
+                names = [name for name in names if not name.startswith('.')]
+        else:
+            shell.error('ls: cannot access \'{}\': No such file or directory\n'.format(operand), 2)
+            continue
+
+        if 'l' in options:
+            lines = []
+            for name in names:
+                full = posixpath.join(path, name) if shell.fs.isdir(path) else path
+                if shell.fs.isdir(full):
+                    lines.append('drwxr-xr-x 2 root root 4096 Jan 18 17:25 {}'.format(name))
+                else:
+                    lines.append('-rwxr-xr-x 1 root root {:>5} Jan 18 17:25 {}'.format(len(shell.fs.read(full) or ''), name))
+            output.append('total {}\n'.format(4 * len(names)) + '\n'.join(lines) + ('\n' if lines else ''))
+        elif names:
+            output.append('  '.join(names) + '\n')
+    return ''.join(output)
+
+def cmd_cat(shell, args, stdin):
+    _, operands = split_options(args)
+    if not operands:
+        return stdin
+    output = []
+    for operand in operands:
+        if operand == '-':
+            output.append(stdin)
+            continue
+        path = shell.path(operand)
+        if shell.fs.isdir(path):
+            shell.error('cat: {}: Is a directory\n'.format(operand))
+        elif not shell.fs.isfile(path):
+            shell.error('cat: {}: No such file or directory\n'.format(operand))
+        else:
+            output.append(shell.fs.read(path) or '')
+    return ''.join(output)
+
+def read_input(shell, operands, stdin):
+    if not operands:
+        return stdin
+    return ''.join(shell.fs.read(shell.path(operand)) or '' for operand in operands)
+
+def line_count(args, default=10):
+    for i, arg in enumerate(args):
+        if arg == '-n' and i + 1 < len(args) and args[i + 1].lstrip('-').isdigit():
+            return abs(int(args[i + 1])), args[:i] + args[i + 2:]
+        if re.match(r'^-n?\d+$', arg):
+            return int(arg.lstrip('-n')), args[:i] + args[i + 1:]
+    return default, args
+
+def cmd_head(shell, args, stdin):
+    count, args = line_count(args)
+    _, operands = split_options(args)
+    return ''.join(read_input(shell, operands, stdin).splitlines(True)[:count])
+
+def cmd_tail(shell, args, stdin):
+    count, args = line_count(args)
+    _, operands = split_options(args)
+    return ''.join(read_input(shell, operands, stdin).splitlines(True)[-count:] if count else [])
+
+def cmd_grep(shell, args, stdin):
+    options, operands = split_options(args)
+    if not operands:
+        return shell.error('Usage: grep [OPTION]... PATTERNS [FILE]...\n', 2)
+    pattern = operands[0]
+    flags = re.I if 'i' in options else 0
+    try:
+        regex = re.compile(pattern, flags)
+    except re.error:
+        regex = re.compile(re.escape(pattern), flags)
+
+    lines = [line for line in read_input(shell, operands[1:], stdin).splitlines(True) if bool(regex.search(line)) != ('v' in options)]
+    shell.status = 0 if lines else 1
+    if 'c' in options:
+        return '{}\n'.format(len(lines))
+    if 'q' in options:
+        return ''
+    return ''.join(lines)
+
+def cmd_wc(shell, args, stdin):
+    options, operands = split_options(args)
+    text = read_input(shell, operands, stdin)
+    if 'l' in options:
+        return '{}\n'.format(text.count('\n'))
+    if 'c' in options:
+        return '{}\n'.format(len(text))
+    return '{:>7} {:>7} {:>7}\n'.format(text.count('\n'), len(text.split()), len(text))
+
+def cmd_env(shell, args, stdin):
+    args = [arg for arg in args if '=' not in arg or arg.startswith('-')]
+    if args:
+        return shell.execute(args[0], args[1:], stdin)
+    return ''.join('{}={}\n'.format(name, value) for name, value in shell.env.items())
+
+def cmd_export(shell, args, stdin):
+    for arg in args:
+        if '=' in arg:
+            name, value = arg.split('=', 1)
+            shell.env[name] = value
+    return ''
+
+def cmd_ps(shell, args, stdin):
+    return (
+        '  PID TTY          TIME CMD\n'
+        '    1 ?        00:00:00 bash\n'
+        '   {:>2} ?        00:00:00 ps\n'.format(7 + shell.depth)
+    )
+
+def cmd_uptime(shell, args, stdin):
+    now = datetime.datetime.utcnow().strftime('%H:%M:%S')
+    return ' {} up 41 days,  3:12,  0 users,  load average: 0.08, 0.03, 0.01\n'.format(now)
+
+def cmd_nproc(shell, args, stdin):
+    return '2\n'
+
+def cmd_free(shell, args, stdin):
+    return (
+        '              total        used        free      shared  buff/cache   available\n'
+        'Mem:        2030336      818464      203920        1204     1007952     1120460\n'
+        'Swap:             0           0           0\n'
+    )
+
+def cmd_df(shell, args, stdin):
+    return (
+        'Filesystem     1K-blocks     Used Available Use% Mounted on\n'
+        'overlay         30308240 10496436  19795420  35% /\n'
+        'tmpfs              65536        0     65536   0% /dev\n'
+        'shm                65536        0     65536   0% /dev/shm\n'
+    )
+
+def cmd_date(shell, args, stdin):
+    return datetime.datetime.utcnow().strftime('%a %b %d %H:%M:%S UTC %Y') + '\n'
+
+def cmd_which(shell, args, stdin):
+    output = []
+    shell.status = 0
+    for name in [arg for arg in args if not arg.startswith('-')]:
+        for directory in shell.env['PATH'].split(':'):
+            path = posixpath.join(directory, name)
+            if shell.fs.isfile(path):
+                output.append(path + '\n')
+                break
+        else:
+            shell.status = 1
+    return ''.join(output)
+
+def cmd_touch(shell, args, stdin):
+    _, operands = split_options(args)
+    for operand in operands:
+        path = shell.path(operand)
+        if not shell.fs.exists(path):
+            shell.fs.write(path, '')
+    return ''
+
+def cmd_mkdir(shell, args, stdin):
+    _, operands = split_options(args)
+    for operand in operands:
+        shell.fs.mkdir(shell.path(operand))
+    return ''
+
+def cmd_rm(shell, args, stdin):
+    options, operands = split_options(args)
+    for operand in operands:
+        path = shell.path(operand)
+        if not shell.fs.exists(path):
+            if 'f' not in options:
+                shell.error('rm: cannot remove \'{}\': No such file or directory\n'.format(operand))
+            continue
+        shell.fs.remove(path)
+    return ''
+
+def cmd_cp(shell, args, stdin, move=False):
+    _, operands = split_options(args)
+    if len(operands) < 2:
+        return shell.error('{}: missing destination file operand\n'.format('mv' if move else 'cp'))
+
+    target = shell.path(operands[-1])
+    for operand in operands[:-1]:
+        source = shell.path(operand)
+        if not shell.fs.isfile(source):
+            return shell.error('{}: cannot stat \'{}\': No such file or directory\n'.format('mv' if move else 'cp', operand))
+        destination = posixpath.join(target, posixpath.basename(source)) if shell.fs.isdir(target) else target
+        shell.fs.write(destination, shell.fs.read(source) or '')
+        if move:
+            shell.fs.remove(source)
+    return ''
+
+def cmd_mv(shell, args, stdin):
+    return cmd_cp(shell, args, stdin, move=True)
+
+def cmd_chmod(shell, args, stdin):
+    _, operands = split_options(args)
+    for operand in operands[1:]:
+        if not shell.fs.exists(shell.path(operand)):
+            return shell.error('chmod: cannot access \'{}\': No such file or directory\n'.format(operand))
+    return ''
+
+def cmd_base64(shell, args, stdin):
+    options, operands = split_options(args)
+    data = read_input(shell, operands, stdin)
+    if 'd' in options or '--decode' in args:
+        try:
+            return base64.b64decode(''.join(data.split()) + '==').decode('utf-8', 'replace')
+        except ValueError:
+            return shell.error('base64: invalid input\n')
+    return base64.b64encode(data.encode('utf-8')).decode('ascii') + '\n'
+
+def download(shell, tool, url, target):
+    #the request is recorded, the file is created empty
+    if not re.match(r'^[a-z]+://', url):
+        url = 'http://' + url
+    if len(shell.downloads) < MAX_DOWNLOADS:
+        shell.downloads.append({'Tool': tool, 'Url': url[:MAX_URL], 'Path': target[:MAX_PATH] if target else target, 'Date': datetime.datetime.utcnow()})
+    if target:
+        shell.fs.write(target, '')
+
+def remote_name(url):
+    return posixpath.basename(url.split('?', 1)[0].rstrip('/')) or 'index.html'
+
+def cmd_wget(shell, args, stdin):
+    output_file, quiet, urls = None, False, []
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        if arg in ['-O', '--output-document'] and i + 1 < len(args):
+            output_file = args[i + 1]
+            i += 1
+        elif arg.startswith('-O') and len(arg) > 2:
+            output_file = arg[2:]
+        elif arg.startswith('--output-document='):
+            output_file = arg.split('=', 1)[1]
+        elif arg in ['-q', '--quiet'] or (arg.startswith('-') and 'q' in arg and not arg.startswith('--')):
+            quiet = True
+        elif not arg.startswith('-'):
+            urls.append(arg)
+        i += 1
+
+    if not urls:
+        return shell.error('wget: missing URL\nUsage: wget [OPTION]... [URL]...\n')
+
+    #the progress goes to stderr
+    for url in urls:
+        name = output_file or remote_name(url)
+        download(shell, 'wget', url, None if name == '-' else shell.path(name))
+        if not quiet:
+            shell.error(
+                '--{0}--  {1}\nConnecting to {2}... connected.\nHTTP request sent, awaiting response... 200 OK\n'
+                'Length: unspecified [application/octet-stream]\nSaving to: \'{3}\'\n\n'
+                '{0} - \'{3}\' saved\n\n'.format(datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S'), url, url.split('/')[2] if '://' in url else url.split('/')[0], name),
+                0
+            )
+    return ''
+
+def cmd_curl(shell, args, stdin):
+    output_file, use_remote_name, urls = None, False, []
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        if arg in ['-o', '--output'] and i + 1 < len(args):
+            output_file = args[i + 1]
+            i += 1
+        elif arg in ['-O', '--remote-name']:
+            use_remote_name = True
+        elif arg in ['-H', '-A', '-d', '-X', '-u', '-e', '--data', '--header', '--user-agent', '-m', '--max-time', '--connect-timeout'] and i + 1 < len(args):
+            i += 1
+        elif not arg.startswith('-'):
+            urls.append(arg)
+        i += 1
+
+    if not urls:
+        return shell.error('curl: try \'curl --help\' or \'curl --manual\' for more information\n', 2)
+
+    for url in urls:
+        name = output_file or (remote_name(url) if use_remote_name else None)
+        download(shell, 'curl', url, shell.path(name) if name and name != '-' else None)
+    return ''
+
+def cmd_sh(shell, args, stdin):
+    if args and args[0] == '-c':
+        return shell.run(args[1] if len(args) > 1 else '')
+
+    operands = [arg for arg in args if not arg.startswith('-')]
+    if operands:
+        path = shell.path(operands[0])
+        if not shell.fs.isfile(path):
+            return shell.error('sh: 0: Can\'t open {}\n'.format(operands[0]), 127)
+        return shell.run(shell.fs.read(path) or '')
+
+    #commands piped into the shell
+    return shell.run(stdin)
+
+def cmd_prefix(shell, args, stdin):
+    #nohup, sudo, timeout... run the rest of the line
+    while args and (args[0].startswith('-') or re.match(r'^\d+[smhd]?$', args[0])):
+        args = args[1:]
+    if not args:
+        return ''
+    return shell.execute(args[0], args[1:], stdin)
+
+def cmd_crontab(shell, args, stdin):
+    if '-l' in args:
+        content = shell.fs.read('/var/spool/cron/crontabs/root')
+        if content is None:
+            return shell.error('no crontab for root\n')
+        return content
+    if '-r' in args:
+        shell.fs.remove('/var/spool/cron/crontabs/root')
+        return ''
+    operands = [arg for arg in args if not arg.startswith('-')]
+    content = stdin if not operands or operands[0] == '-' else shell.fs.read(shell.path(operands[0])) or ''
+    shell.fs.write('/var/spool/cron/crontabs/root', content)
+    return ''
+
+def cmd_package_manager(shell, args, stdin):
+    #there is no network to install from, a quiet success keeps scripts going
+    return ''
+
+COMMANDS = {
+    'true': cmd_true, ':': cmd_true, 'false': cmd_false,
+    'echo': cmd_echo, 'printf': cmd_printf,
+    'id': cmd_id, 'whoami': cmd_whoami, 'hostname': cmd_hostname, 'uname': cmd_uname,
+    'pwd': cmd_pwd, 'cd': cmd_cd, 'ls': cmd_ls, 'cat': cmd_cat,
+    'head': cmd_head, 'tail': cmd_tail, 'grep': cmd_grep, 'egrep': cmd_grep, 'wc': cmd_wc,
+    'env': cmd_env, 'printenv': cmd_env, 'export': cmd_export,
+    'ps': cmd_ps, 'uptime': cmd_uptime, 'nproc': cmd_nproc, 'free': cmd_free, 'df': cmd_df, 'date': cmd_date,
+    'which': cmd_which, 'command': cmd_which, 'type': cmd_which,
+    'touch': cmd_touch, 'mkdir': cmd_mkdir, 'rm': cmd_rm, 'cp': cmd_cp, 'mv': cmd_mv,
+    'chmod': cmd_chmod, 'chown': cmd_chmod, 'chattr': cmd_chmod,
+    'base64': cmd_base64,
+    'wget': cmd_wget, 'curl': cmd_curl,
+    'sh': cmd_sh, 'bash': cmd_sh, 'dash': cmd_sh, 'ash': cmd_sh, 'source': cmd_sh, '.': cmd_sh,
+    'nohup': cmd_prefix, 'sudo': cmd_prefix, 'timeout': cmd_prefix, 'busybox': cmd_prefix,
+    'exec': cmd_prefix, 'setsid': cmd_prefix, 'nice': cmd_prefix,
+    'crontab': cmd_crontab,
+    'apt': cmd_package_manager, 'apt-get': cmd_package_manager, 'yum': cmd_package_manager, 'apk': cmd_package_manager,
+    'sleep': cmd_true, 'kill': cmd_true, 'pkill': cmd_true, 'killall': cmd_true, 'ulimit': cmd_true, 'set': cmd_true,
+    'unset': cmd_true, 'history': cmd_true, 'service': cmd_true, 'systemctl': cmd_true, 'sync': cmd_true,
+}
@@ -0,0 +1,104 @@
+import io
+import gzip
+import json
+import socket
+import http.client
+import urllib.parse
+
+from bson import json_util
+
+#Sensor side of the collector mode: request logs are shipped to collector.py instead of being written to Mongo.
+#The records go through the spool (see spool.py) and a sealed segment is sent in batches, one POST per batch:
+#  body     gzip of extended JSON lines, the documents carry their _id
+#  headers  Authorization: Bearer <token>, X-Sensor-Id, X-Batch-Id
+#The collector answers {'Batch': <id>, 'Stored': n} once the batch is written. Anything else raises, the segment
+#goes back to the spool and is sent again on the next attempt; the collector skips the batches it already stored.
+#The url is http://, https:// or unix:///path/to/collector.sock
+
+BATCH_PATH = '/batches'
+#the batches stored by the collector, see collector.py
+BATCH_COLLECTION = 'collector_batch'
+SENSOR_HEADER = 'X-Sensor-Id'
+BATCH_HEADER = 'X-Batch-Id'
+
+class ShippingError(Exception):
+    pass
+
+def encode_batch(documents, level=6):
+    lines = ''.join(json_util.dumps(document) + '\n' for document in documents)
+    return gzip.compress(lines.encode('utf-8'), level)
+
+def decode_batch(data, max_size):
+    with gzip.GzipFile(fileobj=io.BytesIO(data)) as f:
+        lines = f.read(max_size + 1)
+    if len(lines) > max_size:
+        raise ValueError('Batch is larger than {} bytes'.format(max_size))
+    return [json_util.loads(line) for line in lines.splitlines() if line.strip()]
+
+def batch_id(documents):
+    #the same for a batch sent again, the segments are not modified once sealed
+    return '{}-{}'.format(documents[0]['_id'], len(documents))
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+
+    def __init__(self, path, timeout):
+        super().__init__('localhost', timeout=timeout)
+        self.socket_path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+class Shipper:
+    #used by the spool drainer thread only, the connection is kept between batches
+
+    def __init__(self, url, token, sensor_id, timeout=10, compress_level=6):
+        self.url = urllib.parse.urlsplit(url)
+        self.token = token
+        self.sensor_id = sensor_id
+        self.timeout = timeout
+        self.compress_level = compress_level
+        self.path = self.url.path.rstrip('/') + BATCH_PATH if self.url.scheme != 'unix' else BATCH_PATH
+        self._connection = None
+
+    def connect(self):
+        if self.url.scheme == 'unix':
+            return UnixHTTPConnection(self.url.path, self.timeout)
+        if self.url.scheme == 'https':
+            return http.client.HTTPSConnection(self.url.netloc, timeout=self.timeout)
+        return http.client.HTTPConnection(self.url.netloc, timeout=self.timeout)
+
+    def send(self, documents):
+        batch = batch_id(documents)
+        headers = {
+            'Content-Type': 'application/x-ndjson',
+            'Content-Encoding': 'gzip',
+            SENSOR_HEADER: self.sensor_id,
+            BATCH_HEADER: batch
+        }
+        if self.token:
+            headers['Authorization'] = 'Bearer {}'.format(self.token)
+        body = encode_batch(documents, self.compress_level)
+
+        try:
+            if self._connection is None:
+                self._connection = self.connect()
+            self._connection.request('POST', self.path, body, headers)
+            response = self._connection.getresponse()
+            answer = response.read()
+        except (OSError, http.client.HTTPException):
+            self.close()
+            raise
+
+        if response.status != 200:
+            raise ShippingError('Collector answered {}: {}'.format(response.status, answer[:200]))
+        ack = json.loads(answer)
+        if ack.get('Batch') != batch:
+            raise ShippingError('Collector acknowledged {} instead of {}'.format(ack.get('Batch'), batch))
+        return ack
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
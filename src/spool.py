@@ -0,0 +1,249 @@
+import os
+import glob
+import time
+import uuid
+import fcntl
+import logging
+import datetime
+import threading
+
+from bson import json_util
+from bson.errors import BSONError
+from pymongo.errors import BulkWriteError
+
+#Store-and-forward spool for http_request_log documents.
+#Records are appended as extended JSON lines to a segment file owned by the writing process:
+#  <token>-<timestamp>.open      the active segment
+#  <token>-<timestamp>.spool     a sealed segment waiting to be replayed
+#  <token>-<timestamp>.<token>   a sealed segment claimed by a draining process
+#  <token>-<timestamp>.bad       a segment that could not be parsed, left for inspection
+#The token is unique to a process (pids start over after a container restart) and the owner holds a flock on its
+#open and claimed segments, a segment nobody holds a lock on belongs to a dead process.
+#Documents carry their _id, so a segment replayed twice (a crash between insert and unlink) is deduplicated by Mongo.
+#A line cut by a crash at the end of a segment is skipped.
+
+DUPLICATE_KEY_ERROR = 11000
+
+logger = logging.getLogger(__name__)
+
+#Stored of the documents inserted by insert_request_logs until the server time replaces it
+STORED_PENDING = datetime.datetime(9999, 12, 31)
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+_token = (None, None)
+
+def process_token():
+    #a forked worker gets its own token
+    global _token
+    if _token[0] != os.getpid():
+        _token = (os.getpid(), uuid.uuid4().hex)
+    return _token[1]
+
+def lock(f):
+    #True when the lock is taken, False when another open file holds it
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        return False
+    return True
+
+def insert_ignoring_duplicates(collection, documents):
+    try:
+        collection.insert_many(documents, ordered=False)
+    except BulkWriteError as err:
+        errors = [e for e in err.details.get('writeErrors', []) if e.get('code') != DUPLICATE_KEY_ERROR]
+        if errors or err.details.get('writeConcernErrors'):
+            raise
+
+def insert_request_logs(collection, documents):
+    #request logs written after the request was served (spool replay, collector, import) get Stored, the insert
+    #time of the server: their _id comes from the sensor and can be older than what the Parquet export has read
+    for document in documents:
+        document['Stored'] = STORED_PENDING
+    insert_ignoring_duplicates(collection, documents)
+    #the documents stored before keep their time, a replayed batch is not exported twice
+    collection.update_many(
+        {'_id': {'$in': [document['_id'] for document in documents]}, 'Stored': STORED_PENDING},
+        {'$currentDate': {'Stored': True}}
+    )
+
+class Spool:
+
+    def __init__(self, directory, segment_size=16*1024*1024, segment_age=30, max_bytes=1024*1024*1024, fsync=False):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.segment_age = segment_age
+        self.max_bytes = max_bytes
+        self.fsync = fsync
+        self.dropped = 0
+
+        self._lock = threading.Lock()
+        self._file = None
+        self._path = None
+        self._opened = None
+
+        os.makedirs(directory, exist_ok=True)
+
+    def _segments(self, pattern):
+        return sorted(glob.glob(os.path.join(self.directory, pattern)))
+
+    def size(self):
+        total = 0
+        for path in self._segments('*-*.*'):
+            try:
+                total += os.path.getsize(path)
+            except OSError:
+                pass
+        return total
+
+    def _seal(self):
+        #called with the lock held
+        if self._file is None:
+            return
+        #renamed while locked, recover never sees an unlocked open segment of a live process
+        os.rename(self._path, self._path[:-len('.open')] + '.spool')
+        self._file.close()
+        self._file = None
+        self._path = None
+
+    def append(self, document):
+        line = json_util.dumps(document) + '\n'
+
+        with self._lock:
+            if self._file is None:
+                if self.size() >= self.max_bytes:
+                    self.dropped += 1
+                    return False
+                self._path = os.path.join(self.directory, '{}-{}.open'.format(process_token(), time.time_ns()))
+                self._file = open(self._path, 'a')
+                lock(self._file)
+                self._opened = time.time()
+
+            self._file.write(line)
+            self._file.flush()
+            if self.fsync:
+                os.fsync(self._file.fileno())
+
+            if self._file.tell() >= self.segment_size:
+                self._seal()
+        return True
+
+    def close(self):
+        with self._lock:
+            self._seal()
+
+    def seal_idle(self):
+        with self._lock:
+            if self._file is not None and time.time() - self._opened >= self.segment_age:
+                self._seal()
+
+    def recover(self):
+        #segments left behind by dead processes: open ones are sealed, claimed ones are released
+        for path in self._segments('*-*.*'):
+            base, state = path.rsplit('.', 1)
+            if state in ('spool', 'bad') or process_token() in os.path.basename(path):
+                continue
+            try:
+                with open(path) as f:
+                    if lock(f):
+                        os.replace(path, base + '.spool')
+            except FileNotFoundError:
+                #sealed or released meanwhile
+                continue
+
+    def pending(self):
+        return self._segments('*-*.spool')
+
+    def drain(self, write, batch_size=1000):
+        #write(documents) raises if the documents could not be stored
+        #returns the number of replayed documents
+        replayed = 0
+        self.seal_idle()
+
+        for path in self.pending():
+            claimed = '{}.{}'.format(path[:-len('.spool')], process_token())
+            try:
+                f = open(path)
+            except FileNotFoundError:
+                #replayed by another worker
+                continue
+
+            with f:
+                try:
+                    if not lock(f):
+                        #claimed by another worker
+                        continue
+                    os.rename(path, claimed)
+                except FileNotFoundError:
+                    continue
+
+                try:
+                    replayed += self._replay(f, claimed, write, batch_size)
+                except Exception:
+                    os.rename(claimed, path)
+                    raise
+
+        return replayed
+
+    def _replay(self, f, claimed, write, batch_size):
+        #writes the records of a claimed segment and removes it, a segment with a damaged line in the middle is
+        #renamed .bad once the records before that line are written
+        replayed = 0
+        damaged = False
+        batch = []
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                batch.append(json_util.loads(line))
+            except (ValueError, BSONError):
+                if not line.endswith('\n'):
+                    #the last line, cut by a crash
+                    break
+                damaged = True
+                break
+            if len(batch) >= batch_size:
+                write(batch)
+                replayed += len(batch)
+                batch = []
+        if batch:
+            write(batch)
+            replayed += len(batch)
+
+        if damaged:
+            bad = claimed.rsplit('.', 1)[0] + '.bad'
+            os.rename(claimed, bad)
+            logger.warning('Spool segment %s could not be parsed after %d record(s)', os.path.basename(bad), replayed)
+        else:
+            os.remove(claimed)
+        return replayed
+
+class SpoolDrainer(threading.Thread):
+    #replays the spool once Mongo answers again
+
+    def __init__(self, spool, write, interval=10, batch_size=1000):
+        super().__init__(daemon=True, name='spool-drainer')
+        self.spool = spool
+        self.write = write
+        self.interval = interval
+        self.batch_size = batch_size
+        self._stop_event = threading.Event()
+
+    def run(self):
+        self.spool.recover()
+        while not self._stop_event.wait(self.interval):
+            try:
+                self.spool.drain(self.write, self.batch_size)
+            except Exception as err:
+                logger.warning('Spool replay failed: %s', err)
+
+    def stop(self):
+        self._stop_event.set()
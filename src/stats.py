@@ -0,0 +1,165 @@
+import json
+import hashlib
+import datetime
+
+from pymongo import ASCENDING, DESCENDING
+
+from retention import HOURLY_COLLECTION, DAILY_COLLECTION, ensure_ttl_index
+from ioc import IOC_COLLECTION
+from campaigns import CAMPAIGN_COLLECTION
+
+#Read-only top-N and timeline queries.
+#Request counts come from the hourly/daily rollups (see retention.py), so they cover the hours
+#rolled up so far. IOCs and campaigns are ranked by the all-time Hits of their own collections, which keep no
+#per-hour counts, so their tops take no range. Results are cached in stats_cache.
+
+CACHE_COLLECTION = 'stats_cache'
+
+#dimension: rollup field
+ROLLUP_DIMENSIONS = {
+    'source': 'SourceIP',
+    'action': 'Action',
+    'type': 'ActionType',
+    'image': 'Image',
+    'sensor': 'SensorId',
+    'path': 'Path',
+}
+
+#dimension: collection, field holding the value
+COLLECTION_DIMENSIONS = {
+    'ioc': (IOC_COLLECTION, 'Value'),
+    'campaign': (CAMPAIGN_COLLECTION, 'Example'),
+}
+
+DIMENSIONS = list(ROLLUP_DIMENSIONS) + list(COLLECTION_DIMENSIONS)
+
+def ensure_stats_indexes(db, cache_ttl):
+    ensure_ttl_index(db[CACHE_COLLECTION], 'Created', max(int(cache_ttl), 1))
+    db[IOC_COLLECTION].create_index([('Hits', DESCENDING)])
+    db[CAMPAIGN_COLLECTION].create_index([('Hits', DESCENDING)])
+    for name in [HOURLY_COLLECTION, DAILY_COLLECTION]:
+        for field in ['Action', 'Image']:
+            db[name].create_index([(field, ASCENDING), ('Date', DESCENDING)])
+
+def check_filters(dimension, filters):
+    #raises ValueError for the filters a query can not apply, dimension is None for a timeline
+    if not filters:
+        return
+    if dimension in COLLECTION_DIMENSIONS:
+        raise ValueError('{} does not support filters'.format(dimension))
+    unknown = sorted(set(filters) - set(ROLLUP_DIMENSIONS))
+    if unknown:
+        raise ValueError('Unsupported filter {}, should be one of: {}'.format(', '.join(unknown), ', '.join(ROLLUP_DIMENSIONS)))
+
+def hour_range(since, until):
+    #rollups have no finer resolution, whole hours also keep relative ranges cacheable
+    floor = lambda date: date.replace(minute=0, second=0, microsecond=0)
+    ceil = floor(until)
+    if ceil != until:
+        ceil += datetime.timedelta(hours=1)
+    return floor(since), ceil
+
+def rollup_collection(since, until, bucket=None):
+    #daily rollups when the range is made of whole days, hourly ones otherwise
+    if bucket == 'hour':
+        return HOURLY_COLLECTION
+    whole_days = all(date.time() == datetime.time(0) for date in [since, until])
+    if bucket == 'day' or whole_days:
+        return DAILY_COLLECTION
+    return HOURLY_COLLECTION
+
+class Stats:
+
+    def __init__(self, db, cache_ttl=60):
+        self.db = db
+        self.cache_ttl = cache_ttl
+
+    def _cached(self, query, compute):
+        if not self.cache_ttl:
+            return compute()
+
+        key = hashlib.sha1(json.dumps(query, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+        cache = self.db[CACHE_COLLECTION]
+        #the TTL monitor runs once a minute, expired entries are skipped here
+        fresh = datetime.datetime.utcnow() - datetime.timedelta(seconds=self.cache_ttl)
+        cached = cache.find_one({'_id': key, 'Created': {'$gte': fresh}})
+        if cached:
+            return cached['Result']
+
+        result = compute()
+        cache.replace_one({'_id': key}, {'Created': datetime.datetime.utcnow(), 'Result': result}, upsert=True)
+        return result
+
+    def top(self, dimension, since=None, until=None, limit=10, page=1, filters=None):
+        #[{'Value': ..., 'Count': ...}] sorted by Count, page starts at 1
+        #ioc and campaign: [{'Value': ..., 'Id': ..., 'Hits': ..., 'LastSeen': ...}] sorted by all-time Hits, no range
+        check_filters(dimension, filters)
+        skip = (page - 1) * limit
+
+        if dimension in COLLECTION_DIMENSIONS:
+            name, field = COLLECTION_DIMENSIONS[dimension]
+            query = {'query': 'top', 'dimension': dimension, 'limit': limit, 'page': page}
+
+            def compute():
+                documents = self.db[name].find({}, {field: 1, 'Hits': 1, 'LastSeen': 1}).sort('Hits', DESCENDING).skip(skip).limit(limit)
+                return [
+                    {'Value': document.get(field) or document['_id'], 'Id': str(document['_id']), 'Hits': document['Hits'], 'LastSeen': document.get('LastSeen')}
+                    for document in documents
+                ]
+
+            return self._cached(query, compute)
+
+        since, until = hour_range(since, until)
+        query = {'query': 'top', 'dimension': dimension, 'since': since, 'until': until, 'limit': limit, 'page': page, 'filters': filters}
+        field = ROLLUP_DIMENSIONS[dimension]
+
+        def compute():
+            match = {'Date': {'$gte': since, '$lt': until}}
+            match.update(self._filters(filters))
+            pipeline = [
+                {'$match': match},
+                {'$group': {'_id': '${}'.format(field), 'Count': {'$sum': '$Count'}}},
+                {'$sort': {'Count': DESCENDING, '_id': ASCENDING}},
+                {'$skip': skip},
+                {'$limit': limit}
+            ]
+            groups = self.db[rollup_collection(since, until)].aggregate(pipeline, allowDiskUse=True)
+            return [{'Value': group['_id'], 'Count': group['Count']} for group in groups]
+
+        return self._cached(query, compute)
+
+    def timeline(self, since, until, bucket='hour', filters=None):
+        #[{'Date': ..., 'Count': ...}] for every bucket with requests
+        check_filters(None, filters)
+        since, until = hour_range(since, until)
+        if bucket == 'day':
+            since = since.replace(hour=0)
+        query = {'query': 'timeline', 'since': since, 'until': until, 'bucket': bucket, 'filters': filters}
+
+        def compute():
+            match = {'Date': {'$gte': since, '$lt': until}}
+            match.update(self._filters(filters))
+            pipeline = [
+                {'$match': match},
+                {'$group': {'_id': '$Date', 'Count': {'$sum': '$Count'}}},
+                {'$sort': {'_id': ASCENDING}}
+            ]
+            groups = self.db[rollup_collection(since, until, bucket)].aggregate(pipeline)
+            return [{'Date': group['_id'], 'Count': group['Count']} for group in groups]
+
+        return self._cached(query, compute)
+
+    @staticmethod
+    def _filters(filters):
+        #{'source': '1.2.3.4'} -> {'SourceIP': '1.2.3.4'}
+        return {ROLLUP_DIMENSIONS[name]: value for name, value in (filters or {}).items()}
+
+def parse_since(value, now=None):
+    #'90m', '24h', '7d' relative to now or an ISO 8601 UTC date
+    now = now or datetime.datetime.utcnow()
+    units = {'m': 'minutes', 'h': 'hours', 'd': 'days', 'w': 'weeks'}
+    if value[:-1].isdigit() and value[-1] in units:
+        return now - datetime.timedelta(**{units[value[-1]]: int(value[:-1])})
+
+    from dateutil import parser
+    return parser.isoparse(value).replace(tzinfo=None)
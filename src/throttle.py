@@ -0,0 +1,102 @@
+import threading
+import time
+from collections import OrderedDict
+
+class TokenBucket:
+    __slots__ = ('tokens', 'updated', 'suppressed', 'first_suppressed', 'last_suppressed', 'last_path')
+
+    def __init__(self, tokens, now):
+        self.tokens = tokens
+        self.updated = now
+        self.suppressed = 0
+        self.first_suppressed = None
+        self.last_suppressed = None
+        self.last_path = None
+
+    def summary(self, source_ip):
+        return {
+            'SourceIP': source_ip,
+            'Count': self.suppressed,
+            'FirstSeen': self.first_suppressed,
+            'LastSeen': self.last_suppressed,
+            'LastPath': self.last_path
+        }
+
+class RateLimiter:
+    #per source IP token buckets kept in a bounded LRU
+    #a bucket costs a few dozen bytes, so max_clients=10000 stays well under a few MB per worker
+
+    def __init__(self, rate, burst, max_clients):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.max_clients = int(max_clients)
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def hit(self, source_ip, path=None, now=None):
+        #returns (allowed, summaries)
+        #summaries are the suppressed request counters that should be persisted now:
+        #the one of this client when it gets through again and the ones of evicted clients
+        now = now or time.time()
+        wall_now = time.time()
+        summaries = []
+
+        with self._lock:
+            bucket = self._buckets.get(source_ip)
+            if bucket is None:
+                bucket = TokenBucket(self.burst, now)
+                self._buckets[source_ip] = bucket
+                while len(self._buckets) > self.max_clients:
+                    evicted_ip, evicted = self._buckets.popitem(last=False)
+                    if evicted.suppressed:
+                        summaries.append(evicted.summary(evicted_ip))
+            else:
+                self._buckets.move_to_end(source_ip)
+                bucket.tokens = min(self.burst, bucket.tokens + (now - bucket.updated) * self.rate)
+                bucket.updated = now
+
+            if bucket.tokens >= 1:
+                bucket.tokens -= 1
+                if bucket.suppressed:
+                    summaries.append(bucket.summary(source_ip))
+                    bucket.suppressed = 0
+                    bucket.first_suppressed = None
+                return True, summaries
+
+            bucket.suppressed += 1
+            bucket.first_suppressed = bucket.first_suppressed or wall_now
+            bucket.last_suppressed = wall_now
+            bucket.last_path = path
+            return False, summaries
+
+    def drain(self):
+        #pending counters of all clients, used on shutdown
+        with self._lock:
+            summaries = [bucket.summary(ip) for ip, bucket in self._buckets.items() if bucket.suppressed]
+            for bucket in self._buckets.values():
+                bucket.suppressed = 0
+                bucket.first_suppressed = None
+        return summaries
+
+class Tarpit:
+    #only a few threads may be parked in the tarpit at a time,
+    #other over-limit clients are dropped right away so the pool is never exhausted by the tarpit itself
+
+    def __init__(self, delay, slots):
+        self.delay = float(delay)
+        self._slots = threading.BoundedSemaphore(max(int(slots), 0) or 1)
+        self._enabled = int(slots) > 0
+
+    def acquire(self):
+        return self._enabled and self._slots.acquire(blocking=False)
+
+    def release(self):
+        self._slots.release()
+
+    def drip(self, interval=1.0):
+        #a byte per interval keeps scanners waiting on the socket instead of reconnecting
+        deadline = time.time() + self.delay
+        while time.time() < deadline:
+            yield b' '
+            time.sleep(min(interval, max(deadline - time.time(), 0)))
+        yield b'{}'
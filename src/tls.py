@@ -0,0 +1,155 @@
+import ssl
+import socket
+import struct
+import hashlib
+import threading
+from collections import OrderedDict
+
+#TLS listener (2376) support: the SSL context and the ClientHello metadata of the connections.
+#gunicorn builds a new SSLContext per connection by default, which rules out session resumption and
+#loads the certificate every time. The context is built once in the master instead and inherited by
+#the workers, so they share its session cache setup and ticket keys and a scanner resuming a session
+#skips the full handshake whichever worker it reaches.
+#The ClientHello is read with MSG_PEEK before the handshake: the bytes stay in the kernel buffer and
+#OpenSSL reads them as usual, so there is no extra pass over the connection.
+#SNI, versions, ALPN and the JA3 fingerprint are kept per peer address for the requests of the connection.
+
+HANDSHAKE_RECORD = 22
+CLIENT_HELLO = 1
+MAX_RECORD = 16384
+
+#extensions
+SERVER_NAME = 0
+SUPPORTED_GROUPS = 10
+EC_POINT_FORMATS = 11
+ALPN = 16
+SUPPORTED_VERSIONS = 43
+
+def is_grease(value):
+    #RFC 8701 values, left out of JA3
+    return value & 0x0f0f == 0x0a0a and value >> 8 == value & 0xff
+
+def u16_list(data):
+    return [value for (value,) in struct.iter_unpack('!H', data[:len(data) - len(data) % 2])]
+
+def parse_client_hello(data):
+    #{'Version', 'Sni', 'Alpn', 'SupportedVersions', 'Ja3', 'Ja3Hash'} or None when data is not a ClientHello
+    if len(data) < 5 or data[0] != HANDSHAKE_RECORD:
+        return None
+    record_length = struct.unpack('!H', data[3:5])[0]
+    hello = data[5:5 + record_length]
+    if len(hello) < 38 or hello[0] != CLIENT_HELLO:
+        return None
+
+    try:
+        version = struct.unpack('!H', hello[4:6])[0]
+        position = 38
+        position += 1 + hello[position]
+        ciphers_length = struct.unpack('!H', hello[position:position + 2])[0]
+        ciphers = u16_list(hello[position + 2:position + 2 + ciphers_length])
+        position += 2 + ciphers_length
+        position += 1 + hello[position]
+
+        extensions = []
+        groups = []
+        point_formats = []
+        info = {'Sni': None, 'Alpn': [], 'SupportedVersions': []}
+        if position + 2 <= len(hello):
+            end = position + 2 + struct.unpack('!H', hello[position:position + 2])[0]
+            position += 2
+            while position + 4 <= min(end, len(hello)):
+                kind, length = struct.unpack('!HH', hello[position:position + 4])
+                body = hello[position + 4:position + 4 + length]
+                position += 4 + length
+                extensions.append(kind)
+
+                if kind == SERVER_NAME and len(body) >= 5 and body[2] == 0:
+                    name_length = struct.unpack('!H', body[3:5])[0]
+                    info['Sni'] = body[5:5 + name_length].decode('ascii', 'replace')
+                elif kind == SUPPORTED_GROUPS:
+                    groups = u16_list(body[2:])
+                elif kind == EC_POINT_FORMATS and body:
+                    point_formats = list(body[1:1 + body[0]])
+                elif kind == ALPN:
+                    names = body[2:]
+                    while names:
+                        info['Alpn'].append(names[1:1 + names[0]].decode('ascii', 'replace'))
+                        names = names[1 + names[0]:]
+                elif kind == SUPPORTED_VERSIONS and body:
+                    info['SupportedVersions'] = [value for value in u16_list(body[1:1 + body[0]]) if not is_grease(value)]
+    except (IndexError, struct.error):
+        return None
+
+    ja3 = ','.join([
+        str(version),
+        '-'.join(str(value) for value in ciphers if not is_grease(value)),
+        '-'.join(str(value) for value in extensions if not is_grease(value)),
+        '-'.join(str(value) for value in groups if not is_grease(value)),
+        '-'.join(str(value) for value in point_formats),
+    ])
+    info.update({'Version': version, 'Ja3': ja3, 'Ja3Hash': hashlib.md5(ja3.encode('ascii')).hexdigest()})
+    return info
+
+def peek_client_hello(sock, timeout):
+    #the first TLS record, left in the socket buffer for the handshake
+    previous = sock.gettimeout()
+    sock.settimeout(timeout)
+    try:
+        header = sock.recv(5, socket.MSG_PEEK | socket.MSG_WAITALL)
+        if len(header) < 5 or header[0] != HANDSHAKE_RECORD:
+            return None
+        length = min(struct.unpack('!H', header[3:5])[0], MAX_RECORD)
+        return sock.recv(5 + length, socket.MSG_PEEK | socket.MSG_WAITALL)
+    except OSError:
+        return None
+    finally:
+        sock.settimeout(previous)
+
+class HandshakeRegistry:
+    #(peer ip, peer port): ClientHello metadata, the requests of a connection find it through
+    #REMOTE_ADDR and REMOTE_PORT
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self._handshakes = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, address, port, info):
+        with self._lock:
+            self._handshakes[(address, str(port))] = info
+            self._handshakes.move_to_end((address, str(port)))
+            while len(self._handshakes) > self.max_size:
+                self._handshakes.popitem(last=False)
+
+    def get(self, address, port):
+        with self._lock:
+            return self._handshakes.get((address, str(port)))
+
+handshakes = HandshakeRegistry()
+
+class FingerprintingContext(ssl.SSLContext):
+    peek_timeout = 5
+
+    def wrap_socket(self, sock, *args, **kwargs):
+        hello = peek_client_hello(sock, self.peek_timeout)
+        info = parse_client_hello(hello) if hello else None
+        if info:
+            try:
+                peer = sock.getpeername()
+                handshakes.add(peer[0], peer[1], info)
+            except OSError:
+                pass
+        return super().wrap_socket(sock, *args, **kwargs)
+
+def create_context(certfile, keyfile, fingerprint=True, cache_size=10000, peek_timeout=5):
+    #called once, before the workers are forked
+    context_class = FingerprintingContext if fingerprint else ssl.SSLContext
+    context = context_class(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(certfile=certfile, keyfile=keyfile)
+    context.options |= ssl.OP_NO_COMPRESSION
+    #session tickets stay enabled, the ticket keys are generated with the context and shared through the fork
+    context.options &= ~ssl.OP_NO_TICKET
+    if fingerprint:
+        context.peek_timeout = peek_timeout
+    handshakes.max_size = cache_size
+    return context
@@ -2,20 +2,63 @@ import random
 import os
 import yaml
 import re
+import json
+import hashlib
+import copy
+import functools
 
 def extract_urls(cmd):
     regex=r"""\b((?:https?://)?(?:(?:www\.)?(?:[\da-z\.-]+)\.(?:[a-z]{2,6})|(?:(?:25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)\.){3}(?:25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)|(?:(?:[0-9a-fA-F]{1,4}:){7,7}[0-9a-fA-F]{1,4}|(?:[0-9a-fA-F]{1,4}:){1,7}:|(?:[0-9a-fA-F]{1,4}:){1,6}:[0-9a-fA-F]{1,4}|(?:[0-9a-fA-F]{1,4}:){1,5}(?::[0-9a-fA-F]{1,4}){1,2}|(?:[0-9a-fA-F]{1,4}:){1,4}(?::[0-9a-fA-F]{1,4}){1,3}|(?:[0-9a-fA-F]{1,4}:){1,3}(?::[0-9a-fA-F]{1,4}){1,4}|(?:[0-9a-fA-F]{1,4}:){1,2}(?::[0-9a-fA-F]{1,4}){1,5}|[0-9a-fA-F]{1,4}:(?:(?::[0-9a-fA-F]{1,4}){1,6})|:(?:(?::[0-9a-fA-F]{1,4}){1,7}|:)|fe80:(?::[0-9a-fA-F]{0,4}){0,4}%[0-9a-zA-Z]{1,}|::(?:ffff(?::0{1,4}){0,1}:){0,1}(?:(?:25[0-5]|(?:2[0-4]|1{0,1}[0-9]){0,1}[0-9])\.){3,3}(?:25[0-5]|(?:2[0-4]|1{0,1}[0-9]){0,1}[0-9])|(?:[0-9a-fA-F]{1,4}:){1,4}:(?:(?:25[0-5]|(?:2[0-4]|1{0,1}[0-9]){0,1}[0-9])\.){3,3}(?:25[0-5]|(?:2[0-4]|1{0,1}[0-9]){0,1}[0-9])))(?::[0-9]{1,4}|[1-5][0-9]{4}|6[0-4][0-9]{3}|65[0-4][0-9]{2}|655[0-2][0-9]|6553[0-5])?(?:/[\w\.-]*)*/?)\b"""
     matches = re.findall(regex, cmd)
     return list(set(matches))
 
-def get_random_name():
+def hash_headers(headers):
+    return hashlib.sha1(json.dumps(headers, sort_keys=True).encode('utf-8')).hexdigest()
+
+#the libyaml loader when pyyaml was built with it
+YamlLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+@functools.lru_cache(maxsize=None)
+def _load_template(path):
+    with open(path) as file:
+        return yaml.load(file, Loader=YamlLoader)
+
+def load_template(path):
+    #parsed once per process, every caller gets its own copy to modify
+    return copy.deepcopy(_load_template(path))
+
+def get_random_name(rng=random):
     # Open the file in read mode
     words1 = ["admiring","adoring","affectionate","agitated","amazing","angry","awesome","beautiful","blissful","bold","boring","brave","busy","charming","clever","cool","compassionate","competent","condescending","confident","cranky","crazy","dazzling","determined","distracted","dreamy","eager","ecstatic","elastic","elated","elegant","eloquent","epic","exciting","fervent","festive","flamboyant","focused","friendly","frosty","funny","gallant","gifted","goofy","gracious","great","happy","hardcore","heuristic","hopeful","hungry","infallible","inspiring","interesting","intelligent","jolly","jovial","keen","kind","laughing","loving","lucid","magical","mystifying","modest","musing","naughty","nervous","nice","nifty","nostalgic","objective","optimistic","peaceful","pedantic","pensive","practical","priceless","quirky","quizzical","recursing","relaxed","reverent","romantic","sad","serene","sharp","silly","sleepy","stoic","strange","stupefied","suspicious","sweet","tender","thirsty","trusting","unruffled","upbeat","vibrant","vigilant","vigorous","wizardly","wonderful","xenodochial","youthful","zealous","zen"]
     words2 = ["albattani","allen","almeida","antonelli","agnesi","archimedes","ardinghelli","aryabhata","austin","babbage","banach","overthruster","banzai","bardeen","bartik","bassi","beaver","bell","benz","bhabha","bhaskara","black","blackburn","blackwell","bohr","booth","borg","bose","bouman","boyd","brahmagupta","brattain","brown","buck","burnell","cannon","carson","cartwright","carver","cerf","chandrasekhar","chaplygin","chatelet","chatterjee","chebyshev","cohen","chaum","clarke","colden","cori","cray","curran","curie","darwin","davinci","dewdney","dhawan","diffie","dijkstra","dirac","driscoll","dubinsky","easley","edison","einstein","elbakyan","elgamal","elion","ellis","engelbart","euclid","euler","faraday","feistel","fermat","fermi","feynman","franklin","gagarin","galileo","galois","ganguly","gates","gauss","germain","goldberg","goldstine","goldwasser","golick","goodall","gould","greider","grothendieck","haibt","hamilton","haslett","hawking","hellman","heisenberg","hermann","herschel","hertz","heyrovsky","hodgkin","hofstadter","hoover","hopper","hugle","hypatia","ishizaka","jackson","jang","jemison","jennings","jepsen","johnson","joliot","jones","kalam","kapitsa","kare","keldysh","keller","kepler","khayyam","khorana","kilby","kirch","knuth","kowalevski","lalande","lamarr","lamport","leakey","leavitt","lederberg","lehmann","lewin","lichterman","liskov","lovelace","lumiere","mahavira","margulis","matsumoto","maxwell","mayer","mccarthy","mcclintock","mclaren","mclean","mcnulty","mendel","mendeleev","meitner","meninsky","merkle","mestorf","mirzakhani","montalcini","moore","morse","murdock","moser","napier","nash","neumann","newton","nightingale","nobel","noether","northcutt","noyce","panini","pare","pascal","pasteur","payne","perlman","pike","poincare","poitras","proskuriakova","ptolemy","raman","ramanujan","ride","ritchie","rhodes","robinson","roentgen","rosalind","rubin","saha","sammet","sanderson","satoshi","shamir","shannon","shaw","shirley","shockley","shtern","sinoussi","snyder","solomon","spence","stonebraker","sutherland","swanson","swartz","swirles","taussig","tereshkova","tesla","tharp","thompson","torvalds","tu","turing","varahamihira","vaughan","visvesvaraya","volhard","villani","wescoff","wilbur","wiles","williams","williamson","wilson","wing","wozniak","wright","wu","yalow","yonath","zhukovsky"]
   
-    return '/{}_{}'.format(random.choice(words1),random.choice(words2))
+    return '/{}_{}'.format(rng.choice(words1),rng.choice(words2))
+
+def get_option(file_settings, section, key, default=None, env_name=None):
+    #environment variables override the settings file, as for the options in get_settings
+    #the value type follows the type of the default
+    env_name = env_name or '{}_{}'.format(section, key)
+
+    if env_name in os.environ:
+        value = os.environ[env_name]
+        if isinstance(default, bool):
+            return value.lower() == 'true'
+        elif isinstance(default, int):
+            return int(value)
+        elif isinstance(default, float):
+            return float(value)
+        elif isinstance(default, list):
+            return [x.strip() for x in value.split(',') if x.strip()]
+        return value
 
+    if file_settings and file_settings.get(section) and key in file_settings[section]:
+        return file_settings[section][key]
+
+    return default
+
+@functools.lru_cache(maxsize=None)
 def get_settings():
+    #read once per process, the returned dict is shared and must not be modified
     CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
     SETTINGS_PATH = os.path.join(CURRENT_DIR,'settings','settings.yml')
 
@@ -57,6 +100,9 @@ def get_settings():
     else:
         settings['mongodb']['uri'] = file_settings['mongodb']['uri']
 
+    settings['mongodb']['max_pool_size'] = get_option(file_settings, 'mongodb', 'max_pool_size', 20)
+    settings['mongodb']['min_pool_size'] = get_option(file_settings, 'mongodb', 'min_pool_size', 0)
+
     if 'misp_url' in os.environ:
         settings['misp']['url'] = os.environ['misp_url']
     else:
@@ -80,4 +126,149 @@ def get_settings():
     else:
         settings['misp']['cert'] = file_settings['misp']['cert']
 
+    settings['gunicorn'] = {
+        'bind': get_option(file_settings, 'gunicorn', 'bind', '0.0.0.0:2375'),
+        'workers': get_option(file_settings, 'gunicorn', 'workers', 0),
+        'max_workers': get_option(file_settings, 'gunicorn', 'max_workers', 8),
+        'threads': get_option(file_settings, 'gunicorn', 'threads', 5),
+        'preload': get_option(file_settings, 'gunicorn', 'preload', True),
+        'max_requests': get_option(file_settings, 'gunicorn', 'max_requests', 10000),
+        'max_requests_jitter': get_option(file_settings, 'gunicorn', 'max_requests_jitter', 1000),
+        'timeout': get_option(file_settings, 'gunicorn', 'timeout', 60),
+        'graceful_timeout': get_option(file_settings, 'gunicorn', 'graceful_timeout', 30),
+        'keepalive': get_option(file_settings, 'gunicorn', 'keepalive', 5),
+    }
+
+    settings['tls'] = {
+        'enabled': get_option(file_settings, 'tls', 'enabled', False),
+        'bind': get_option(file_settings, 'tls', 'bind', '0.0.0.0:2376'),
+        'certfile': get_option(file_settings, 'tls', 'certfile', os.path.join(CURRENT_DIR, 'certs', 'server-cert.pem')),
+        'keyfile': get_option(file_settings, 'tls', 'keyfile', os.path.join(CURRENT_DIR, 'certs', 'server-key.pem')),
+        'fingerprint': get_option(file_settings, 'tls', 'fingerprint', True),
+        'cache_size': get_option(file_settings, 'tls', 'cache_size', 10000),
+        'handshake_timeout': get_option(file_settings, 'tls', 'handshake_timeout', 5),
+    }
+
+    settings['throttle'] = {
+        'enabled': get_option(file_settings, 'throttle', 'enabled', False),
+        'rate': get_option(file_settings, 'throttle', 'rate', 2.0),
+        'burst': get_option(file_settings, 'throttle', 'burst', 20),
+        'max_clients': get_option(file_settings, 'throttle', 'max_clients', 10000),
+        'mode': get_option(file_settings, 'throttle', 'mode', 'tarpit'),
+        'tarpit_delay': get_option(file_settings, 'throttle', 'tarpit_delay', 10.0),
+        'tarpit_slots': get_option(file_settings, 'throttle', 'tarpit_slots', 2),
+    }
+
+    settings['compaction'] = {
+        'enabled': get_option(file_settings, 'compaction', 'enabled', False),
+        'window': get_option(file_settings, 'compaction', 'window', 300),
+        'paths': get_option(file_settings, 'compaction', 'paths', ['/_ping', '/version', '/info', '/containers/json', '/images/json']),
+        'exclude': get_option(file_settings, 'compaction', 'exclude', ['/containers/create', '/exec', '/start', '/build', '/archive', '/images/create']),
+        'max_groups': get_option(file_settings, 'compaction', 'max_groups', 10000),
+    }
+
+    settings['interning'] = {
+        'enabled': get_option(file_settings, 'interning', 'enabled', False),
+        'user_agent': get_option(file_settings, 'interning', 'user_agent', False),
+        'cache_size': get_option(file_settings, 'interning', 'cache_size', 10000),
+    }
+
+    settings['spool'] = {
+        'enabled': get_option(file_settings, 'spool', 'enabled', False),
+        'directory': get_option(file_settings, 'spool', 'directory', os.path.join(CURRENT_DIR, 'spool')),
+        'segment_size': get_option(file_settings, 'spool', 'segment_size', 16*1024*1024),
+        'segment_age': get_option(file_settings, 'spool', 'segment_age', 30),
+        'max_bytes': get_option(file_settings, 'spool', 'max_bytes', 1024*1024*1024),
+        'fsync': get_option(file_settings, 'spool', 'fsync', False),
+        'interval': get_option(file_settings, 'spool', 'interval', 10),
+        'batch_size': get_option(file_settings, 'spool', 'batch_size', 1000),
+        'retry_interval': get_option(file_settings, 'spool', 'retry_interval', 10),
+        'mongo_timeout_ms': get_option(file_settings, 'spool', 'mongo_timeout_ms', 2000),
+    }
+
+    settings['collector'] = {
+        'url': get_option(file_settings, 'collector', 'url', ''),
+        'token': get_option(file_settings, 'collector', 'token', ''),
+        'interval': get_option(file_settings, 'collector', 'interval', 5),
+        'batch_size': get_option(file_settings, 'collector', 'batch_size', 500),
+        'timeout': get_option(file_settings, 'collector', 'timeout', 10),
+        'compress_level': get_option(file_settings, 'collector', 'compress_level', 6),
+        'max_batch_bytes': get_option(file_settings, 'collector', 'max_batch_bytes', 64*1024*1024),
+        'batch_ttl': get_option(file_settings, 'collector', 'batch_ttl', 7*24*3600),
+    }
+
+    settings['samples'] = {
+        'enabled': get_option(file_settings, 'samples', 'enabled', False),
+        'directory': get_option(file_settings, 'samples', 'directory', os.path.join(CURRENT_DIR, 'samples')),
+        'max_queued_bytes': get_option(file_settings, 'samples', 'max_queued_bytes', 128*1024*1024),
+        'max_archive_size': get_option(file_settings, 'samples', 'max_archive_size', 64*1024*1024),
+        'max_entries': get_option(file_settings, 'samples', 'max_entries', 1000),
+        'max_entry_size': get_option(file_settings, 'samples', 'max_entry_size', 32*1024*1024),
+        'max_total_size': get_option(file_settings, 'samples', 'max_total_size', 256*1024*1024),
+    }
+
+    settings['containers'] = {
+        'run_seconds': get_option(file_settings, 'containers', 'run_seconds', 60),
+        'max_containers': get_option(file_settings, 'containers', 'max_containers', 100),
+        'ttl': get_option(file_settings, 'containers', 'ttl', 7*24*3600),
+        'archive': get_option(file_settings, 'containers', 'archive', False),
+        'archive_ttl_days': get_option(file_settings, 'containers', 'archive_ttl_days', 90.0),
+        'interval': get_option(file_settings, 'containers', 'interval', 10),
+    }
+
+    settings['retention'] = {
+        'raw_ttl_days': get_option(file_settings, 'retention', 'raw_ttl_days', 0.0),
+        'hourly_ttl_days': get_option(file_settings, 'retention', 'hourly_ttl_days', 90.0),
+        'daily_ttl_days': get_option(file_settings, 'retention', 'daily_ttl_days', 0.0),
+        'lag': get_option(file_settings, 'retention', 'lag', 600),
+    }
+
+    settings['analyzer'] = {
+        'batch_size': get_option(file_settings, 'analyzer', 'batch_size', 500),
+        'batch_timeout': get_option(file_settings, 'analyzer', 'batch_timeout', 1.0),
+        'workers': get_option(file_settings, 'analyzer', 'workers', os.cpu_count() or 1),
+        'job_timeout': get_option(file_settings, 'analyzer', 'job_timeout', 10.0),
+        'max_pending': get_option(file_settings, 'analyzer', 'max_pending', 100),
+    }
+
+    settings['geoip'] = {
+        'city_db': get_option(file_settings, 'geoip', 'city_db', os.path.join(CURRENT_DIR, 'geoip', 'GeoLite2-City.mmdb')),
+        'asn_db': get_option(file_settings, 'geoip', 'asn_db', os.path.join(CURRENT_DIR, 'geoip', 'GeoLite2-ASN.mmdb')),
+        'cache_size': get_option(file_settings, 'geoip', 'cache_size', 100000),
+    }
+
+    settings['campaigns'] = {
+        'enabled': get_option(file_settings, 'campaigns', 'enabled', True),
+        'threshold': get_option(file_settings, 'campaigns', 'threshold', 0.6),
+    }
+
+    settings['stats'] = {
+        'cache_ttl': get_option(file_settings, 'stats', 'cache_ttl', 60),
+    }
+
+    settings['profiling'] = {
+        'enabled': get_option(file_settings, 'profiling', 'enabled', False),
+        'socket_dir': get_option(file_settings, 'profiling', 'socket_dir', '/tmp/dockertrap-profiling'),
+        'slow_ms': get_option(file_settings, 'profiling', 'slow_ms', 0),
+    }
+
+    settings['inspect'] = {
+        'cache_size': get_option(file_settings, 'inspect', 'cache_size', 1024),
+        'cache_ttl': get_option(file_settings, 'inspect', 'cache_ttl', 5),
+    }
+
+    settings['images'] = {
+        'cache_size': get_option(file_settings, 'images', 'cache_size', 1024),
+        'cache_ttl': get_option(file_settings, 'images', 'cache_ttl', 30),
+    }
+
+    settings['events'] = {
+        'history': get_option(file_settings, 'events', 'history', 1000),
+        'persist': get_option(file_settings, 'events', 'persist', True),
+        'ttl': get_option(file_settings, 'events', 'ttl', 7*24*3600),
+        'poll_interval': get_option(file_settings, 'events', 'poll_interval', 1.0),
+        'max_subscribers': get_option(file_settings, 'events', 'max_subscribers', 2),
+        'max_duration': get_option(file_settings, 'events', 'max_duration', 300),
+    }
+
     return settings
\ No newline at end of file
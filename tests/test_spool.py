@@ -0,0 +1,88 @@
+import os
+import sys
+import subprocess
+
+from bson import ObjectId
+
+from spool import Spool
+
+def spool_with(directory, *segments):
+    spool = Spool(str(directory))
+    for records in segments:
+        for n in records:
+            spool.append({'_id': ObjectId(), 'n': n})
+        spool.close()
+    return spool
+
+def segment_files(directory):
+    return sorted(os.listdir(str(directory)))
+
+def test_drain_writes_and_removes(tmp_path):
+    spool = spool_with(tmp_path, [0, 1], [2])
+    written = []
+    assert spool.drain(written.extend) == 3
+    assert [d['n'] for d in written] == [0, 1, 2]
+    assert segment_files(tmp_path) == []
+
+def test_drain_skips_truncated_last_line(tmp_path):
+    spool = spool_with(tmp_path, [0, 1, 2], [3])
+    first = os.path.join(str(tmp_path), segment_files(tmp_path)[0])
+    with open(first) as f:
+        data = f.read()
+    with open(first, 'w') as f:
+        f.write(data[:-10])
+
+    written = []
+    assert spool.drain(written.extend) == 3
+    assert [d['n'] for d in written] == [0, 1, 3]
+    assert segment_files(tmp_path) == []
+
+def test_drain_quarantines_damaged_segment(tmp_path):
+    spool = spool_with(tmp_path, [0, 1], [2])
+    first = os.path.join(str(tmp_path), segment_files(tmp_path)[0])
+    with open(first) as f:
+        lines = f.readlines()
+    with open(first, 'w') as f:
+        f.write(lines[0] + 'garbage\n' + lines[1])
+
+    written = []
+    assert spool.drain(written.extend) == 2
+    assert [d['n'] for d in written] == [0, 2]
+    assert [name.rsplit('.', 1)[1] for name in segment_files(tmp_path)] == ['bad']
+
+def test_drain_keeps_segment_when_write_fails(tmp_path):
+    spool = spool_with(tmp_path, [0])
+
+    def fail(documents):
+        raise OSError('down')
+
+    try:
+        spool.drain(fail)
+    except OSError:
+        pass
+    assert [name.rsplit('.', 1)[1] for name in segment_files(tmp_path)] == ['spool']
+
+def test_recover_releases_unlocked_segments_only(tmp_path):
+    dead = tmp_path / 'deadbeef-1.open'
+    dead.write_text('{"n": 1}\n')
+    live = tmp_path / 'cafe-2.open'
+    holder = subprocess.Popen(
+        [sys.executable, '-c', 'import fcntl, sys; f = open(sys.argv[1], "a"); fcntl.flock(f, fcntl.LOCK_EX); print(1, flush=True); sys.stdin.read()', str(live)],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE
+    )
+    try:
+        holder.stdout.readline()
+        Spool(str(tmp_path)).recover()
+        assert segment_files(tmp_path) == ['cafe-2.open', 'deadbeef-1.spool']
+    finally:
+        holder.stdin.close()
+        holder.wait()
+
+    Spool(str(tmp_path)).recover()
+    assert segment_files(tmp_path) == ['cafe-2.spool', 'deadbeef-1.spool']
+
+def test_recover_keeps_own_open_segment(tmp_path):
+    spool = spool_with(tmp_path)
+    spool.append({'_id': ObjectId(), 'n': 0})
+    spool.recover()
+    assert [name.rsplit('.', 1)[1] for name in segment_files(tmp_path)] == ['open']